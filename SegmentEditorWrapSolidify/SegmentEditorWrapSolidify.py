@@ -53,6 +53,12 @@ class SegmentEditorWrapSolidifyTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_WrapSolidify1()
+    self.setUp()
+    self.test_WrapSolidifyCavityOrientation()
+    self.setUp()
+    self.test_WrapSolidifyRegionSegmentLabelmap()
+    self.setUp()
+    self.test_WrapSolidifyDilationMatchesImageMargin()
 
   def test_WrapSolidify1(self):
     """
@@ -189,3 +195,170 @@ class SegmentEditorWrapSolidifyTest(ScriptedLoadableModuleTest):
     self.assertEqual( round(statistics["MODEL_both",'ScalarVolumeSegmentStatisticsPlugin.volume_mm3']), 9245)
     
     self.delayDisplay('test_WrapSolidify1 passed')
+
+  def test_WrapSolidifyCavityOrientation(self):
+    """
+    Check orientation of extracted cavity surfaces. The cavity surface is the boundary of everything except
+    the cavity, therefore it is oriented the opposite way as the outer surface (enclosed volumes have opposite sign),
+    and shell offset direction refers to the same side relative to the object wall for both.
+    """
+
+    self.delayDisplay("Starting test_WrapSolidifyCavityOrientation")
+
+    import sys
+    import numpy as np
+    libPath = os.path.join(os.path.dirname(__file__), self.__class__.__name__[:-len('Test')] + 'Lib')
+    if libPath not in sys.path:
+      sys.path.insert(0, libPath)
+    import SegmentEditorEffect
+    from WrapSolidifyTesting import createWrapSolidifyLogic, getSignedVolume
+
+    # Hollow sphere: the inner sphere is an internal cavity
+    appender = vtk.vtkAppendPolyData()
+    for radius in [30, 15]:
+      sphereSource = vtk.vtkSphereSource()
+      sphereSource.SetRadius(radius)
+      sphereSource.SetPhiResolution(60)
+      sphereSource.SetThetaResolution(60)
+      appender.AddInputConnection(sphereSource.GetOutputPort())
+    appender.Update()
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+    segmentId = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(appender.GetOutput(), "HollowSphere")
+
+    def computeWrapSolidify(region, shellOffsetDirection=None):
+      parameters = {'region': region}
+      if shellOffsetDirection:
+        parameters.update({'createShell': True, 'shellThickness': 2.0, 'shellOffsetDirection': shellOffsetDirection})
+      outputPd = createWrapSolidifyLogic(segmentationNode, segmentId, parameters).computeWrapSolidify()
+      outputPds = outputPd if isinstance(outputPd, list) else [outputPd]
+      self.assertEqual(len(outputPds), 1)
+      return outputPds[0]
+
+    def getMaximumRadius(surfacePd):
+      bounds = np.zeros(6)
+      surfacePd.GetBounds(bounds)
+      return bounds[1]
+
+    outerSurfaceVolume = getSignedVolume(computeWrapSolidify(SegmentEditorEffect.REGION_OUTER_SURFACE))
+    # Inside shell of the outer surface: the original surface is the outer side of the shell (radius 30)
+    # if the offset goes into the object wall, otherwise the shell extends to radius 32
+    outerShellIntoWall = getMaximumRadius(computeWrapSolidify(SegmentEditorEffect.REGION_OUTER_SURFACE,
+      SegmentEditorEffect.SHELL_OFFSET_INSIDE)) < 31.0
+    logging.info("Outer surface: enclosed volume {0:.0f}mm3, inside shell offset into the wall: {1}".format(
+      outerSurfaceVolume, outerShellIntoWall))
+
+    cavityVolume = 4.0 / 3.0 * 3.14159 * 15 ** 3
+    for region in [SegmentEditorEffect.REGION_LARGEST_CAVITY, SegmentEditorEffect.REGION_CAVITIES]:
+      volume = getSignedVolume(computeWrapSolidify(region))
+      logging.info("Region {0}: cavity volume {1:.0f}mm3".format(region, volume))
+      self.assertGreater(abs(volume), 0.7 * cavityVolume)
+      self.assertLess(abs(volume), 1.3 * cavityVolume)
+      self.assertLess(volume * outerSurfaceVolume, 0)
+
+      # Inside shell of the cavity surface: the shell extends to radius 17 if the offset goes into the object wall,
+      # otherwise the original surface is the outer side of the shell (radius 15)
+      cavityShellIntoWall = getMaximumRadius(computeWrapSolidify(region, SegmentEditorEffect.SHELL_OFFSET_INSIDE)) > 16.0
+      self.assertEqual(cavityShellIntoWall, outerShellIntoWall)
+
+    self.delayDisplay('test_WrapSolidifyCavityOrientation passed')
+
+  def test_WrapSolidifyRegionSegmentLabelmap(self):
+    """
+    Check that a custom region segment is used when the source representation is binary labelmap
+    (closed surface representation of the segmentation is not created by the effect then).
+    """
+
+    self.delayDisplay("Starting test_WrapSolidifyRegionSegmentLabelmap")
+
+    import sys
+    libPath = os.path.join(os.path.dirname(__file__), self.__class__.__name__[:-len('Test')] + 'Lib')
+    if libPath not in sys.path:
+      sys.path.insert(0, libPath)
+    import SegmentEditorEffect
+    from WrapSolidifyTesting import createWrapSolidifyLogic
+
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+    segmentIds = []
+    for name, radius in [("Input", 20), ("Region", 30)]:
+      sphereSource = vtk.vtkSphereSource()
+      sphereSource.SetRadius(radius)
+      sphereSource.SetPhiResolution(60)
+      sphereSource.SetThetaResolution(60)
+      sphereSource.Update()
+      segmentIds.append(segmentationNode.AddSegmentFromClosedSurfaceRepresentation(sphereSource.GetOutput(), name))
+    segmentationNode.CreateBinaryLabelmapRepresentation()
+    try:
+      segmentationNode.SetSourceRepresentationToBinaryLabelmap()
+    except AttributeError:
+      # Legacy (Slicer-5.3 and earlier)
+      segmentationNode.SetMasterRepresentationToBinaryLabelmap()
+    segmentationNode.RemoveClosedSurfaceRepresentation()
+
+    logic = createWrapSolidifyLogic(segmentationNode, segmentIds[0], {'region': SegmentEditorEffect.REGION_SEGMENT}, segmentIds[1])
+    outputPd = logic.computeWrapSolidify()
+
+    # The region segment is shrunk onto the input sphere
+    massProperties = vtk.vtkMassProperties()
+    massProperties.SetInputData(outputPd)
+    massProperties.Update()
+    sphereVolume = 4.0 / 3.0 * 3.14159 * 20 ** 3
+    logging.info("Region segment output volume {0:.0f}mm3".format(massProperties.GetVolume()))
+    self.assertGreater(massProperties.GetVolume(), 0.7 * sphereVolume)
+    self.assertLess(massProperties.GetVolume(), 1.3 * sphereVolume)
+
+    self.delayDisplay('test_WrapSolidifyRegionSegmentLabelmap passed')
+
+  def test_WrapSolidifyDilationMatchesImageMargin(self):
+    """
+    Check that dilation by thresholding the shared input distance map gives the same labelmap
+    as dilation by vtkITKImageMargin (that was used for each dilation before).
+    """
+
+    self.delayDisplay("Starting test_WrapSolidifyDilationMatchesImageMargin")
+
+    import sys
+    import numpy as np
+    import vtkITK
+    from vtk.util import numpy_support
+    libPath = os.path.join(os.path.dirname(__file__), self.__class__.__name__[:-len('Test')] + 'Lib')
+    if libPath not in sys.path:
+      sys.path.insert(0, libPath)
+    import SegmentEditorEffect
+    from WrapSolidifyTesting import createWrapSolidifyLogic
+
+    # Input with a narrow gap, so that the dilated labelmap is not just a larger sphere
+    appender = vtk.vtkAppendPolyData()
+    for center in [(-12, 0, 0), (12, 0, 0)]:
+      sphereSource = vtk.vtkSphereSource()
+      sphereSource.SetCenter(center)
+      sphereSource.SetRadius(10)
+      sphereSource.SetPhiResolution(40)
+      sphereSource.SetThetaResolution(40)
+      appender.AddInputConnection(sphereSource.GetOutputPort())
+    appender.Update()
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+    segmentId = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(appender.GetOutput(), "TwoSpheres")
+
+    logic = createWrapSolidifyLogic(segmentationNode, segmentId, {'region': SegmentEditorEffect.REGION_OUTER_SURFACE,
+      'carveHolesInOuterSurface': True, 'carveHolesInOuterSurfaceDiameter': 10.0})
+    try:
+      logic._startComputation()
+      for radius in [5.0, 2.5]:
+        dilatedLabelmap = logic._getDilatedInputLabelmap(radius)
+        inputLabelmap = SegmentEditorEffect.WrapSolidifyLogic._polydataToLabelmap(logic._inputPd, referenceImage=dilatedLabelmap)
+        margin = vtkITK.vtkITKImageMargin()
+        margin.SetInputData(inputLabelmap)
+        margin.CalculateMarginInMMOn()
+        margin.SetOuterMarginMM(radius)
+        margin.Update()
+        dilatedVoxels = numpy_support.vtk_to_numpy(dilatedLabelmap.GetPointData().GetScalars()) > 0
+        marginVoxels = numpy_support.vtk_to_numpy(margin.GetOutput().GetPointData().GetScalars()) > 0
+        numberOfDifferentVoxels = np.count_nonzero(dilatedVoxels != marginVoxels)
+        logging.info("Dilation radius {0}mm: {1} of {2} dilated voxels are different".format(
+          radius, numberOfDifferentVoxels, np.count_nonzero(marginVoxels)))
+        # Only voxels exactly at the dilation radius may be classified differently
+        self.assertLess(numberOfDifferentVoxels, 0.01 * np.count_nonzero(marginVoxels))
+    finally:
+      logic._cleanup()
+
+    self.delayDisplay('test_WrapSolidifyDilationMatchesImageMargin passed')
@@ -1,8 +1,17 @@
 import os
 import vtk, qt, ctk, slicer
 import logging
+import time
+import json
+import contextlib
+import hashlib
+import collections
+import threading
+import copy
+import zlib
 from SegmentEditorEffects import *
 import numpy as np
+from vtk.util import numpy_support
 import math
 import vtkSegmentationCorePython
 
@@ -16,6 +25,22 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
 
     self.logic = WrapSolidifyLogic()
     self.logic.logCallback = self.addLog
+    self.logic.progressCallback = self.setProgress
+
+    # Use computation time measured in previous sessions for estimating computation time
+    secondsPerVoxelIteration = slicer.app.userSettings().value("WrapSolidify/SecondsPerVoxelIteration")
+    if secondsPerVoxelIteration:
+      self.logic.secondsPerVoxelIteration = float(secondsPerVoxelIteration)
+
+    # Background processing
+    self.backgroundTimer = None
+    self.backgroundStatusMessage = None
+    self.backgroundProgress = None
+
+    # Resource estimate is updated after parameter changes have stopped for a while,
+    # so that it is not recomputed for each intermediate value while a slider is dragged
+    self.resourceEstimateTimer = None
+    self.resourceEstimateInput = None  # (segmentation node, segment ID) of the displayed estimate
 
   def clone(self):
     # It should not be necessary to modify this method
@@ -43,7 +68,19 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     self.cleanup()
 
   def cleanup(self):
-    pass
+    if self.resourceEstimateTimer:
+      self.resourceEstimateTimer.stop()
+    if self.backgroundTimer and self.backgroundTimer.isActive():
+      # Stop the background computation and discard the result
+      self.backgroundTimer.stop()
+      self.logic.requestCancel()
+      try:
+        self.logic.finishWrapSolidify(writeOutput=False)
+      except ValueError:
+        pass
+      self.onApplyFinished(None)
+    # Segment editor effects expect all segments to have the source representation
+    self.updateDeferredRepresentations()
 
   def setupOptionsFrame(self):
 
@@ -65,6 +102,7 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     self.ui.regionGroup.addButton(self.ui.regionOuterSurfaceRadioButton)
     self.ui.regionGroup.addButton(self.ui.regionLargestCavityRadioButton)
     self.ui.regionGroup.addButton(self.ui.regionSegmentRadioButton)
+    self.ui.regionGroup.addButton(self.ui.regionCavitiesRadioButton)
 
     self.ui.shellOffsetDirectionGroup = qt.QButtonGroup()
     self.ui.shellOffsetDirectionGroup.addButton(self.ui.shellOffsetInsideRadioButton)
@@ -75,6 +113,17 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     self.ui.outputTypeGroup.addButton(self.ui.outputNewSegmentRadioButton)
     self.ui.outputTypeGroup.addButton(self.ui.outputModelRadioButton)
 
+    self.ui.isoSurfaceEngineGroup = qt.QButtonGroup()
+    self.ui.isoSurfaceEngineGroup.addButton(self.ui.isoSurfaceEngineMarchingCubesRadioButton)
+    self.ui.isoSurfaceEngineGroup.addButton(self.ui.isoSurfaceEngineFlyingEdgesRadioButton)
+    self.ui.isoSurfaceEngineGroup.addButton(self.ui.isoSurfaceEngineSurfaceNetsRadioButton)
+    self.ui.isoSurfaceEngineSurfaceNetsRadioButton.enabled = hasattr(vtk, 'vtkSurfaceNets3D')
+
+    self.ui.initialShapeGroup = qt.QButtonGroup()
+    self.ui.initialShapeGroup.addButton(self.ui.initialShapeSphereRadioButton)
+    self.ui.initialShapeGroup.addButton(self.ui.initialShapeConvexHullRadioButton)
+    self.ui.initialShapeGroup.addButton(self.ui.initialShapeOrientedBoundingBoxRadioButton)
+
     # Widget to arguments mapping
     self.valueEditWidgets = {
       ARG_REGION: self.ui.regionGroup,
@@ -83,6 +132,8 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
       ARG_CARVE_HOLES_IN_OUTER_SURFACE_DIAMETER: self.ui.carveHolesInOuterSurfaceDiameterSlider,
       ARG_SPLIT_CAVITIES: self.ui.splitCavitiesCheckBox,
       ARG_SPLIT_CAVITIES_DIAMETER: self.ui.splitCavitiesDiameterSlider,
+      ARG_CAVITIES_MAX_COUNT: self.ui.cavitiesMaxCountSlider,
+      ARG_CAVITIES_MINIMUM_VOLUME: self.ui.cavitiesMinimumVolumeSlider,
       ARG_CREATE_SHELL: self.ui.createShellCheckBox,
       ARG_SHELL_THICKNESS: self.ui.shellThicknessSlider,
       ARG_SHELL_OFFSET_DIRECTION: self.ui.shellOffsetDirectionGroup,
@@ -92,7 +143,20 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
       ARG_SMOOTHING_FACTOR: self.ui.smoothingFactorSlider,
       ARG_REMESH_OVERSAMPLING: self.ui.remeshOversamplingSlider,
       ARG_SHRINKWRAP_ITERATIONS: self.ui.iterationsSlider,
-      ARG_SAVE_INTERMEDIATE_RESULTS: self.ui.saveIntermediateResultsCheckBox
+      ARG_SHRINKWRAP_COARSE_TO_FINE: self.ui.coarseToFineCheckBox,
+      ARG_SHRINKWRAP_STOP_AT_CONVERGENCE: self.ui.stopAtConvergenceCheckBox,
+      ARG_REMESH_NARROW_BAND: self.ui.narrowBandCheckBox,
+      ARG_REMESH_ANISOTROPIC: self.ui.anisotropicCheckBox,
+      ARG_SPLIT_COMPONENTS: self.ui.splitComponentsCheckBox,
+      ARG_INITIAL_SHAPE: self.ui.initialShapeGroup,
+      ARG_WARM_START: self.ui.warmStartCheckBox,
+      ARG_COMPACT_UNDO: self.ui.compactUndoCheckBox,
+      ARG_DEFER_REPRESENTATION_UPDATE: self.ui.deferRepresentationUpdateCheckBox,
+      ARG_TIMING_REPORT: self.ui.timingReportCheckBox,
+      ARG_ISO_SURFACE_ENGINE: self.ui.isoSurfaceEngineGroup,
+      ARG_MEMORY_BUDGET_MB: self.ui.memoryBudgetSlider,
+      ARG_SAVE_INTERMEDIATE_RESULTS: self.ui.saveIntermediateResultsCheckBox,
+      ARG_RUN_IN_BACKGROUND: self.ui.runInBackgroundCheckBox
     }
 
     # Add connections
@@ -113,6 +177,17 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
         raise Exception("Unexpected widget class: {0}".format(widgetClassName))
 
     self.ui.applyButton.connect('clicked()', self.onApply)
+    self.ui.undoButton.connect('clicked()', self.onUndo)
+    self.ui.estimateButton.connect('clicked()', self.updateResourceEstimate)
+
+    self.backgroundTimer = qt.QTimer()
+    self.backgroundTimer.setInterval(200)
+    self.backgroundTimer.connect('timeout()', self.onBackgroundTimer)
+
+    self.resourceEstimateTimer = qt.QTimer()
+    self.resourceEstimateTimer.setSingleShot(True)
+    self.resourceEstimateTimer.setInterval(500)
+    self.resourceEstimateTimer.connect('timeout()', self.updateResourceEstimate)
 
   def createCursor(self, widget):
     return slicer.util.mainWindow().cursor
@@ -167,20 +242,55 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     createShell = (self.scriptedEffect.parameter(ARG_CREATE_SHELL) == "True")
     region = self.scriptedEffect.parameter(ARG_REGION)
 
-    self.valueEditWidgets[ARG_CARVE_HOLES_IN_OUTER_SURFACE].enabled = (region == REGION_OUTER_SURFACE or region == REGION_LARGEST_CAVITY)
+    self.valueEditWidgets[ARG_CARVE_HOLES_IN_OUTER_SURFACE].enabled = (region == REGION_OUTER_SURFACE or region in CAVITY_REGIONS)
     self.valueEditWidgets[ARG_CARVE_HOLES_IN_OUTER_SURFACE_DIAMETER].enabled = (carveHolesInOuterSurface
       and self.valueEditWidgets[ARG_CARVE_HOLES_IN_OUTER_SURFACE].enabled)
 
-    self.valueEditWidgets[ARG_SPLIT_CAVITIES].enabled = region == REGION_LARGEST_CAVITY
+    self.valueEditWidgets[ARG_SPLIT_CAVITIES].enabled = region in CAVITY_REGIONS
     self.valueEditWidgets[ARG_SPLIT_CAVITIES_DIAMETER].enabled = (splitCavities and self.valueEditWidgets[ARG_SPLIT_CAVITIES].enabled)
 
+    self.valueEditWidgets[ARG_CAVITIES_MAX_COUNT].enabled = (region == REGION_CAVITIES)
+    self.valueEditWidgets[ARG_CAVITIES_MINIMUM_VOLUME].enabled = (region == REGION_CAVITIES)
+
     self.valueEditWidgets[ARG_REGION_SEGMENT_ID].enabled = (region == REGION_SEGMENT)
+    self.valueEditWidgets[ARG_SPLIT_COMPONENTS].enabled = (region != REGION_SEGMENT)
+    for widget in self.valueEditWidgets[ARG_INITIAL_SHAPE].buttons():
+      widget.enabled = (region != REGION_SEGMENT and not carveHolesInOuterSurface)
+    self.valueEditWidgets[ARG_WARM_START].enabled = (region != REGION_SEGMENT
+      and self.scriptedEffect.parameter(ARG_SPLIT_COMPONENTS) != "True")
+
+    self.ui.undoButton.visible = (self.scriptedEffect.parameter(ARG_COMPACT_UNDO) == "True")
+    self.ui.undoButton.enabled = self.logic.canUndo() and not self.logic.isWrapSolidifyRunning()
 
     self.valueEditWidgets[ARG_SHELL_THICKNESS].enabled = createShell
     for widget in self.valueEditWidgets[ARG_SHELL_OFFSET_DIRECTION].buttons():
       widget.enabled = createShell
     self.valueEditWidgets[ARG_SHELL_PRESERVE_CRACKS].enabled = createShell
 
+    self.ui.estimateButton.enabled = not self.logic.isWrapSolidifyRunning()
+    if self.resourceEstimateInput != (parameterNode.GetSegmentationNode(), parameterNode.GetSelectedSegmentID()):
+      # Estimate is only computed on request or on parameter change (not on each GUI update), clear the outdated estimate
+      self.ui.resourceEstimateLabel.text = ""
+
+  def updateResourceEstimate(self):
+    """Show estimated memory usage and computation time"""
+    if self.logic.isWrapSolidifyRunning():
+      # Logic inputs must not be changed while computation is in progress
+      return
+    estimateText = ""
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    self.resourceEstimateInput = (parameterSetNode.GetSegmentationNode(), parameterSetNode.GetSelectedSegmentID())
+    if parameterSetNode.GetSegmentationNode() and parameterSetNode.GetSelectedSegmentID():
+      try:
+        self.updateLogicInputs()
+        estimate = self.logic.estimateResources()
+        estimateText = "spacing {0:.2f}mm, memory {1:.0f}MB, time {2:.0f}s".format(
+          np.max(estimate['spacing']), estimate['peakMemoryMB'], estimate['expectedTimeSec'])
+      except ValueError:
+        # Input segment is empty
+        pass
+    self.ui.resourceEstimateLabel.text = estimateText
+
   def updateMRMLFromGUI(self):
     wasModified = self.scriptedEffect.parameterSetNode().StartModify()
     for argName, widget in self.valueEditWidgets.items():
@@ -203,86 +313,199 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
       else:
         raise Exception("Unexpected widget class: {0}".format(widgetClassName))
     self.scriptedEffect.parameterSetNode().EndModify(wasModified)
+    if not self.logic.isWrapSolidifyRunning():
+      self.resourceEstimateTimer.start()
 
   def addLog(self, text):
+    if threading.current_thread() is not threading.main_thread():
+      # Called from the background thread, GUI is updated by the timer
+      self.backgroundStatusMessage = text
+      return
     slicer.util.showStatusMessage(text)
     slicer.app.processEvents() # force update
 
+  def setProgress(self, progress):
+    if threading.current_thread() is not threading.main_thread():
+      self.backgroundProgress = progress
+      return
+    self.ui.progressBar.value = int(round(progress * 100))
+
   def onApply(self):
 
     if self.ui.applyButton.text == 'Cancel':
       self.logic.requestCancel()
       return
 
-    self.scriptedEffect.saveStateForUndo()
-
     errorMessage = None
     self.ui.applyButton.text = 'Cancel'
-    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    self.ui.undoButton.enabled = False
+    self.ui.estimateButton.enabled = False
+    self.resourceEstimateTimer.stop()
+    self.ui.progressBar.value = 0
+    self.ui.progressBar.visible = True
+    runInBackground = (self.scriptedEffect.parameter(ARG_RUN_IN_BACKGROUND) == "True")
+    if not runInBackground:
+      qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
     try:
-      # Set inputs
-      self.logic.segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
-
-      # Save smoothing factor
-      segmentationSmoothingFactor = (
-        self.logic.segmentationNode.GetSegmentation().GetConversionParameter(
-          'Smoothing factor'
-        )
-      )
-
-      # Continue setting inputs
-      self.logic.segmentId = currentSegmentId = self.scriptedEffect.parameterSetNode().GetSelectedSegmentID()
-      self.logic.region = self.scriptedEffect.parameter(ARG_REGION)
-      self.logic.regionSegmentId = self.scriptedEffect.parameter(ARG_REGION_SEGMENT_ID) if self.scriptedEffect.parameterDefined(ARG_REGION_SEGMENT_ID) else ""
-      self.logic.carveHolesInOuterSurface = (self.scriptedEffect.parameter(ARG_CARVE_HOLES_IN_OUTER_SURFACE) == "True")
-      self.logic.carveHolesInOuterSurfaceDiameter = self.scriptedEffect.doubleParameter(ARG_CARVE_HOLES_IN_OUTER_SURFACE_DIAMETER)
-      self.logic.splitCavities = (self.scriptedEffect.parameter(ARG_SPLIT_CAVITIES) == "True")
-      self.logic.splitCavitiesDiameter = self.scriptedEffect.doubleParameter(ARG_SPLIT_CAVITIES_DIAMETER)
-      self.logic.createShell = (self.scriptedEffect.parameter(ARG_CREATE_SHELL) == "True")
-      self.logic.shellThickness = self.scriptedEffect.doubleParameter(ARG_SHELL_THICKNESS)
-      self.logic.shellOffsetDirection = self.scriptedEffect.parameter(ARG_SHELL_OFFSET_DIRECTION)
-      self.logic.shellPreserveCracks = (self.scriptedEffect.parameter(ARG_SHELL_PRESERVE_CRACKS) == "True")
-      self.logic.outputType = self.scriptedEffect.parameter(ARG_OUTPUT_TYPE)
-      self.logic.outputModelNode = self.scriptedEffect.parameterSetNode().GetNodeReference(ARG_OUTPUT_MODEL_NODE)
-      self.logic.remeshOversampling = self.scriptedEffect.doubleParameter(ARG_REMESH_OVERSAMPLING)
-      self.logic.smoothingFactor = self.scriptedEffect.doubleParameter(ARG_SMOOTHING_FACTOR)
-      self.logic.shrinkwrapIterations = self.scriptedEffect.integerParameter(ARG_SHRINKWRAP_ITERATIONS)
-      self.logic.saveIntermediateResults = (self.scriptedEffect.parameter(ARG_SAVE_INTERMEDIATE_RESULTS) == "True")
+      self.updateLogicInputs()
+      self.saveStateForUndo()
       # Run the algorithm
+      if runInBackground:
+        self.backgroundStatusMessage = None
+        self.backgroundProgress = None
+        self.logic.startWrapSolidify()
+        self.backgroundTimer.start()
+        return
       self.logic.applyWrapSolidify()
-      # Save the output model node (a new model node may have been created in the logic)
-      if self.logic.outputType == OUTPUT_MODEL:
-        self.scriptedEffect.parameterSetNode().SetNodeReferenceID(ARG_OUTPUT_MODEL_NODE,
-          self.logic.outputModelNode.GetID() if self.logic.outputModelNode else "")
-
-      # Restore smoothing factor
-      self.logic.segmentationNode.GetSegmentation().SetConversionParameter(
-        'Smoothing factor',
-        segmentationSmoothingFactor
-      )
-
-      self.logic.segmentationNode.GetSegmentation().CreateRepresentation(
-        'Closed surface',
-         True
-      ) # Last parameter forces conversion even if it exists
-
-      self.logic.segmentationNode.Modified() # Update display
+      self.updateSegmentationAfterApply()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      errorMessage = str(e)
+    if not runInBackground:
+      qt.QApplication.restoreOverrideCursor()
+    self.onApplyFinished(errorMessage)
+
+  def onBackgroundTimer(self):
+    """Update progress of the background computation and write the results when completed"""
+    if self.backgroundStatusMessage is not None:
+      slicer.util.showStatusMessage(self.backgroundStatusMessage)
+      self.backgroundStatusMessage = None
+    if self.backgroundProgress is not None:
+      self.ui.progressBar.value = int(round(self.backgroundProgress * 100))
+      self.backgroundProgress = None
+    self.logic.processPendingIntermediateResults()
+    if self.logic.isWrapSolidifyRunning():
+      return
 
+    self.backgroundTimer.stop()
+    errorMessage = None
+    try:
+      self.logic.finishWrapSolidify()
+      self.updateSegmentationAfterApply()
     except Exception as e:
       import traceback
       traceback.print_exc()
       errorMessage = str(e)
+    self.onApplyFinished(errorMessage)
+
+  def onApplyFinished(self, errorMessage):
     slicer.util.showStatusMessage("")
     self.ui.applyButton.text = 'Apply'
-    qt.QApplication.restoreOverrideCursor()
+    self.ui.undoButton.enabled = self.logic.canUndo()
+    self.ui.estimateButton.enabled = True
+    self.ui.progressBar.visible = False
     if errorMessage:
       slicer.util.errorDisplay("Wrap solidify failed: " + errorMessage)
 
+  def saveStateForUndo(self):
+    """Save state of the segmentation before it is modified by the effect"""
+    self.logic.updateDeferredRepresentations()
+    if self.logic.outputType == OUTPUT_MODEL:
+      # Segments are not modified
+      return
+    if self.scriptedEffect.parameter(ARG_COMPACT_UNDO) == "True":
+      # Only save the segment that will be modified
+      self.logic.saveUndoState()
+    else:
+      self.scriptedEffect.saveStateForUndo()
+
+  def onUndo(self):
+    try:
+      self.logic.undo()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      slicer.util.errorDisplay("Wrap solidify undo failed: " + str(e))
+    self.ui.undoButton.enabled = self.logic.canUndo()
+
+  def updateDeferredRepresentations(self):
+    if not self.logic.hasDeferredRepresentationUpdates():
+      return
+    slicer.util.showStatusMessage("Updating segment representations...")
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    try:
+      self.logic.updateDeferredRepresentations()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      slicer.util.errorDisplay("Wrap solidify failed to update segment representations: " + str(e))
+    qt.QApplication.restoreOverrideCursor()
+    slicer.util.showStatusMessage("")
+
+  def updateLogicInputs(self):
+    """Set logic parameters from the effect parameters"""
+    self.logic.segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
+    self.logic.segmentId = self.scriptedEffect.parameterSetNode().GetSelectedSegmentID()
+    self.logic.region = self.scriptedEffect.parameter(ARG_REGION)
+    self.logic.regionSegmentId = self.scriptedEffect.parameter(ARG_REGION_SEGMENT_ID) if self.scriptedEffect.parameterDefined(ARG_REGION_SEGMENT_ID) else ""
+    self.logic.carveHolesInOuterSurface = (self.scriptedEffect.parameter(ARG_CARVE_HOLES_IN_OUTER_SURFACE) == "True")
+    self.logic.carveHolesInOuterSurfaceDiameter = self.scriptedEffect.doubleParameter(ARG_CARVE_HOLES_IN_OUTER_SURFACE_DIAMETER)
+    self.logic.splitCavities = (self.scriptedEffect.parameter(ARG_SPLIT_CAVITIES) == "True")
+    self.logic.splitCavitiesDiameter = self.scriptedEffect.doubleParameter(ARG_SPLIT_CAVITIES_DIAMETER)
+    self.logic.cavitiesMaxCount = self.scriptedEffect.integerParameter(ARG_CAVITIES_MAX_COUNT)
+    self.logic.cavitiesMinimumVolume = self.scriptedEffect.doubleParameter(ARG_CAVITIES_MINIMUM_VOLUME)
+    self.logic.createShell = (self.scriptedEffect.parameter(ARG_CREATE_SHELL) == "True")
+    self.logic.shellThickness = self.scriptedEffect.doubleParameter(ARG_SHELL_THICKNESS)
+    self.logic.shellOffsetDirection = self.scriptedEffect.parameter(ARG_SHELL_OFFSET_DIRECTION)
+    self.logic.shellPreserveCracks = (self.scriptedEffect.parameter(ARG_SHELL_PRESERVE_CRACKS) == "True")
+    self.logic.outputType = self.scriptedEffect.parameter(ARG_OUTPUT_TYPE)
+    self.logic.outputModelNode = self.scriptedEffect.parameterSetNode().GetNodeReference(ARG_OUTPUT_MODEL_NODE)
+    self.logic.remeshOversampling = self.scriptedEffect.doubleParameter(ARG_REMESH_OVERSAMPLING)
+    self.logic.remeshNarrowBand = (self.scriptedEffect.parameter(ARG_REMESH_NARROW_BAND) == "True")
+    self.logic.remeshAnisotropic = (self.scriptedEffect.parameter(ARG_REMESH_ANISOTROPIC) == "True")
+    self.logic.splitComponents = (self.scriptedEffect.parameter(ARG_SPLIT_COMPONENTS) == "True")
+    self.logic.initialShape = self.scriptedEffect.parameter(ARG_INITIAL_SHAPE)
+    self.logic.warmStart = (self.scriptedEffect.parameter(ARG_WARM_START) == "True")
+    self.logic.isoSurfaceEngine = self.scriptedEffect.parameter(ARG_ISO_SURFACE_ENGINE)
+    self.logic.numberOfThreads = self.scriptedEffect.integerParameter(ARG_NUMBER_OF_THREADS)
+    self.logic.memoryBudgetMB = self.scriptedEffect.doubleParameter(ARG_MEMORY_BUDGET_MB)
+    self.logic.smoothingFactor = self.scriptedEffect.doubleParameter(ARG_SMOOTHING_FACTOR)
+    self.logic.shrinkwrapIterations = self.scriptedEffect.integerParameter(ARG_SHRINKWRAP_ITERATIONS)
+    self.logic.shrinkwrapCoarseToFine = (self.scriptedEffect.parameter(ARG_SHRINKWRAP_COARSE_TO_FINE) == "True")
+    self.logic.shrinkwrapCoarseSpacingFactor = self.scriptedEffect.doubleParameter(ARG_SHRINKWRAP_COARSE_SPACING_FACTOR)
+    self.logic.shrinkwrapStopAtConvergence = (self.scriptedEffect.parameter(ARG_SHRINKWRAP_STOP_AT_CONVERGENCE) == "True")
+    self.logic.shrinkwrapConvergenceTolerance = self.scriptedEffect.doubleParameter(ARG_SHRINKWRAP_CONVERGENCE_TOLERANCE)
+    self.logic.saveIntermediateResults = (self.scriptedEffect.parameter(ARG_SAVE_INTERMEDIATE_RESULTS) == "True")
+    self.logic.stageCacheSizeMB = self.scriptedEffect.doubleParameter(ARG_STAGE_CACHE_SIZE_MB)
+    self.logic.deferRepresentationUpdate = (self.scriptedEffect.parameter(ARG_DEFER_REPRESENTATION_UPDATE) == "True")
+    self.logic.instrumentationFile = slicer.app.userSettings().value("WrapSolidify/InstrumentationFile", "")
+
+  def updateSegmentationAfterApply(self):
+    # Save the output model node (a new model node may have been created in the logic)
+    if self.logic.outputType == OUTPUT_MODEL:
+      self.scriptedEffect.parameterSetNode().SetNodeReferenceID(ARG_OUTPUT_MODEL_NODE,
+        self.logic.outputModelNode.GetID() if self.logic.outputModelNode else "")
+
+    self.logic.segmentationNode.Modified() # Update display
+
+    if self.scriptedEffect.parameter(ARG_TIMING_REPORT) == "True":
+      # Reuse the table node of the previous report
+      tableNode = self.logic.getInstrumentationTableNode(
+        self.scriptedEffect.parameterSetNode().GetNodeReference(ARG_TIMING_REPORT_TABLE_NODE))
+      self.scriptedEffect.parameterSetNode().SetNodeReferenceID(ARG_TIMING_REPORT_TABLE_NODE, tableNode.GetID())
+
+    if self.logic.hasDeferredRepresentationUpdates():
+      # Show the output surface now and create the other representations at the next iteration of the event loop.
+      # Conversion still runs in the main thread (segmentation nodes must not be modified in a background thread),
+      # therefore the application is not responsive during the conversion, but the result is visible while waiting.
+      slicer.util.forceRenderAllViews()
+      qt.QTimer.singleShot(0, self.updateDeferredRepresentations)
+
+    # Save calibrated computation time
+    slicer.app.userSettings().setValue("WrapSolidify/SecondsPerVoxelIteration", str(self.logic.secondsPerVoxelIteration))
+    # Segments and time calibration have changed, the estimate is recomputed on request
+    self.resourceEstimateInput = None
+    self.ui.resourceEstimateLabel.text = ""
 
 class WrapSolidifyLogic(object):
 
+  # Processing stages, in order of execution. Results of each stage are cached.
+  STAGES = ['shrinkWrap', 'cavity', 'smoothing', 'shell']
+
   def __init__(self):
     self.logCallback = None
+    self.progressCallback = None
     self.cancelRequested = False
 
     # Inputs
@@ -294,6 +517,8 @@ class WrapSolidifyLogic(object):
     self.carveHolesInOuterSurfaceDiameter = ARG_DEFAULTS[ARG_CARVE_HOLES_IN_OUTER_SURFACE_DIAMETER]
     self.splitCavities = ARG_DEFAULTS[ARG_SPLIT_CAVITIES]
     self.splitCavitiesDiameter = ARG_DEFAULTS[ARG_SPLIT_CAVITIES_DIAMETER]
+    self.cavitiesMaxCount = ARG_DEFAULTS[ARG_CAVITIES_MAX_COUNT]
+    self.cavitiesMinimumVolume = ARG_DEFAULTS[ARG_CAVITIES_MINIMUM_VOLUME]
     self.createShell = ARG_DEFAULTS[ARG_CREATE_SHELL]
     self.shellThickness = ARG_DEFAULTS[ARG_SHELL_THICKNESS]
     self.shellOffsetDirection = ARG_DEFAULTS[ARG_SHELL_OFFSET_DIRECTION]
@@ -301,99 +526,766 @@ class WrapSolidifyLogic(object):
     self.outputType = ARG_DEFAULTS[ARG_OUTPUT_TYPE]
     self.outputModelNode = None
     self.remeshOversampling = ARG_DEFAULTS[ARG_REMESH_OVERSAMPLING]
+    self.remeshNarrowBand = ARG_DEFAULTS[ARG_REMESH_NARROW_BAND]
+    self.remeshAnisotropic = ARG_DEFAULTS[ARG_REMESH_ANISOTROPIC]
+    self.splitComponents = ARG_DEFAULTS[ARG_SPLIT_COMPONENTS]
+    self.initialShape = ARG_DEFAULTS[ARG_INITIAL_SHAPE]
+    self.warmStart = ARG_DEFAULTS[ARG_WARM_START]
+    self.isoSurfaceEngine = ARG_DEFAULTS[ARG_ISO_SURFACE_ENGINE]
+    self.numberOfThreads = ARG_DEFAULTS[ARG_NUMBER_OF_THREADS]
+    self.memoryBudgetMB = ARG_DEFAULTS[ARG_MEMORY_BUDGET_MB]
     self.smoothingFactor = ARG_DEFAULTS[ARG_SMOOTHING_FACTOR]
     self.shrinkwrapIterations = ARG_DEFAULTS[ARG_SHRINKWRAP_ITERATIONS]
+    self.shrinkwrapCoarseToFine = ARG_DEFAULTS[ARG_SHRINKWRAP_COARSE_TO_FINE]
+    self.shrinkwrapCoarseSpacingFactor = ARG_DEFAULTS[ARG_SHRINKWRAP_COARSE_SPACING_FACTOR]
+    self.shrinkwrapStopAtConvergence = ARG_DEFAULTS[ARG_SHRINKWRAP_STOP_AT_CONVERGENCE]
+    self.shrinkwrapConvergenceTolerance = ARG_DEFAULTS[ARG_SHRINKWRAP_CONVERGENCE_TOLERANCE]
     self.saveIntermediateResults = ARG_DEFAULTS[ARG_SAVE_INTERMEDIATE_RESULTS]
+    self.stageCacheSizeMB = ARG_DEFAULTS[ARG_STAGE_CACHE_SIZE_MB]
+    self.deferRepresentationUpdate = ARG_DEFAULTS[ARG_DEFER_REPRESENTATION_UPDATE]
+    # If not empty then the instrumentation report of each run is appended to this file (one JSON object per line)
+    self.instrumentationFile = ""
+
+    # Results of processing stages, kept between runs
+    self._stageCache = WrapSolidifyStageCache()
+
+    # Input labelmap and shrinkwrap result labelmap of the previous run (on the same grid), kept between runs
+    # for warm start. Dictionary with 'key', 'inputLabelmap', 'shrinkWrapLabelmap' items.
+    self._warmStartState = None
+
+    # Compact undo: snapshots of segments before they were modified by apply (most recent last)
+    self.maximumNumberOfUndoSnapshots = 10
+    self._undoSnapshots = []
+    self._pendingUndoSnapshot = None
+
+    # Output segments that only contain the output surface yet: list of (segmentationNode, segmentIds, representationNames)
+    self._deferredRepresentationUpdates = []
+
+    # Time, memory usage, and data size of each processing step of the last run (see getInstrumentationReport)
+    self._instrumentationRecords = []
+    self._instrumentationStartTime = 0.0
+    self._instrumentationTotalTime = None
+    self._instrumentationMemoryInterval = None
+    self._instrumentationMemoryUsageMB = (None, None)  # resident memory size at start and peak during the last run
+    self._memoryMonitor = WrapSolidifyMemoryMonitor()
+
+    # Computation time per voxel per shrinkwrap iteration, used for estimating computation time.
+    # It is updated after each complete run.
+    self.secondsPerVoxelIteration = 3e-7
 
     # Temporary variables
     self._inputPd = None
     self._inputSpacing = None
+    self._inputSpacingAspect = 1.0
+    self._regionSegmentPd = None
+    self._inputDistanceMap = None
+    self._inputDistanceMapMargin = 0
+    self._progressStep = 0
+    self._numberOfProgressSteps = 0
+    # Logic that started this logic for processing a part of its input (used for checking cancel requests)
+    self._parentLogic = None
+    # Number of SMP threads before the computation changed it
+    self._previousNumberOfSmpThreads = None
+
+    # Background processing
+    self._backgroundThread = None
+    self._backgroundOutputPd = None
+    self._backgroundException = None
+    self._pendingIntermediateResults = []
+    self._pendingIntermediateResultsLock = threading.Lock()
 
   def requestCancel(self):
     logging.info("User requested cancelling.")
     self.cancelRequested = True
 
   def _log(self, message):
+    """Report start of a processing step"""
     if self.logCallback:
       self.logCallback(message)
+    if self._numberOfProgressSteps:
+      self._setProgress(float(self._progressStep) / self._numberOfProgressSteps)
+      self._progressStep += 1
+
+  def _setProgress(self, progress):
+    if self.progressCallback:
+      self.progressCallback(min(progress, 1.0))
+
+  def _getNumberOfProgressSteps(self):
+    """Get number of processing steps (calls of _log) during computation"""
+    numberOfSteps = 2  # get input, create starting region
+    numberOfSteps += 2 * self.shrinkwrapIterations
+    if self.splitComponents and self.region != REGION_SEGMENT:
+      numberOfSteps += 1  # split input into components
+    if self.region in CAVITY_REGIONS:
+      numberOfSteps += 1
+    numberOfSteps += self._getEstimatedNumberOfOutputs() * self._getNumberOfProgressStepsPerOutput()
+    return numberOfSteps
+
+  def _getEstimatedNumberOfOutputs(self):
+    """Each cavity is processed separately. The number of cavities is not known in advance,
+    the progress is updated when it is known (see _extractCavities)."""
+    return max(self.cavitiesMaxCount, 1) if self.region == REGION_CAVITIES else 1
+
+  def _getNumberOfProgressStepsPerOutput(self):
+    numberOfSteps = 0
+    if self.region in CAVITY_REGIONS and self.splitCavities:
+      numberOfSteps += 2 * self.shrinkwrapIterations
+    if self.isoSurfaceEngine != ISO_SURFACE_ENGINE_SURFACE_NETS:
+      numberOfSteps += 1  # smoothing
+    if self.createShell:
+      if self.shellPreserveCracks:
+        numberOfSteps += 1
+      if self.shellThickness > 1e-6:
+        numberOfSteps += 1
+    return numberOfSteps
 
   def _checkCancelRequested(self):
-    if self.cancelRequested:
+    if self.cancelRequested or (self._parentLogic and self._parentLogic.cancelRequested):
       self.checkCancelRequested = False
       raise ValueError("Cancel requested")
 
+  def setParameters(self, parameters):
+    """Set inputs from a dictionary. Keys are names of the input attributes of this class
+    (for example 'region', 'shellThickness', 'remeshOversampling').
+    """
+    for name, value in parameters.items():
+      if name.startswith('_') or not hasattr(self, name) or callable(getattr(self, name)):
+        raise ValueError("Unknown parameter: " + name)
+      setattr(self, name, value)
+
   def applyWrapSolidify(self):
     """Applies the Shrinkwrap-Raycast-Shrinkwrap Filter, a surface filter, to the selected passed segment.
     """
+    outputPd = self._computeWrapSolidify()
+    self._log('Save result...')
+    with self._instrumentStage('output', outputPd if not isinstance(outputPd, list) else None):
+      self._writeOutput(outputPd)
+    self._finishInstrumentation()
+
+  def computeWrapSolidify(self):
+    """Computes the filtered surface of the selected segment and returns it as polydata.
+    The segmentation is not modified and no nodes are created (unless saving of intermediate results is enabled),
+    therefore it can be used for processing without graphical user interface.
+    If region is cavities then a list of polydata is returned (one for each cavity, largest first).
+    """
+    outputPd = self._computeWrapSolidify()
+    self._finishInstrumentation()
+    return outputPd
+
+  def _computeWrapSolidify(self):
+    try:
+      self._startComputation()
+      outputPd = self._computeOutputPd()
+      self._setProgress(1.0)
+      return outputPd
+    finally:
+      self._cleanup()
+
+  def startWrapSolidify(self):
+    """Starts computation in a background thread.
+    Input data is read from the segmentation node in the calling thread. When isWrapSolidifyRunning()
+    returns False, finishWrapSolidify() must be called (in the main thread) to write the output.
+    processPendingIntermediateResults() may be called in the main thread while computation is in progress
+    to show intermediate results.
+    """
+    try:
+      self._startComputation()
+    except:
+      self._cleanup()
+      raise
+    self._backgroundOutputPd = None
+    self._backgroundException = None
+    self._backgroundThread = threading.Thread(target=self._computeOutputPdInBackground)
+    self._backgroundThread.start()
+
+  def isWrapSolidifyRunning(self):
+    return self._backgroundThread is not None and self._backgroundThread.is_alive()
+
+  def finishWrapSolidify(self, writeOutput=True):
+    """Waits for completion of the background computation and writes the output to the target node"""
+    try:
+      self._backgroundThread.join()
+      self._backgroundThread = None
+      self.processPendingIntermediateResults()
+      if self._backgroundException:
+        raise self._backgroundException
+      if writeOutput:
+        self._log('Save result...')
+        outputPd = self._backgroundOutputPd
+        with self._instrumentStage('output', outputPd if not isinstance(outputPd, list) else None):
+          self._writeOutput(outputPd)
+        self._finishInstrumentation()
+    finally:
+      self._backgroundOutputPd = None
+      self._backgroundException = None
+      self._cleanup()
+
+  def _computeOutputPdInBackground(self):
+    try:
+      self._backgroundOutputPd = self._computeOutputPd()
+      self._setProgress(1.0)
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self._backgroundException = e
+
+  def _startComputation(self):
+    """Reset processing state and get input data from the segmentation node"""
     self.cancelRequested = False
 
     self.intermediateResultCounter = 0
     self.previousIntermediateResult = None
 
-    try:
-      self._log('Get input data...')
-      self._updateInputPd()
+    self._progressStep = 0
+    self._numberOfProgressSteps = self._getNumberOfProgressSteps()
+
+    if self.numberOfThreads > 0:
+      # Limit number of threads used by multi-threaded (SMP) VTK filters.
+      # This is a process-wide setting, therefore the previous value is restored in _cleanup.
+      self._previousNumberOfSmpThreads = vtk.vtkSMPTools.GetEstimatedNumberOfThreads()
+      vtk.vtkSMPTools.Initialize(self.numberOfThreads)
+
+    # The input segment may be the output of a previous run
+    self.updateDeferredRepresentations()
+
+    self._startInstrumentation()
+    self._log('Get input data...')
+    with self._instrumentStage('input') as record:
+      self._updateInputPd(record)
+      WrapSolidifyLogic._setStageOutput(record, self._inputPd)
+
+  def _computeOutputPd(self):
+    startTime = time.time()
+
+    # Reuse result of the last stage that has not been affected by parameter changes
+    self._stageCache.maxMemorySizeMB = self.stageCacheSizeMB
+    stageKeys = self._getStageKeys()
+    if self.region == REGION_CAVITIES:
+      return self._computeCavitiesOutputPds(stageKeys)
+
+    shrunkenPd = vtk.vtkPolyData()
+    firstStageIndex = 0
+    for stageIndex in reversed(range(len(WrapSolidifyLogic.STAGES))):
+      stageName = WrapSolidifyLogic.STAGES[stageIndex]
+      if self._stageCache.get(stageKeys[stageName], shrunkenPd):
+        logging.info("Wrap solidify: reuse cached result of stage {0}".format(stageName))
+        firstStageIndex = stageIndex + 1
+        break
+
+    for stageName in WrapSolidifyLogic.STAGES[firstStageIndex:]:
+      self._computeStage(stageName, shrunkenPd)
+      self._stageCache.add(stageKeys[stageName], shrunkenPd)
+
+    if firstStageIndex == 0:
+      # Calibrate computation time estimate
+      bounds = np.zeros(6)
+      self._inputPd.GetBounds(bounds)
+      numberOfVoxelIterations = self._getNumberOfVoxelIterations(bounds, self._inputSpacing)
+      if numberOfVoxelIterations > 0:
+        self.secondsPerVoxelIteration = (time.time() - startTime) / numberOfVoxelIterations
 
-      self._log('Create starting region...')
-      regionPd = self._getInitialRegionPd()
+    return shrunkenPd
 
-      shrunkenPd = vtk.vtkPolyData()
+  def _computeCavitiesOutputPds(self, stageKeys):
+    """Compute a separate output for each of the largest cavities. Returns a list of polydata, largest cavity first.
+    The outer surface shrinkwrap is shared by all cavities, only its result is cached.
+    """
+    shrunkenPd = vtk.vtkPolyData()
+    if self._stageCache.get(stageKeys['shrinkWrap'], shrunkenPd):
+      logging.info("Wrap solidify: reuse cached result of stage shrinkWrap")
+    else:
+      self._computeStage('shrinkWrap', shrunkenPd)
+      self._stageCache.add(stageKeys['shrinkWrap'], shrunkenPd)
+
+    self._log('Extract cavities...')
+    with self._instrumentStage('cavities', shrunkenPd) as record:
+      cavityPds = self._extractCavities(shrunkenPd)
+      record['outputPoints'] = sum(cavityPd.GetNumberOfPoints() for cavityPd in cavityPds)
+      record['outputCells'] = sum(cavityPd.GetNumberOfCells() for cavityPd in cavityPds)
+    for cavityPd in cavityPds:
+      for stageName in ['smoothing', 'shell']:
+        self._computeStage(stageName, cavityPd)
+    return cavityPds
+
+  def _computeStage(self, stageName, shrunkenPd):
+    """Compute output of a processing stage. Result is stored in shrunkenPd,
+    which contains output of the previous stage (empty for the first stage).
+    """
+    if stageName == 'shrinkWrap':
+      # Warm start is not used when the input is split into components
+      if self.warmStart and self.region != REGION_SEGMENT and not self.splitComponents:
+        with self._instrumentStage('warmStart', self._inputPd) as record:
+          shrunkenPd.DeepCopy(self._shrinkWrapWarmStart())
+          WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
+        return
+      if self.splitComponents and self.region != REGION_SEGMENT:
+        self._log('Split input into components...')
+        componentPds = self._getInputComponentPds()
+        if len(componentPds) > 1:
+          with self._instrumentStage('splitComponents', self._inputPd) as record:
+            shrunkenPd.DeepCopy(self._shrinkWrapComponents(componentPds))
+            WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
+          return
+      self._log('Create starting region...')
+      with self._instrumentStage('initialRegion') as record:
+        regionPd = self._getInitialRegionPd()
+        WrapSolidifyLogic._setStageOutput(record, regionPd)
       shrunkenPd.DeepCopy(self._shrinkWrap(regionPd))
 
+    elif stageName == 'cavity':
       if self.region == REGION_LARGEST_CAVITY:
         self._log('Extract largest cavity...')
-        shrunkenPd.DeepCopy(self._extractCavity(shrunkenPd))
-
+        with self._instrumentStage('cavity', shrunkenPd) as record:
+          shrunkenPd.DeepCopy(self._extractCavity(shrunkenPd))
+          WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
+
+    elif stageName == 'smoothing':
+      if self.isoSurfaceEngine == ISO_SURFACE_ENGINE_SURFACE_NETS:
+        # Surface nets output is already smoothed during surface extraction, using smoothingFactor
+        return
       self._log('Smoothing...')
-      shrunkenPd.DeepCopy(WrapSolidifyLogic._smoothPolydata(shrunkenPd, self.smoothingFactor))
+      with self._instrumentStage('smoothing', shrunkenPd) as record:
+        shrunkenPd.DeepCopy(WrapSolidifyLogic._smoothPolydata(shrunkenPd, self.smoothingFactor))
+        WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
       self._saveIntermediateResult("Smoothed", shrunkenPd)
 
-      # Create shell
+    elif stageName == 'shell':
       if self.createShell:
         if self.shellPreserveCracks:
           self._checkCancelRequested()
           self._log('Shell - preserving cracks...')
-          shrunkenPd.DeepCopy(self._shellPreserveCracks(shrunkenPd))
+          with self._instrumentStage('preserveCracks', shrunkenPd) as record:
+            shrunkenPd.DeepCopy(self._shellPreserveCracks(shrunkenPd))
+            WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
           self._saveIntermediateResult("ShellRemovedCaps", shrunkenPd)
         if self.shellThickness > 1e-6:
           self._checkCancelRequested()
           self._log('Shell - solidifying...')
-          shrunkenPd.DeepCopy(self._shellSolidify(shrunkenPd, self.shellThickness, self.shellOffsetDirection))
+          with self._instrumentStage('solidify', shrunkenPd) as record:
+            shrunkenPd.DeepCopy(self._shellSolidify(shrunkenPd, self.shellThickness, self.shellOffsetDirection))
+            WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
           self._saveIntermediateResult("ShellSolidified", shrunkenPd)
 
-      # Write output to target node
-      self._log('Save result...')
-      baseSegmentId = self.regionSegmentId if self.region == REGION_SEGMENT else self.segmentId
-      if self.outputType == OUTPUT_SEGMENT:
-        WrapSolidifyLogic._polydataToSegment(shrunkenPd, self.segmentationNode, baseSegmentId)
-      elif self.outputType == OUTPUT_NEW_SEGMENT:
-        WrapSolidifyLogic._polydataToNewSegment(shrunkenPd, self.segmentationNode, baseSegmentId)
-      elif self.outputType == OUTPUT_MODEL:
-        segment = self.segmentationNode.GetSegmentation().GetSegment(baseSegmentId)
-        name = segment.GetName()
-        color = segment.GetColor()
-        if not self.outputModelNode:
-          self.outputModelNode = slicer.modules.models.logic().AddModel(shrunkenPd)
-          self.outputModelNode.SetName(name)
-          self.outputModelNode.GetDisplayNode().SliceIntersectionVisibilityOn()
-        else:
-          self.outputModelNode.SetAndObservePolyData(shrunkenPd)
-        self.outputModelNode.CreateDefaultDisplayNodes()
-        self.outputModelNode.GetDisplayNode().SetColor(color)
+    else:
+      raise ValueError("Unknown stage: " + stageName)
+
+  def _getStageKeys(self):
+    """Get cache keys for each processing stage. Each key contains the input content hash
+    and all the parameters that the stage and the previous stages depend on.
+    """
+    keys = {}
+    key = (WrapSolidifyLogic._getPolyDataHash(self._inputPd), self._inputSpacing, self.remeshAnisotropic, self.region)
+    if self.isoSurfaceEngine == ISO_SURFACE_ENGINE_SURFACE_NETS:
+      # Surface nets smoothing is applied at each surface extraction
+      key += (self.smoothingFactor,)
+    if self.region == REGION_SEGMENT:
+      key += (WrapSolidifyLogic._getPolyDataHash(self._regionSegmentPd),)
+    else:
+      if self.carveHolesInOuterSurface:
+        key += (self.carveHolesInOuterSurfaceDiameter,)
       else:
-        raise ValueError('Unknown output type: '+self.outputType)
+        key += (self.initialShape,)
+      key += (self.splitComponents, self.warmStart and not self.splitComponents)
+    # remeshNarrowBand is not included because it does not change the result
+    key += (self.remeshOversampling, self.isoSurfaceEngine, self.shrinkwrapIterations, self.shrinkwrapCoarseToFine,
+      self.shrinkwrapCoarseSpacingFactor if self.shrinkwrapCoarseToFine else None, self.shrinkwrapStopAtConvergence,
+      self.shrinkwrapConvergenceTolerance if self.shrinkwrapStopAtConvergence else None)
+    keys['shrinkWrap'] = ('shrinkWrap',) + key
+    if self.region in CAVITY_REGIONS:
+      key += (self.splitCavities, self.splitCavitiesDiameter if self.splitCavities else None)
+    keys['cavity'] = ('cavity',) + key
+    key += (self.smoothingFactor,)
+    keys['smoothing'] = ('smoothing',) + key
+    if self.createShell:
+      key += (self.shellThickness, self.shellOffsetDirection, self.shellPreserveCracks)
+    keys['shell'] = ('shell',) + key
+    return keys
 
+  @staticmethod
+  def _getPolyDataHash(polydata):
+    """Get a hash of point coordinates and cells of a polydata"""
+    contentHash = hashlib.sha1()
+    if polydata.GetPoints():
+      contentHash.update(numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()).tobytes())
+    for cellArray in [polydata.GetVerts(), polydata.GetLines(), polydata.GetPolys(), polydata.GetStrips()]:
+      offsets, connectivity = WrapSolidifyLogic._cellArrayToNumpy(cellArray)
+      contentHash.update(offsets.tobytes())
+      contentHash.update(connectivity.tobytes())
+    return contentHash.hexdigest()
+
+  def clearStageCache(self):
+    self._stageCache.clear()
+
+  def _startInstrumentation(self):
+    # A new list is created (instead of clearing it) because copies of this logic that process parts of the input
+    # (see _shrinkWrapComponents) add their records to the list of the current run
+    self._instrumentationRecords = []
+    self._instrumentationStartTime = time.time()
+    self._instrumentationTotalTime = None
+    if self._instrumentationMemoryInterval is not None:
+      # Previous run was not finished
+      self._memoryMonitor.stop(self._instrumentationMemoryInterval)
+    self._instrumentationMemoryInterval = self._memoryMonitor.start()
+    self._instrumentationMemoryUsageMB = (None, None)
+
+  def _finishInstrumentation(self):
+    """Complete the instrumentation report of the current run and append it to the instrumentation file"""
+    self._instrumentationTotalTime = time.time() - self._instrumentationStartTime
+    if self._instrumentationMemoryInterval is not None:
+      self._instrumentationMemoryUsageMB = self._memoryMonitor.stop(self._instrumentationMemoryInterval)
+      self._instrumentationMemoryInterval = None
+    if not self.instrumentationFile:
+      return
+    try:
+      with open(self.instrumentationFile, 'a') as file:
+        file.write(json.dumps(self.getInstrumentationReport()) + '\n')
+    except (IOError, OSError) as e:
+      logging.warning("Wrap solidify: failed to write instrumentation report to {0}: {1}".format(self.instrumentationFile, e))
+
+  @contextlib.contextmanager
+  def _instrumentStage(self, stageName, inputPd=None):
+    """Measure wall time and peak memory usage of a processing step and add it to the instrumentation report
+    (see WrapSolidifyMemoryMonitor for accuracy of memory usage on different platforms). Additional information (voxel count of the labelmap, number of output points and cells) can be stored
+    in the yielded record dictionary.
+    """
+    record = {'stage': stageName}
+    if inputPd is not None:
+      record['inputPoints'] = inputPd.GetNumberOfPoints()
+      record['inputCells'] = inputPd.GetNumberOfCells()
+    memoryInterval = self._memoryMonitor.start()
+    startTime = time.time()
+    try:
+      yield record
     finally:
-      self._cleanup()
+      record['startTimeSec'] = startTime - self._instrumentationStartTime
+      record['timeSec'] = time.time() - startTime
+      WrapSolidifyLogic._setMemoryUsage(record, *self._memoryMonitor.stop(memoryInterval))
+      self._instrumentationRecords.append(record)
 
+  @staticmethod
+  def _setStageOutput(record, polydata):
+    record['outputPoints'] = polydata.GetNumberOfPoints()
+    record['outputCells'] = polydata.GetNumberOfCells()
+
+  @staticmethod
+  def _setMemoryUsage(record, startMemoryUsageMB, peakMemoryUsageMB):
+    """Store peak resident memory size of the process during a step and its increase compared to the start of the step
+    (None if memory usage cannot be measured on this platform)"""
+    record['peakMemoryMB'] = peakMemoryUsageMB
+    record['peakMemoryIncreaseMB'] = (peakMemoryUsageMB - startMemoryUsageMB
+      if peakMemoryUsageMB is not None and startMemoryUsageMB is not None else None)
+
+  def getInstrumentationReport(self):
+    """Get wall time, peak memory usage (and its increase), labelmap voxel count, and input and output point and cell counts
+    of each processing step of the last run as a dictionary. Steps are listed in order of their start time
+    (nested steps, such as shrinkwrap iterations of cavity extraction, are listed after their parent step).
+    """
+    parameters = {name: value for name, value in vars(self).items()
+      if not name.startswith('_') and (value is None or isinstance(value, (bool, int, float, str)))}
+    report = {
+      'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._instrumentationStartTime)),
+      'segmentId': self.segmentId,
+      'parameters': parameters,
+      'totalTimeSec': self._instrumentationTotalTime,
+      'stages': sorted(self._instrumentationRecords, key=lambda record: record['startTimeSec']),
+      }
+    WrapSolidifyLogic._setMemoryUsage(report, *self._instrumentationMemoryUsageMB)
+    return report
+
+  def getInstrumentationTableNode(self, tableNode=None):
+    """Write the instrumentation report of the last run into a table node (one row for each processing step).
+    A new table node is created if tableNode is not specified. Returns the table node.
+    """
+    report = self.getInstrumentationReport()
+    if not tableNode:
+      tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', slicer.mrmlScene.GenerateUniqueName('WrapSolidifyTimings'))
+    totalRecord = {'stage': 'total', 'startTimeSec': 0.0, 'timeSec': report['totalTimeSec'],
+      'peakMemoryMB': report['peakMemoryMB'], 'peakMemoryIncreaseMB': report['peakMemoryIncreaseMB']}
+    records = report['stages'] + [totalRecord]
+    columns = [('stage', 'Stage'), ('startTimeSec', 'Start (s)'), ('timeSec', 'Time (s)'),
+      ('peakMemoryMB', 'Peak memory (MB)'), ('peakMemoryIncreaseMB', 'Peak memory increase (MB)'), ('voxels', 'Voxels'),
+      ('inputPoints', 'Input points'), ('inputCells', 'Input cells'), ('outputPoints', 'Output points'), ('outputCells', 'Output cells')]
+    table = vtk.vtkTable()
+    for key, title in columns:
+      array = vtk.vtkStringArray() if key == 'stage' else vtk.vtkDoubleArray()
+      array.SetName(title)
+      for record in records:
+        value = record.get(key)
+        if key == 'stage':
+          array.InsertNextValue(value)
+        else:
+          # Not applicable or not available values are left empty
+          array.InsertNextValue(float('nan') if value is None else value)
+      table.AddColumn(array)
+    tableNode.SetAndObserveTable(table)
+    return tableNode
+
+  def _writeOutput(self, shrunkenPd):
+    """Write output to target node"""
+    baseSegmentId = self.regionSegmentId if self.region == REGION_SEGMENT else self.segmentId
+    representationNames = []
+    self.segmentationNode.GetSegmentation().GetContainedRepresentationNames(representationNames)
+    if isinstance(shrunkenPd, list):
+      # Multiple cavities: each cavity is written into a new segment, or all of them into the output model
+      if self.outputType == OUTPUT_SEGMENT or self.outputType == OUTPUT_NEW_SEGMENT:
+        addedSegmentIds = []
+        for cavityIndex, cavityPd in enumerate(shrunkenPd):
+          addedSegmentIds.append(WrapSolidifyLogic._polydataToNewSegment(cavityPd, self.segmentationNode, baseSegmentId,
+            "_cavity{0}".format(cavityIndex+1)))
+        self._updateOutputSegmentRepresentationsOrDefer(addedSegmentIds, representationNames)
+        self._finishUndoState(addedSegmentIds)
+        return
+      appendFilter = vtk.vtkAppendPolyData()
+      for cavityPd in shrunkenPd:
+        appendFilter.AddInputData(cavityPd)
+      appendFilter.Update()
+      shrunkenPd = appendFilter.GetOutput()
+    if self.outputType == OUTPUT_SEGMENT:
+      WrapSolidifyLogic._polydataToSegment(shrunkenPd, self.segmentationNode, baseSegmentId, updateRepresentations=False)
+      self._updateOutputSegmentRepresentationsOrDefer([baseSegmentId], representationNames)
+      self._finishUndoState()
+    elif self.outputType == OUTPUT_NEW_SEGMENT:
+      addedSegmentId = WrapSolidifyLogic._polydataToNewSegment(shrunkenPd, self.segmentationNode, baseSegmentId)
+      self._updateOutputSegmentRepresentationsOrDefer([addedSegmentId], representationNames)
+      self._finishUndoState([addedSegmentId])
+    elif self.outputType == OUTPUT_MODEL:
+      segment = self.segmentationNode.GetSegmentation().GetSegment(baseSegmentId)
+      name = segment.GetName()
+      color = segment.GetColor()
+      if not self.outputModelNode:
+        self.outputModelNode = slicer.modules.models.logic().AddModel(shrunkenPd)
+        self.outputModelNode.SetName(name)
+        self.outputModelNode.GetDisplayNode().SliceIntersectionVisibilityOn()
+      else:
+        self.outputModelNode.SetAndObservePolyData(shrunkenPd)
+      self.outputModelNode.CreateDefaultDisplayNodes()
+      self.outputModelNode.GetDisplayNode().SetColor(color)
+    else:
+      raise ValueError('Unknown output type: '+self.outputType)
+
+  def _updateOutputSegmentRepresentationsOrDefer(self, segmentIds, representationNames):
+    if not self.deferRepresentationUpdate:
+      WrapSolidifyLogic._updateOutputSegmentRepresentations(self.segmentationNode, segmentIds, representationNames)
+      return
+    # Segments only contain the output surface until updateDeferredRepresentations() is called
+    self._deferredRepresentationUpdates.append((self.segmentationNode, segmentIds, representationNames))
+
+  def hasDeferredRepresentationUpdates(self):
+    return len(self._deferredRepresentationUpdates) > 0
+
+  def updateDeferredRepresentations(self):
+    """Create the source representation and other representations of output segments
+    that were written with deferred representation update"""
+    deferredRepresentationUpdates = self._deferredRepresentationUpdates
+    self._deferredRepresentationUpdates = []
+    for segmentationNode, segmentIds, representationNames in deferredRepresentationUpdates:
+      segmentation = segmentationNode.GetSegmentation()
+      # Segments may have been removed in the meantime
+      segmentIds = [segmentId for segmentId in segmentIds if segmentation.GetSegment(segmentId)]
+      WrapSolidifyLogic._updateOutputSegmentRepresentations(segmentationNode, segmentIds, representationNames)
+    self._updateUndoSnapshotOutputHashes()
+
+  @staticmethod
+  def _updateOutputSegmentRepresentations(segmentationNode, segmentIds, representationNames):
+    """Make output segments contain the specified representations, converted from the source representation
+    using the conversion parameters of the segmentation. Other segments are not converted.
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    try:
+      masterRepresentationName = segmentation.GetSourceRepresentationName()
+    except:
+      # Legacy (Slicer-5.3 and earlier)
+      masterRepresentationName = segmentation.GetMasterRepresentationName()
+    wasModified = segmentationNode.StartModify()
+    for segmentId in segmentIds:
+      segment = segmentation.GetSegment(segmentId)
+      if not segment.GetRepresentation(masterRepresentationName):
+        segmentation.ConvertSingleSegment(segmentId, masterRepresentationName)
+      # Remove representations that were not converted from the current source representation
+      # (for example, the output surface when the source representation is binary labelmap)
+      segmentRepresentationNames = []
+      segment.GetContainedRepresentationNames(segmentRepresentationNames)
+      for representationName in segmentRepresentationNames:
+        if representationName != masterRepresentationName:
+          segment.RemoveRepresentation(representationName)
+      for representationName in representationNames:
+        if representationName != masterRepresentationName:
+          segmentation.ConvertSingleSegment(segmentId, representationName)
+    segmentationNode.EndModify(wasModified)
+
+  def saveUndoState(self):
+    """Save the segment that the next apply will overwrite (compact alternative to saving the whole segmentation).
+    The snapshot becomes available for undo() when the output is written.
+    """
+    self.updateDeferredRepresentations()
+    snapshot = {'segmentationNode': self.segmentationNode, 'modifiedSegments': {}, 'addedSegmentIds': []}
+    if self.outputType == OUTPUT_SEGMENT and self.region != REGION_CAVITIES:
+      segmentId = self.regionSegmentId if self.region == REGION_SEGMENT else self.segmentId
+      snapshot['modifiedSegments'][segmentId] = WrapSolidifyLogic._getSegmentSnapshot(self.segmentationNode, segmentId)
+    self._pendingUndoSnapshot = snapshot
+
+  def _finishUndoState(self, addedSegmentIds=None):
+    """Make the pending undo snapshot available, after the output is written"""
+    snapshot = self._pendingUndoSnapshot
+    self._pendingUndoSnapshot = None
+    if not snapshot or snapshot['segmentationNode'] != self.segmentationNode:
+      return
+    snapshot['addedSegmentIds'] = addedSegmentIds or []
+    # Content of the output segments is stored when their source representation is available
+    # (after deferred representation update), to detect if they are modified later by something else
+    snapshot['outputHashes'] = None
+    self._undoSnapshots.append(snapshot)
+    del self._undoSnapshots[:-self.maximumNumberOfUndoSnapshots]
+    if not self.hasDeferredRepresentationUpdates():
+      self._updateUndoSnapshotOutputHashes()
+
+  def _updateUndoSnapshotOutputHashes(self):
+    for snapshot in self._undoSnapshots:
+      if snapshot['outputHashes'] is None:
+        snapshot['outputHashes'] = WrapSolidifyLogic._getSegmentHashes(snapshot['segmentationNode'],
+          list(snapshot['modifiedSegments'].keys()) + snapshot['addedSegmentIds'])
+
+  def canUndo(self):
+    return len(self._undoSnapshots) > 0
+
+  def undo(self):
+    """Restore segments to the state before the last apply.
+    Undo is refused (and all snapshots are discarded) if the output segments have been modified since then
+    (for example, by painting or by the undo of the segment editor), because restoring the snapshot would lose those changes.
+    """
+    if not self._undoSnapshots:
+      raise ValueError("There is nothing to undo")
+    self.updateDeferredRepresentations()
+    snapshot = self._undoSnapshots.pop()
+    segmentationNode = snapshot['segmentationNode']
+    outputHashes = snapshot['outputHashes']
+    if outputHashes != WrapSolidifyLogic._getSegmentHashes(segmentationNode, list(outputHashes.keys())):
+      self._undoSnapshots = []
+      raise ValueError("Output segments have been modified since the last apply, they cannot be restored")
+    segmentation = segmentationNode.GetSegmentation()
+    for segmentId in snapshot['addedSegmentIds']:
+      if segmentation.GetSegment(segmentId):
+        segmentation.RemoveSegment(segmentId)
+    for segmentId, segmentSnapshot in snapshot['modifiedSegments'].items():
+      if segmentation.GetSegment(segmentId):
+        WrapSolidifyLogic._restoreSegmentSnapshot(segmentationNode, segmentId, segmentSnapshot)
+    # Restored segments are in the state that the previous apply created, but the restored representation
+    # may not be bitwise identical to it (for example, the labelmap extent may differ), therefore their hash is updated
+    restoredSegmentIds = list(snapshot['modifiedSegments'].keys())
+    restoredSegmentHashes = WrapSolidifyLogic._getSegmentHashes(segmentationNode, restoredSegmentIds)
+    for previousSnapshot in self._undoSnapshots:
+      if previousSnapshot['segmentationNode'] != segmentationNode or previousSnapshot['outputHashes'] is None:
+        continue
+      for segmentId in restoredSegmentIds:
+        if segmentId in previousSnapshot['outputHashes']:
+          previousSnapshot['outputHashes'][segmentId] = restoredSegmentHashes[segmentId]
+
+  @staticmethod
+  def _getSegmentHashes(segmentationNode, segmentIds):
+    """Get a hash of the source representation of each segment (None if the segment does not exist)"""
+    segmentation = segmentationNode.GetSegmentation()
+    segmentHashes = {}
+    for segmentId in segmentIds:
+      if not segmentation.GetSegment(segmentId):
+        segmentHashes[segmentId] = None
+        continue
+      segmentSnapshot = WrapSolidifyLogic._getSegmentSnapshot(segmentationNode, segmentId, compress=False)
+      contentHash = hashlib.sha1()
+      for key in sorted(segmentSnapshot.keys()):
+        content = segmentSnapshot[key]
+        if key == 'polydata' and content is not None:
+          for array in content:
+            contentHash.update(array)
+        elif isinstance(content, bytes):
+          contentHash.update(content)
+        else:
+          contentHash.update(repr(content).encode())
+      segmentHashes[segmentId] = contentHash.hexdigest()
+    return segmentHashes
+
+  @staticmethod
+  def _getSegmentSnapshot(segmentationNode, segmentId, compress=True):
+    """Get the source representation of a segment, compressed (unless compress is False)"""
+    def encode(array):
+      return zlib.compress(array.tobytes(), 1) if compress else array.tobytes()
+    segmentation = segmentationNode.GetSegmentation()
+    try:
+      masterRepresentationName = segmentation.GetSourceRepresentationName()
+    except:
+      # Legacy (Slicer-5.3 and earlier)
+      masterRepresentationName = segmentation.GetMasterRepresentationName()
+
+    if masterRepresentationName == slicer.vtkSegmentationConverter().GetSegmentationBinaryLabelmapRepresentationName():
+      labelmap = slicer.vtkOrientedImageData()
+      segmentationNode.GetBinaryLabelmapRepresentation(segmentId, labelmap)
+      extent = labelmap.GetExtent()
+      if extent[0] > extent[1] or extent[2] > extent[3] or extent[4] > extent[5]:
+        return {'labelmap': None}
+      directions = vtk.vtkMatrix4x4()
+      labelmap.GetDirectionMatrix(directions)
+      return {
+        'labelmap': encode(numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars())),
+        'scalarType': labelmap.GetScalarType(),
+        'origin': labelmap.GetOrigin(),
+        'spacing': labelmap.GetSpacing(),
+        'directions': [[directions.GetElement(row, column) for column in range(3)] for row in range(3)],
+        'extent': extent,
+        }
+    else:
+      polydata = vtk.vtkPolyData()
+      segmentationNode.GetClosedSurfaceRepresentation(segmentId, polydata)
+      if not polydata.GetPoints():
+        return {'polydata': None}
+      points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+      offsets, connectivity = WrapSolidifyLogic._cellArrayToNumpy(polydata.GetPolys())
+      return {'polydata': [encode(array) for array in [points, offsets, connectivity]],
+        'pointsType': points.dtype}
+
+  @staticmethod
+  def _restoreSegmentSnapshot(segmentationNode, segmentId, segmentSnapshot):
+    if 'polydata' in segmentSnapshot:
+      polydata = vtk.vtkPolyData()
+      if segmentSnapshot['polydata'] is not None:
+        compressedPoints, compressedOffsets, compressedConnectivity = segmentSnapshot['polydata']
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(
+          np.frombuffer(zlib.decompress(compressedPoints), dtype=segmentSnapshot['pointsType']).reshape(-1, 3), deep=1))
+        polydata.SetPoints(points)
+        polydata.SetPolys(WrapSolidifyLogic._numpyToCellArray(
+          np.frombuffer(zlib.decompress(compressedOffsets), dtype=np.int64),
+          np.frombuffer(zlib.decompress(compressedConnectivity), dtype=np.int64)))
+      WrapSolidifyLogic._polydataToSegment(polydata, segmentationNode, segmentId)
+      return
+    if segmentSnapshot['labelmap'] is None:
+      slicer.vtkSlicerSegmentationsModuleLogic.ClearSegment(segmentationNode, segmentId)
+      return
+    labelmap = slicer.vtkOrientedImageData()
+    labelmap.SetOrigin(segmentSnapshot['origin'])
+    labelmap.SetSpacing(segmentSnapshot['spacing'])
+    directions = segmentSnapshot['directions']
+    labelmap.SetDirections(directions[0], directions[1], directions[2])
+    labelmap.SetExtent(segmentSnapshot['extent'])
+    labelmap.AllocateScalars(segmentSnapshot['scalarType'], 1)
+    voxels = numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars())
+    voxels[:] = np.frombuffer(zlib.decompress(segmentSnapshot['labelmap']), dtype=voxels.dtype)
+    slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(labelmap, segmentationNode, segmentId,
+      slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE)
 
   def _cleanup(self):
     if self.previousIntermediateResult:
       self.previousIntermediateResult.GetDisplayNode().SetVisibility(False)
     self._inputPd = None
     self._inputSpacing = None
+    self._inputSpacingAspect = 1.0
+    self._regionSegmentPd = None
+    self._inputDistanceMap = None
+    self._inputDistanceMapMargin = 0
+    self._numberOfProgressSteps = 0
+    if self._previousNumberOfSmpThreads is not None:
+      vtk.vtkSMPTools.Initialize(self._previousNumberOfSmpThreads)
+      self._previousNumberOfSmpThreads = None
 
-  def _updateInputPd(self):
+  def _updateInputPd(self, record=None):
 
     segment = self.segmentationNode.GetSegmentation().GetSegment(self.segmentId)
     self._inputPd = vtk.vtkPolyData()
@@ -407,37 +1299,231 @@ class WrapSolidifyLogic(object):
     # Get input polydata and input spacing
     if masterRepresentationName == slicer.vtkSegmentationConverter().GetSegmentationBinaryLabelmapRepresentationName():
       # Master representation is binary labelmap
-      # Reconvert to closed surface using chosen chosen smoothing factor
-      originalSurfaceSmoothing = float(self.segmentationNode.GetSegmentation().GetConversionParameter(
-        slicer.vtkBinaryLabelmapToClosedSurfaceConversionRule().GetSmoothingFactorParameterName()))
-      if abs(originalSurfaceSmoothing-self.smoothingFactor) > 0.001:
-        self.segmentationNode.GetSegmentation().SetConversionParameter(
-          slicer.vtkBinaryLabelmapToClosedSurfaceConversionRule().GetSmoothingFactorParameterName(), str(self.smoothingFactor))
-        # Force re-conversion
-        self.segmentationNode.RemoveClosedSurfaceRepresentation()
-      self.segmentationNode.CreateClosedSurfaceRepresentation()
-      self.segmentationNode.GetClosedSurfaceRepresentation(self.segmentId, self._inputPd)
-      if self._inputPd.GetNumberOfPoints() == 0:
-        raise ValueError("Input segment closed surface representation is empty")
-      # Get input spacing
       inputLabelmap = slicer.vtkOrientedImageData()
       self.segmentationNode.GetBinaryLabelmapRepresentation(self.segmentId, inputLabelmap)
       extent = inputLabelmap.GetExtent()
       if extent[0]>extent[1] or extent[2]>extent[3] or extent[4]>extent[5]:
         raise ValueError("Input segment labelmap representation is empty")
-      self._inputSpacing = math.sqrt(np.sum(np.array(inputLabelmap.GetSpacing())**2))
+      if record is not None:
+        record['voxels'] = inputLabelmap.GetNumberOfPoints()
+      self._inputPd = self._getInputClosedSurface(self.segmentId, inputLabelmap)
+      if self._inputPd.GetNumberOfPoints() == 0:
+        raise ValueError("Input segment closed surface representation is empty")
+      # Get input spacing
+      self._inputSpacing, self._inputSpacingAspect = self._getLabelmapInputSpacing(inputLabelmap)
     else:
       # Representation is already closed surface
       self.segmentationNode.CreateClosedSurfaceRepresentation()
       self.segmentationNode.GetClosedSurfaceRepresentation(self.segmentId, self._inputPd)
-      # set spacing to have an approxmately 250^3 volume
-      # this size is not too large for average computing hardware yet
-      # it is sufficiently detailed for many applications
-      preferredVolumeSizeInVoxels = 250 * 250 * 250
       bounds = np.zeros(6)
       self._inputPd.GetBounds(bounds)
-      volumeSizeInMm3 = (bounds[1] - bounds[0]) * (bounds[3] - bounds[2]) * (bounds[5] - bounds[4])
-      self._inputSpacing = pow(volumeSizeInMm3 / preferredVolumeSizeInVoxels, 1 / 3.)
+      self._inputSpacing = WrapSolidifyLogic._getClosedSurfaceInputSpacing(bounds)
+
+    # Get initial region segment (all access to the segmentation node must be done before starting the computation)
+    if self.region == REGION_SEGMENT:
+      if not self.regionSegmentId:
+        raise ValueError("Region segment is not set")
+      if self.regionSegmentId == self.segmentId:
+        raise ValueError("Region segment cannot be the same segment as the current segment")
+      if masterRepresentationName == slicer.vtkSegmentationConverter().GetSegmentationBinaryLabelmapRepresentationName():
+        # Closed surface representation of the segmentation is not created, convert only the region segment
+        self._regionSegmentPd = self._getInputClosedSurface(self.regionSegmentId)
+      else:
+        self._regionSegmentPd = vtk.vtkPolyData()
+        self.segmentationNode.GetClosedSurfaceRepresentation(self.regionSegmentId, self._regionSegmentPd)
+      if not self._regionSegmentPd or self._regionSegmentPd.GetNumberOfPoints() == 0:
+        raise ValueError("Region segment is empty")
+
+    # Use the finest resolution that fits into the memory budget. Closed surface input spacing is just a heuristic,
+    # therefore it may be made finer, while labelmap input spacing is only made coarser.
+    bounds = np.zeros(6)
+    self._inputPd.GetBounds(bounds)
+    allowFinerSpacing = (masterRepresentationName != slicer.vtkSegmentationConverter().GetSegmentationBinaryLabelmapRepresentationName())
+    inputSpacing, peakMemoryBytes = self._getMemoryLimitedInputSpacing(bounds, self._inputSpacing, allowFinerSpacing)
+    if inputSpacing != self._inputSpacing:
+      logging.info("Wrap solidify: remesh spacing is {0} from {1:.3f}mm to {2:.3f}mm to fit into {3}MB memory budget".format(
+        "increased" if inputSpacing > self._inputSpacing else "decreased",
+        self._inputSpacing / self.remeshOversampling, inputSpacing / self.remeshOversampling, self.memoryBudgetMB))
+      self._inputSpacing = inputSpacing
+    logging.info("Wrap solidify: estimated peak memory usage of labelmaps is {0:.0f}MB".format(peakMemoryBytes / 1024.0 / 1024.0))
+
+  def _getInputClosedSurface(self, segmentId, inputLabelmap=None):
+    """Get closed surface of a segment (the input or the region segment), converted from its labelmap using
+    the chosen smoothing factor. The existing closed surface representation is used if it was created with
+    the same smoothing factor, otherwise only this segment is converted (in a temporary segmentation),
+    representations of the segmentation node are not modified.
+    """
+    segmentation = self.segmentationNode.GetSegmentation()
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    smoothingFactorName = slicer.vtkBinaryLabelmapToClosedSurfaceConversionRule().GetSmoothingFactorParameterName()
+    inputPd = vtk.vtkPolyData()
+    segment = segmentation.GetSegment(segmentId)
+    if not segment:
+      raise ValueError("Segment is not found: " + segmentId)
+    if (segment.GetRepresentation(closedSurfaceName)
+        and abs(float(segmentation.GetConversionParameter(smoothingFactorName)) - self.smoothingFactor) <= 0.001):
+      self.segmentationNode.GetClosedSurfaceRepresentation(segmentId, inputPd)
+      return inputPd
+
+    if inputLabelmap is None:
+      inputLabelmap = slicer.vtkOrientedImageData()
+      self.segmentationNode.GetBinaryLabelmapRepresentation(segmentId, inputLabelmap)
+
+    inputSegmentation = vtkSegmentationCorePython.vtkSegmentation()
+    labelmapName = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+    try:
+      inputSegmentation.SetSourceRepresentationName(labelmapName)
+    except AttributeError:
+      # Legacy (Slicer-5.3 and earlier)
+      inputSegmentation.SetMasterRepresentationName(labelmapName)
+    inputSegmentation.CopyConversionParameters(segmentation)
+    inputSegmentation.SetConversionParameter(smoothingFactorName, str(self.smoothingFactor))
+    inputSegment = vtkSegmentationCorePython.vtkSegment()
+    inputSegment.AddRepresentation(labelmapName, inputLabelmap)
+    inputSegmentation.AddSegment(inputSegment, segmentId)
+    inputSegmentation.CreateRepresentation(closedSurfaceName)
+    inputPd.DeepCopy(inputSegment.GetRepresentation(closedSurfaceName))
+    return inputPd
+
+  def estimateResources(self):
+    """Estimate remesh spacing, peak memory usage of labelmaps, and computation time of a run before starting it.
+    The estimate is computed from the input segment bounds, without converting the segment.
+    Returns a dictionary with 'spacing' (mm), 'peakMemoryMB', and 'expectedTimeSec'.
+    """
+    segmentation = self.segmentationNode.GetSegmentation()
+    segment = segmentation.GetSegment(self.segmentId)
+    if not segment:
+      raise ValueError("Input segment is not found")
+    bounds = np.zeros(6)
+    segment.GetBounds(bounds)
+    if bounds[0] > bounds[1] or bounds[2] > bounds[3] or bounds[4] > bounds[5]:
+      raise ValueError("Input segment is empty")
+
+    # Estimate using a copy of the logic, so that the state of a computation (that may be running
+    # in the background) is not changed
+    logic = copy.copy(self)
+    labelmapRepresentationName = slicer.vtkSegmentationConverter().GetSegmentationBinaryLabelmapRepresentationName()
+    try:
+      masterRepresentationName = segmentation.GetSourceRepresentationName()
+    except:
+      # Legacy (Slicer-5.3 and earlier)
+      masterRepresentationName = segmentation.GetMasterRepresentationName()
+    allowFinerSpacing = (masterRepresentationName != labelmapRepresentationName)
+    if not allowFinerSpacing:
+      inputSpacing, logic._inputSpacingAspect = logic._getLabelmapInputSpacing(segment.GetRepresentation(labelmapRepresentationName))
+    else:
+      inputSpacing = WrapSolidifyLogic._getClosedSurfaceInputSpacing(bounds)
+      logic._inputSpacingAspect = 1.0
+
+    inputSpacing, peakMemoryBytes = logic._getMemoryLimitedInputSpacing(bounds, inputSpacing, allowFinerSpacing)
+    return {
+      'spacing': logic._getGridSpacing(inputSpacing / logic.remeshOversampling),
+      'peakMemoryMB': peakMemoryBytes / 1024.0 / 1024.0,
+      'expectedTimeSec': logic._getNumberOfVoxelIterations(bounds, inputSpacing) * logic.secondsPerVoxelIteration,
+      }
+
+  def _getLabelmapInputSpacing(self, inputLabelmap):
+    """Get input spacing from the input labelmap.
+    Returns the input spacing (scalar) and the relative spacing along each axis (1.0 for isotropic grid).
+    """
+    inputLabelmapSpacing = np.array(inputLabelmap.GetSpacing())
+    if not self.remeshAnisotropic:
+      return math.sqrt(np.sum(inputLabelmapSpacing**2)), 1.0
+    # Get spacing along the RAS axes (the remesh grid is aligned with the RAS axes)
+    directions = vtk.vtkMatrix4x4()
+    inputLabelmap.GetDirectionMatrix(directions)
+    directionsArray = np.abs(np.array([[directions.GetElement(row, column) for column in range(3)] for row in range(3)]))
+    inputRasSpacing = directionsArray.dot(inputLabelmapSpacing)
+    # Voxel volume is the same as of the isotropic grid (therefore the number of voxels does not increase),
+    # only the resolution is redistributed between the axes: the grid is finer along finely sampled axes.
+    # Relative spacing follows the square root of the input spacing ratios, so that the grid does not become
+    # much coarser than the input along the coarsely sampled axis.
+    isotropicSpacing = math.sqrt(np.sum(inputLabelmapSpacing**2))
+    relativeSpacing = np.sqrt(inputRasSpacing / np.max(inputRasSpacing))
+    relativeSpacing /= np.prod(relativeSpacing) ** (1.0 / 3.0)
+    return isotropicSpacing * np.max(relativeSpacing), relativeSpacing / np.max(relativeSpacing)
+
+  def _getGridSpacing(self, spacing):
+    """Get spacing of remesh grid (scalar if isotropic, 3-element array if anisotropic).
+    All scalar spacing values used in the logic refer to the coarsest axis of the grid.
+    """
+    return spacing * self._inputSpacingAspect
+
+  @staticmethod
+  def _getClosedSurfaceInputSpacing(bounds):
+    # set spacing to have an approxmately 250^3 volume
+    # this size is not too large for average computing hardware yet
+    # it is sufficiently detailed for many applications
+    preferredVolumeSizeInVoxels = 250 * 250 * 250
+    volumeSizeInMm3 = (bounds[1] - bounds[0]) * (bounds[3] - bounds[2]) * (bounds[5] - bounds[4])
+    return pow(volumeSizeInMm3 / preferredVolumeSizeInVoxels, 1 / 3.)
+
+  @staticmethod
+  def _getNumberOfVoxels(bounds, spacing, margin=0):
+    """Get number of voxels of a labelmap that is created by _polydataToLabelmap"""
+    spacing3 = np.ones(3) * spacing
+    numberOfVoxels = 1
+    for i in range(3):
+      numberOfVoxels *= int(math.ceil((bounds[i * 2 + 1] - bounds[i * 2] + 2 * margin) / spacing3[i])) + 3
+    return numberOfVoxels
+
+  def _estimatePeakMemoryBytes(self, bounds, spacing):
+    """Estimate peak memory usage of all labelmaps that are allocated during a run"""
+    spacing = self._getGridSpacing(spacing)
+    # Rasterized labelmap (1 byte per voxel), slabs of parallel rasterization are written directly into it
+    shrinkWrapBytes = 0
+    if not self.remeshNarrowBand or self.isoSurfaceEngine == ISO_SURFACE_ENGINE_SURFACE_NETS:
+      shrinkWrapBytes = WrapSolidifyLogic._getNumberOfVoxels(bounds, spacing)
+    peakMemoryBytes = shrinkWrapBytes
+
+    distanceMapMargin = self._getInputDistanceMapMargin()
+    distanceMapBytes = 0
+    if distanceMapMargin > 0:
+      numberOfVoxels = WrapSolidifyLogic._getNumberOfVoxels(bounds, spacing, distanceMapMargin + np.max(spacing))
+      # Distance map is kept during the run (float)
+      distanceMapBytes = 4 * numberOfVoxels
+      # While computing: inverted input labelmap and two double distance maps (vtkImageEuclideanDistance
+      # processes the axes one by one, keeping the output of the previous and the current axis).
+      # Casting the double distance map to float afterwards needs less memory.
+      peakMemoryBytes = max(peakMemoryBytes, (1 + 8 + 8) * numberOfVoxels)
+      # Carving holes: dilated labelmap, region growing output
+      peakMemoryBytes = max(peakMemoryBytes, distanceMapBytes + shrinkWrapBytes + (1 + 1) * numberOfVoxels)
+
+    if self.region in CAVITY_REGIONS:
+      # Outer surface and input labelmaps (combined in place), cavity labels (unsigned short)
+      numberOfVoxels = WrapSolidifyLogic._getNumberOfVoxels(bounds, spacing, distanceMapMargin + np.max(spacing))
+      peakMemoryBytes = max(peakMemoryBytes, distanceMapBytes + (1 + 1 + 2) * numberOfVoxels)
+
+    return peakMemoryBytes
+
+  def _getMemoryLimitedInputSpacing(self, bounds, inputSpacing, allowFinerSpacing=False):
+    """Get the finest input spacing for which the estimated peak memory usage fits into the memory budget.
+    If allowFinerSpacing is False then the returned spacing is not finer than inputSpacing
+    (labelmap input has no details below its own resolution), otherwise the whole budget may be used.
+    Returns the input spacing and the estimated peak memory usage in bytes.
+    """
+    peakMemoryBytes = self._estimatePeakMemoryBytes(bounds, inputSpacing / self.remeshOversampling)
+    if self.memoryBudgetMB > 0:
+      memoryBudgetBytes = self.memoryBudgetMB * 1024 * 1024
+      if allowFinerSpacing and 0 < peakMemoryBytes < memoryBudgetBytes:
+        # Memory usage is approximately proportional to the number of voxels. Padding voxels make the
+        # scaled spacing slightly too fine, which is corrected by the search for coarser spacing below.
+        inputSpacing *= pow(float(peakMemoryBytes) / memoryBudgetBytes, 1 / 3.)
+        peakMemoryBytes = self._estimatePeakMemoryBytes(bounds, inputSpacing / self.remeshOversampling)
+      while peakMemoryBytes > memoryBudgetBytes:
+        # Memory usage is approximately proportional to the number of voxels
+        inputSpacing *= max(pow(float(peakMemoryBytes) / memoryBudgetBytes, 1 / 3.), 1.01)
+        peakMemoryBytes = self._estimatePeakMemoryBytes(bounds, inputSpacing / self.remeshOversampling)
+    return inputSpacing, peakMemoryBytes
+
+  def _getNumberOfVoxelIterations(self, bounds, inputSpacing):
+    """Get total number of voxels processed in all shrinkwrap iterations"""
+    spacings = self._getShrinkWrapSpacings(inputSpacing)
+    numberOfVoxelIterations = sum([WrapSolidifyLogic._getNumberOfVoxels(bounds, self._getGridSpacing(spacing)) for spacing in spacings])
+    if self.region in CAVITY_REGIONS and self.splitCavities:
+      # Cavities are smaller than the outer surface, therefore this is an upper estimate for multiple cavities
+      numberOfVoxelIterations *= 2
+    return numberOfVoxelIterations
 
 
   def _getInitialRegionPd(self):
@@ -445,56 +1531,13 @@ class WrapSolidifyLogic(object):
 
     spacing = self._inputSpacing / self.remeshOversampling
 
-    if self.carveHolesInOuterSurface:
-      # Grow input polydata to close holes between outer surface and internal cavities.
-
-      # It is less accurate but more robust to dilate labelmap than grow polydata.
-      # Since accuracy is not important here, we dilate labelmap.
-      # Convert to labelmap
-      carveHolesInOuterSurfaceRadius = self.carveHolesInOuterSurfaceDiameter/2.0
-      # add self.carveHolesInOuterSurfaceDiameter extra to bounds to ensure that the grown input still has an margin around
-      inputLabelmap = WrapSolidifyLogic._polydataToLabelmap(self._inputPd, spacing, extraMarginToBounds=carveHolesInOuterSurfaceRadius)
-
-      self._saveIntermediateResult("InitialRegionResampled", WrapSolidifyLogic._labelmapToPolydata(inputLabelmap, 1))
-
-      # Dilate
-      import vtkITK
-      margin = vtkITK.vtkITKImageMargin()
-      margin.SetInputData(inputLabelmap)
-      margin.CalculateMarginInMMOn()
-      margin.SetOuterMarginMM(carveHolesInOuterSurfaceRadius)
-      margin.Update()
-      # extendedInputLabelmap: 255 near original inputLabelmap voxels, 0 elsewhere
-      extendedInputLabelmap = margin.GetOutput()
-      self._saveIntermediateResult("InitialRegionGrown", WrapSolidifyLogic._labelmapToPolydata(extendedInputLabelmap, 255))
-
-      # Region growing from a corner of the image
-      seedPoints = vtk.vtkPoints()
-      seedPoints.InsertNextPoint(inputLabelmap.GetOrigin()[0] + spacing / 2,
-                                 inputLabelmap.GetOrigin()[1] + spacing / 2,
-                                 inputLabelmap.GetOrigin()[2] + spacing / 2)
-      seedScalars = vtk.vtkUnsignedCharArray()
-      seedScalars.InsertNextValue(255)  # this will be the label value to the grown region
-      seedData = vtk.vtkPolyData()
-      seedData.SetPoints(seedPoints)
-      seedData.GetPointData().SetScalars(seedScalars)
-
-      regionGrowing = vtk.vtkImageConnectivityFilter()
-      regionGrowing.SetSeedData(seedData)
-      regionGrowing.SetScalarRange(-10, 10)
-      regionGrowing.SetInputData(extendedInputLabelmap)
-      regionGrowing.Update()
-
-      # outsideObjectImage: 255 outside the object, 0 inside
-      outsideObjectLabelmap = regionGrowing.GetOutput()
-
     # Cavity extraction and outer surface extraction starts from the same outer surface shrinkwrap
-    if self.region == REGION_OUTER_SURFACE or self.region == REGION_LARGEST_CAVITY:
+    if self.region == REGION_OUTER_SURFACE or self.region in CAVITY_REGIONS:
       if self.carveHolesInOuterSurface:
-        # Convert back to polydata
-        initialRegionPd = vtk.vtkPolyData()
-        initialRegionPd.DeepCopy(WrapSolidifyLogic._labelmapToPolydata(outsideObjectLabelmap, 255))
-      else:
+        initialRegionPd = self._getCarvedOuterSurfacePd(self.carveHolesInOuterSurfaceDiameter)
+      elif self.initialShape == INITIAL_SHAPE_CONVEX_HULL or self.initialShape == INITIAL_SHAPE_ORIENTED_BOUNDING_BOX:
+        initialRegionPd = self._getBoundingPolyhedronPd(self.initialShape)
+      elif self.initialShape == INITIAL_SHAPE_SPHERE:
         # create sphere that encloses entire segment content
         bounds = np.zeros(6)
         self._inputPd.GetBounds(bounds)
@@ -518,16 +1561,11 @@ class WrapSolidifyLogic(object):
         sphereSource.SetCenter((bounds[0]+bounds[1])/2.0, (bounds[2]+bounds[3])/2.0, (bounds[4]+bounds[5])/2.0)
         sphereSource.Update()
         initialRegionPd = sphereSource.GetOutput()
+      else:
+        raise ValueError("Invalid initial shape: "+self.initialShape)
     elif self.region == REGION_SEGMENT:
       # create initial region from segment (that will be grown)
-      if not self.regionSegmentId:
-        raise ValueError("Region segment is not set")
-      if self.regionSegmentId == self.segmentId:
-        raise ValueError("Region segment cannot be the same segment as the current segment")
-      initialRegionPd = vtk.vtkPolyData()
-      self.segmentationNode.GetClosedSurfaceRepresentation(self.regionSegmentId, initialRegionPd)
-      if not initialRegionPd or initialRegionPd.GetNumberOfPoints() == 0:
-        raise ValueError("Region segment is empty")
+      initialRegionPd = self._regionSegmentPd
       # initialRegionPd = self._remeshPolydata(initialRegionPd, self._inputSpacing*5.0)  # simplify the mesh
     else:
       raise ValueError("Invalid region: "+self.region)
@@ -540,100 +1578,664 @@ class WrapSolidifyLogic(object):
     self._saveIntermediateResult("InitialRegion", initialRegionPd)
     return initialRegionPd
 
+  def _getBoundingPolyhedronPd(self, initialShape):
+    """Get a convex polyhedron that tightly encloses the input: its convex hull or its oriented bounding box.
+    The polyhedron is enlarged by one remesh grid voxel to make sure that the input is inside,
+    and it is remeshed at the spacing of the first shrinkwrap iteration.
+    """
+    points = numpy_support.vtk_to_numpy(self._inputPd.GetPoints().GetData()).astype(np.float64)
+    if initialShape == INITIAL_SHAPE_CONVEX_HULL:
+      # Approximate the convex hull by planes of evenly distributed orientations
+      directionsSource = vtk.vtkSphereSource()
+      directionsSource.SetPhiResolution(8)
+      directionsSource.SetThetaResolution(8)
+      directionsSource.Update()
+      directions = numpy_support.vtk_to_numpy(directionsSource.GetOutput().GetPoints().GetData()).astype(np.float64)
+    else:
+      # Principal axes of the input points
+      _, axes = np.linalg.eigh(np.cov(points.T))
+      directions = np.vstack([axes.T, -axes.T])
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+    shrinkWrapSpacings = self._getShrinkWrapSpacings()
+    spacing = self._getGridSpacing(shrinkWrapSpacings[0] if shrinkWrapSpacings else self._inputSpacing / self.remeshOversampling)
+    margin = np.max(spacing)
+
+    hull = vtk.vtkHull()
+    for direction in directions:
+      # Plane is placed at the farthest input point along the direction (computed one direction
+      # at a time to avoid allocating a points x directions array)
+      distance = np.max(points.dot(direction)) + margin
+      hull.AddPlane(direction[0], direction[1], direction[2], -distance)
+    bounds = np.zeros(6)
+    self._inputPd.GetBounds(bounds)
+    hullBoundsMargin = np.max(bounds[1::2] - bounds[0::2]) + margin
+    hullPd = vtk.vtkPolyData()
+    hull.GenerateHull(hullPd,
+      bounds[0] - hullBoundsMargin, bounds[1] + hullBoundsMargin,
+      bounds[2] - hullBoundsMargin, bounds[3] + hullBoundsMargin,
+      bounds[4] - hullBoundsMargin, bounds[5] + hullBoundsMargin)
+
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(hullPd)
+    triangleFilter.Update()
+    initialRegionPd = vtk.vtkPolyData()
+    initialRegionPd.DeepCopy(WrapSolidifyLogic._remeshPolydata(triangleFilter.GetOutput(), spacing,
+      isoSurfaceEngine=self.isoSurfaceEngine, numberOfThreads=self.numberOfThreads, smoothingFactor=self.smoothingFactor))
+    return initialRegionPd
+
+  def _getCarvedOuterSurfacePd(self, carveHolesInOuterSurfaceDiameter):
+    """Get outer surface of the input, grown to close holes between outer surface and internal cavities"""
+
+    # It is less accurate but more robust to dilate labelmap than grow polydata.
+    # Since accuracy is not important here, we dilate labelmap.
+    # extendedInputLabelmap: 255 near original inputLabelmap voxels, 0 elsewhere
+    extendedInputLabelmap = self._getDilatedInputLabelmap(carveHolesInOuterSurfaceDiameter / 2.0)
+    self._saveIntermediateResult("InitialRegionGrown", WrapSolidifyLogic._labelmapToPolydata(extendedInputLabelmap, 255, self.isoSurfaceEngine))
+
+    # Region growing from a corner of the image
+    origin = extendedInputLabelmap.GetOrigin()
+    spacing = extendedInputLabelmap.GetSpacing()
+    seedPoints = vtk.vtkPoints()
+    seedPoints.InsertNextPoint(origin[0] + spacing[0] / 2, origin[1] + spacing[1] / 2, origin[2] + spacing[2] / 2)
+    seedScalars = vtk.vtkUnsignedCharArray()
+    seedScalars.InsertNextValue(255)  # this will be the label value to the grown region
+    seedData = vtk.vtkPolyData()
+    seedData.SetPoints(seedPoints)
+    seedData.GetPointData().SetScalars(seedScalars)
+
+    regionGrowing = vtk.vtkImageConnectivityFilter()
+    regionGrowing.SetSeedData(seedData)
+    regionGrowing.SetScalarRange(-10, 10)
+    regionGrowing.SetInputData(extendedInputLabelmap)
+    regionGrowing.Update()
+
+    # outsideObjectImage: 255 outside the object, 0 inside
+    outsideObjectLabelmap = regionGrowing.GetOutput()
+
+    # Convert back to polydata
+    initialRegionPd = vtk.vtkPolyData()
+    initialRegionPd.DeepCopy(WrapSolidifyLogic._labelmapToPolydata(outsideObjectLabelmap, 255, self.isoSurfaceEngine, self.smoothingFactor))
+    return initialRegionPd
+
+  def _getInputDistanceMapMargin(self):
+    """Get the largest dilation radius that is needed during the current run"""
+    margin = 0
+    if self.carveHolesInOuterSurface and (self.region == REGION_OUTER_SURFACE or self.region in CAVITY_REGIONS):
+      margin = max(margin, self.carveHolesInOuterSurfaceDiameter / 2.0)
+    if self.splitCavities and self.region in CAVITY_REGIONS:
+      margin = max(margin, self.splitCavitiesDiameter / 2.0)
+    return margin
+
+  def _getInputDistanceMap(self, margin=0):
+    """Get squared distance (in mm^2) of each voxel from the input segment.
+    The distance map is computed once per run (on a grid that has the largest required dilation radius
+    as margin around the input) and reused for all dilations.
+    """
+    margin = max(margin, self._getInputDistanceMapMargin())
+    if self._inputDistanceMap is not None and self._inputDistanceMapMargin >= margin:
+      return self._inputDistanceMap
+
+    spacing = self._getGridSpacing(self._inputSpacing / self.remeshOversampling)
+    # add an extra voxel to the margin to ensure that the dilated input still has a margin around
+    inputLabelmap = WrapSolidifyLogic._polydataToLabelmap(self._inputPd, spacing, extraMarginToBounds=margin + np.max(spacing),
+      numberOfThreads=self.numberOfThreads)
+
+    # Distance is computed to the nearest zero voxel, therefore the labelmap is inverted (0 inside, 1 outside).
+    # Inversion is done in place to avoid allocating another labelmap.
+    inputVoxels = numpy_support.vtk_to_numpy(inputLabelmap.GetPointData().GetScalars())
+    np.logical_not(inputVoxels, out=inputVoxels)
+    inputLabelmap.GetPointData().GetScalars().Modified()
+
+    distanceFilter = vtk.vtkImageEuclideanDistance()
+    distanceFilter.SetInputData(inputLabelmap)
+    distanceFilter.InitializeOn()
+    distanceFilter.ConsiderAnisotropyOn()  # compute distance in physical units
+    # Only distances up to the largest dilation radius are needed. Distance of farther voxels is capped
+    # at a value that is still above all thresholds (squared distance, in mm^2).
+    distanceFilter.SetMaximumDistance((margin + np.max(spacing)) ** 2)
+
+    # Single precision is sufficient and halves the memory needed for keeping the distance map
+    distanceCast = vtk.vtkImageCast()
+    distanceCast.SetInputConnection(distanceFilter.GetOutputPort())
+    distanceCast.SetOutputScalarTypeToFloat()
+    distanceCast.Update()
+
+    self._inputDistanceMap = distanceCast.GetOutput()
+    self._inputDistanceMapMargin = margin
+    return self._inputDistanceMap
+
+  def _getDilatedInputLabelmap(self, radius):
+    """Get input labelmap dilated by radius (in mm). Voxels are 255 near the input and 0 elsewhere."""
+    threshold = vtk.vtkImageThreshold()
+    threshold.SetInputData(self._getInputDistanceMap(radius))
+    threshold.ThresholdByLower(radius * radius)
+    threshold.SetInValue(255)
+    threshold.SetOutValue(0)
+    threshold.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+    threshold.Update()
+    return threshold.GetOutput()
+
+  def computeCarveHolesSweep(self, diameters):
+    """Compute the initial region of outer surface extraction for several carve holes diameters.
+    The input distance map is computed only once, therefore trying many diameters costs little more than trying one.
+    Returns a dictionary of diameter -> initial region polydata.
+    """
+    try:
+      self._startComputation()
+      self._getInputDistanceMap(max(diameters) / 2.0)
+      initialRegions = {}
+      for diameter in diameters:
+        self._checkCancelRequested()
+        initialRegions[diameter] = self._getCarvedOuterSurfacePd(diameter)
+      return initialRegions
+    finally:
+      self._cleanup()
+
+  def computeSplitCavitiesSweep(self, diameters):
+    """Compute the largest cavity for several split cavities diameters.
+    The outer surface shrinkwrap and the input distance map are computed only once.
+    Returns a dictionary of diameter -> cavity polydata (before it is refined by shrinkwrapping).
+    """
+    try:
+      self._startComputation()
+      shrunkenPd = vtk.vtkPolyData()
+      self._computeStage('shrinkWrap', shrunkenPd)
+      self._getInputDistanceMap(max(diameters) / 2.0)
+      cavities = {}
+      for diameter in diameters:
+        self._checkCancelRequested()
+        cavities[diameter] = self._getLargestCavityPd(shrunkenPd, diameter)
+      return cavities
+    finally:
+      self._cleanup()
+
+
+  def _getShrinkWrapSpacings(self, inputSpacing=None):
+    """Get remesh spacing of each shrink-wrap iteration.
+    In coarse-to-fine mode the spacing is refined from coarse to the target spacing during
+    the first half of the iterations, the remaining iterations are performed at the target spacing.
+    """
+    if inputSpacing is None:
+      inputSpacing = self._inputSpacing
+    spacing = inputSpacing / self.remeshOversampling
+    if not self.shrinkwrapCoarseToFine or self.shrinkwrapIterations < 2:
+      return [spacing] * self.shrinkwrapIterations
+    numberOfRefinementIterations = int(math.ceil(self.shrinkwrapIterations / 2.0))
+    spacings = []
+    for iterationIndex in range(self.shrinkwrapIterations):
+      refinement = min(float(iterationIndex) / numberOfRefinementIterations, 1.0)
+      spacings.append(spacing * pow(self.shrinkwrapCoarseSpacingFactor, 1.0 - refinement))
+    return spacings
 
-  def _shrinkWrap(self, regionPd):
+  def _shrinkWrap(self, regionPd, inputPd=None):
 
+    if inputPd is None:
+      inputPd = self._inputPd
     shrunkenPd = regionPd
-    spacing = self._inputSpacing / self.remeshOversampling
+    spacings = self._getShrinkWrapSpacings()
+    # Time spent at each resolution level: list of [spacing, number of iterations, time]
+    levelTimes = []
 
+    numberOfIterations = self.shrinkwrapIterations
     for iterationIndex in range(self.shrinkwrapIterations):
+      spacing = spacings[iterationIndex]
+      iterationStartTime = time.time()
+      previousPd = shrunkenPd
 
       # shrink
       self._checkCancelRequested()
       self._log('Shrinking %s/%s...' %(iterationIndex+1, self.shrinkwrapIterations))
-      if shrunkenPd.GetNumberOfPoints()<=1 or self._inputPd.GetNumberOfPoints()<=1:
+      if shrunkenPd.GetNumberOfPoints()<=1 or inputPd.GetNumberOfPoints()<=1:
         # we must not feed empty polydata into vtkSmoothPolyDataFilter because it would crash the application
         raise ValueError("Mesh has become empty during shrink-wrap iterations")
-      smoothFilter = vtk.vtkSmoothPolyDataFilter()
-      smoothFilter.SetInputData(0, shrunkenPd)
-      smoothFilter.SetInputData(1, self._inputPd)  # constrain smoothed points to the input surface
-      smoothFilter.Update()
-      shrunkenPd = vtk.vtkPolyData()
-      shrunkenPd.DeepCopy(smoothFilter.GetOutput())
+      with self._instrumentStage('shrink {0}'.format(iterationIndex+1), shrunkenPd) as record:
+        smoothFilter = vtk.vtkSmoothPolyDataFilter()
+        smoothFilter.SetInputData(0, shrunkenPd)
+        smoothFilter.SetInputData(1, inputPd)  # constrain smoothed points to the input surface
+        smoothFilter.Update()
+        shrunkenPd = vtk.vtkPolyData()
+        shrunkenPd.DeepCopy(smoothFilter.GetOutput())
+        WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
       self._saveIntermediateResult("Shrunken", shrunkenPd)
 
       # remesh
       self._checkCancelRequested()
       self._log('Remeshing %s/%s...' %(iterationIndex+1, self.shrinkwrapIterations))
-      remeshedPd = WrapSolidifyLogic._remeshPolydata(shrunkenPd, spacing)
-      shrunkenPd = vtk.vtkPolyData()
-      shrunkenPd.DeepCopy(remeshedPd)
+      with self._instrumentStage('remesh {0}'.format(iterationIndex+1), shrunkenPd) as record:
+        gridSpacing = self._getGridSpacing(spacing)
+        bounds = np.zeros(6)
+        shrunkenPd.GetBounds(bounds)
+        record['voxels'] = WrapSolidifyLogic._getNumberOfVoxels(bounds, gridSpacing)
+        remeshedPd = WrapSolidifyLogic._remeshPolydata(shrunkenPd, gridSpacing, narrowBand=self.remeshNarrowBand,
+          isoSurfaceEngine=self.isoSurfaceEngine, numberOfThreads=self.numberOfThreads, smoothingFactor=self.smoothingFactor)
+        shrunkenPd = vtk.vtkPolyData()
+        shrunkenPd.DeepCopy(remeshedPd)
+        WrapSolidifyLogic._setStageOutput(record, shrunkenPd)
       self._saveIntermediateResult("Remeshed", shrunkenPd)
 
+      converged = False
+      if self.shrinkwrapStopAtConvergence:
+        movement = WrapSolidifyLogic._surfaceDistance(previousPd, shrunkenPd)
+        logging.info("Shrink-wrap iteration {0}: mean surface movement {1:.3f}mm".format(iterationIndex+1, movement))
+        # Only stop if the last two iterations were performed at the final spacing
+        if iterationIndex > 0 and spacings[iterationIndex-1] == spacing == spacings[-1]:
+          converged = (movement < self.shrinkwrapConvergenceTolerance * spacing)
+
+      iterationTime = time.time() - iterationStartTime
+      if levelTimes and levelTimes[-1][0] == spacing:
+        levelTimes[-1][1] += 1
+        levelTimes[-1][2] += iterationTime
+      else:
+        levelTimes.append([spacing, 1, iterationTime])
+
+      if converged:
+        numberOfIterations = iterationIndex+1
+        break
+
+    for levelIndex, (spacing, numberOfLevelIterations, levelTime) in enumerate(levelTimes):
+      logging.info("Shrink-wrap level {0}: spacing {1:.3f}mm, {2} iterations, {3:.2f}s".format(
+        levelIndex+1, spacing, numberOfLevelIterations, levelTime))
+    if self.shrinkwrapStopAtConvergence:
+      logging.info("Shrink-wrap completed in {0} of maximum {1} iterations".format(numberOfIterations, self.shrinkwrapIterations))
+
     return shrunkenPd
 
   def _extractCavity(self, shrunkenPd):
 
-    spacing = self._inputSpacing / self.remeshOversampling
-    outsideObjectLabelmap = WrapSolidifyLogic._polydataToLabelmap(shrunkenPd, spacing)  # 0=outside, 1=inside
+    initialRegionPd = self._getLargestCavityPd(shrunkenPd, self.splitCavitiesDiameter if self.splitCavities else None)
+
+    if self.splitCavities:
+      return self._shrinkWrap(initialRegionPd)
+    else:
+      return initialRegionPd
 
-    inputLabelmap = WrapSolidifyLogic._polydataToLabelmap(self._inputPd, referenceImage=outsideObjectLabelmap)
+  def _extractCavities(self, shrunkenPd):
+    """Get the largest internal cavities (at most cavitiesMaxCount, each at least cavitiesMinimumVolume)
+    as a list of polydata, largest cavity first. All cavities are labeled in a single pass.
+    """
+    with self._instrumentStage('labelCavities', shrunkenPd) as record:
+      cavityLabelmap, cavityLabels, cavitySizes = self._labelCavities(shrunkenPd,
+        self.splitCavitiesDiameter if self.splitCavities else None)
+      record['voxels'] = cavityLabelmap.GetNumberOfPoints()
+    voxelVolume = np.prod(cavityLabelmap.GetSpacing())
+    # Cavity sizes are in decreasing order, therefore the cavities that are large enough are the first ones
+    numberOfCavities = int(np.count_nonzero(cavitySizes * voxelVolume >= self.cavitiesMinimumVolume))
+    if self.cavitiesMaxCount > 0:
+      numberOfCavities = min(numberOfCavities, self.cavitiesMaxCount)
+    if numberOfCavities == 0:
+      raise ValueError("No internal cavity is found")
+    logging.info("Wrap solidify: extract {0} of {1} cavities".format(numberOfCavities, len(cavitySizes)))
+    if self._numberOfProgressSteps:
+      self._numberOfProgressSteps += ((numberOfCavities - self._getEstimatedNumberOfOutputs())
+        * self._getNumberOfProgressStepsPerOutput())
+
+    # Reuse the cavity labelmap buffer for the mask of each cavity: 1 in the cavity, 0 elsewhere.
+    # The surface of label 0 (everything except the cavity) is extracted, the same way as for the largest cavity.
+    cavityVoxels = numpy_support.vtk_to_numpy(cavityLabelmap.GetPointData().GetScalars()).view(np.bool_)
+    cavityPds = []
+    for cavityLabel in range(1, numberOfCavities + 1):
+      self._checkCancelRequested()
+      np.equal(cavityLabels, cavityLabel, out=cavityVoxels)
+      cavityLabelmap.GetPointData().GetScalars().Modified()
+      cavityPd = vtk.vtkPolyData()
+      cavityPd.DeepCopy(WrapSolidifyLogic._labelmapToPolydata(cavityLabelmap, 0, self.isoSurfaceEngine, self.smoothingFactor))
+      self._saveIntermediateResult("Cavity{0}".format(cavityLabel), cavityPd)
+      cavityPds.append(cavityPd)
 
     if self.splitCavities:
-      # It is less accurate but more robust to dilate labelmap than grow polydata.
-      # Since accuracy is not important here, we dilate labelmap.
-      splitCavitiesRadius = self.splitCavitiesDiameter / 2.0
-      # Dilate
-      import vtkITK
-      margin = vtkITK.vtkITKImageMargin()
-      margin.SetInputData(inputLabelmap)
-      margin.CalculateMarginInMMOn()
-      margin.SetOuterMarginMM(splitCavitiesRadius)
-      margin.Update()
-      # extendedInputLabelmap: 255 near original inputLabelmap voxels, 0 elsewhere
-      extendedInputLabelmap = margin.GetOutput()
-      self._saveIntermediateResult("SplitCavitiesGrown",
-                                   WrapSolidifyLogic._labelmapToPolydata(extendedInputLabelmap, 255))
+      cavityPds = self._shrinkWrapRegions(cavityPds)
+    return cavityPds
+
+  def _shrinkWrapRegions(self, regionPds):
+    """Shrinkwrap several regions concurrently. Returns list of shrunken polydata, in the same order as the input.
+    Intermediate result nodes can only be created in the main thread, therefore regions are processed
+    one by one if saving of intermediate results is enabled.
+    """
+    numberOfWorkers = self.numberOfThreads if self.numberOfThreads > 0 else (os.cpu_count() or 1)
+    numberOfWorkers = min(numberOfWorkers, len(regionPds))
+    if self.saveIntermediateResults or numberOfWorkers < 2:
+      return [self._shrinkWrap(regionPd) for regionPd in regionPds]
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+      futures = []
+      for regionPd in regionPds:
+        # Each thread uses its own input polydata object (sharing the same arrays), because the smoothing filter
+        # builds a locator for it
+        inputPd = vtk.vtkPolyData()
+        inputPd.ShallowCopy(self._inputPd)
+        futures.append(executor.submit(self._shrinkWrap, regionPd, inputPd))
+      return [future.result() for future in futures]
+
+  def _getWarmStartKey(self):
+    """Get all the inputs (except input content) that the shrinkwrap result depends on"""
+    shrinkWrapKey = self._getStageKeys()['shrinkWrap']
+    # The first two items are the stage name and the input content hash
+    return (self.segmentationNode.GetID() if self.segmentationNode else None, self.segmentId) + shrinkWrapKey[2:]
+
+  def _shrinkWrapWarmStart(self):
+    """Shrinkwrap the input, starting from the result of the previous run.
+    Only the neighborhood of the region where the input labelmap has changed since the previous run is recomputed,
+    the previous result is kept everywhere else. A full shrinkwrap is performed if there is no usable previous result
+    (first run, different segment or parameters, or the input has grown out of the previous grid).
+    """
+    state = self._warmStartState
+    # Release memory of the previous state, it is replaced by the new state
+    self._warmStartState = None
+    key = self._getWarmStartKey()
+
+    shrunkenPd = None
+    if state and state['key'] == key:
+      self._log('Find changes since previous run...')
+      inputLabelmap = self._getWarmStartInputLabelmap(state['inputLabelmap'])
+      if inputLabelmap:
+        shrunkenPd, shrunkenLabelmap = self._shrinkWrapChangedRegion(state['inputLabelmap'], inputLabelmap, state['shrinkWrapLabelmap'])
+
+    if shrunkenPd is None:
+      logging.info("Wrap solidify: previous result cannot be used for warm start, compute full shrinkwrap")
+      self._log('Create starting region...')
+      with self._instrumentStage('initialRegion') as record:
+        regionPd = self._getInitialRegionPd()
+        WrapSolidifyLogic._setStageOutput(record, regionPd)
+      shrunkenPd = self._shrinkWrap(regionPd)
+      spacing = self._getGridSpacing(self._inputSpacing / self.remeshOversampling)
+      # Margin allows the input to grow in later runs without having to recompute everything
+      inputLabelmap = WrapSolidifyLogic._polydataToLabelmap(self._inputPd, spacing, extraMarginToBounds=10 * np.max(spacing),
+        numberOfThreads=self.numberOfThreads)
+      shrunkenLabelmap = WrapSolidifyLogic._polydataToLabelmap(shrunkenPd, referenceImage=inputLabelmap,
+        numberOfThreads=self.numberOfThreads)
+
+    self._warmStartState = {'key': key, 'inputLabelmap': inputLabelmap, 'shrinkWrapLabelmap': shrunkenLabelmap}
+    return shrunkenPd
+
+  def _getWarmStartInputLabelmap(self, previousInputLabelmap):
+    """Rasterize the input on the grid of the previous input labelmap.
+    Returns None if the input is not fully inside the grid (with a few voxels margin).
+    """
+    bounds = np.zeros(6)
+    self._inputPd.GetBounds(bounds)
+    origin = np.array(previousInputLabelmap.GetOrigin())
+    spacing = np.array(previousInputLabelmap.GetSpacing())
+    extent = previousInputLabelmap.GetExtent()
+    minIjk = (bounds[0::2] - origin) / spacing
+    maxIjk = (bounds[1::2] - origin) / spacing
+    margin = 3
+    if np.any(minIjk < np.array(extent[0::2]) + margin) or np.any(maxIjk > np.array(extent[1::2]) - margin):
+      return None
+    return WrapSolidifyLogic._polydataToLabelmap(self._inputPd, referenceImage=previousInputLabelmap,
+      numberOfThreads=self.numberOfThreads)
+
+  def _shrinkWrapChangedRegion(self, previousInputLabelmap, inputLabelmap, previousShrunkenLabelmap):
+    """Recompute shrinkwrap result in the box that contains all changed input voxels.
+    The shrinkwrap is started from the previous result combined with the changed box and it is performed
+    in a larger box (so that the boundary of the box has no effect on the result in the changed box).
+    Returns the new shrinkwrap result as polydata and labelmap (None, None if the input is too small for warm start).
+    """
+    dimensions = inputLabelmap.GetDimensions()
+    previousInputVoxels = numpy_support.vtk_to_numpy(previousInputLabelmap.GetPointData().GetScalars()).reshape(
+      dimensions[2], dimensions[1], dimensions[0])
+    inputVoxels = numpy_support.vtk_to_numpy(inputLabelmap.GetPointData().GetScalars()).reshape(
+      dimensions[2], dimensions[1], dimensions[0])
+    # The previous result is not needed anymore, therefore its buffer is updated in place
+    shrunkenLabelmap = previousShrunkenLabelmap
+    shrunkenVoxels = numpy_support.vtk_to_numpy(shrunkenLabelmap.GetPointData().GetScalars()).reshape(
+      dimensions[2], dimensions[1], dimensions[0])
+
+    changedKji = np.nonzero(previousInputVoxels != inputVoxels)
+    if len(changedKji[0]) == 0:
+      logging.info("Wrap solidify: input has not changed since the previous run")
     else:
-      extendedInputLabelmap = inputLabelmap
-
-    outsideObjectLabelmapInverter = vtk.vtkImageThreshold()
-    outsideObjectLabelmapInverter.SetInputData(outsideObjectLabelmap)
-    outsideObjectLabelmapInverter.ThresholdByLower(0)
-    outsideObjectLabelmapInverter.SetInValue(1)  # backgroundValue
-    outsideObjectLabelmapInverter.SetOutValue(0)  # labelValue
-    outsideObjectLabelmapInverter.SetOutputScalarType(outsideObjectLabelmap.GetScalarType())
-    outsideObjectLabelmapInverter.Update()
-
-    addImage = vtk.vtkImageMathematics()
-    addImage.SetInput1Data(outsideObjectLabelmapInverter.GetOutput())
-    addImage.SetInput2Data(extendedInputLabelmap)
-    addImage.SetOperationToMax()
-    addImage.Update()
-    internalHolesLabelmap = addImage.GetOutput()
-    # internal holes are 0, elsewhere >=1
-    self._saveIntermediateResult("SplitCavitiesAll", WrapSolidifyLogic._labelmapToPolydata(internalHolesLabelmap, 0))
+      # Changed box: all changed voxels with a small margin (it is added to the initial region to make sure that
+      # added voxels are inside). Work box: changed box with a wider band around.
+      changedMargin = 3
+      workMargin = changedMargin + 8
+      changedMin = np.maximum([np.min(indices) - changedMargin for indices in changedKji], 0)
+      changedMax = np.minimum([np.max(indices) + changedMargin + 1 for indices in changedKji], dimensions[::-1])
+      workMin = np.maximum(changedMin - workMargin, 0)
+      workMax = np.minimum(changedMax + workMargin, dimensions[::-1])
+      logging.info("Wrap solidify: warm start, recompute {0} of {1} voxels".format(
+        int(np.prod(workMax - workMin)), int(np.prod(dimensions))))
+
+      # Initial region: previous result and the changed box. The outermost layer is cleared to get a closed surface.
+      workSlices = tuple(slice(workMin[axis], workMax[axis]) for axis in range(3))
+      changedSlices = tuple(slice(changedMin[axis] - workMin[axis], changedMax[axis] - workMin[axis]) for axis in range(3))
+      seedVoxels = np.array(shrunkenVoxels[workSlices])
+      seedVoxels[changedSlices] = 1
+      seedVoxels[[0, -1], :, :] = 0
+      seedVoxels[:, [0, -1], :] = 0
+      seedVoxels[:, :, [0, -1]] = 0
+      seedLabelmap = WrapSolidifyLogic._getSubLabelmap(inputLabelmap, workMin, workMax)
+      seedLabelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+      numpy_support.vtk_to_numpy(seedLabelmap.GetPointData().GetScalars())[:] = seedVoxels.ravel()
+      seedPd = vtk.vtkPolyData()
+      seedPd.DeepCopy(WrapSolidifyLogic._labelmapToPolydata(seedLabelmap, 1, self.isoSurfaceEngine, self.smoothingFactor))
+      self._saveIntermediateResult("WarmStartInitialRegion", seedPd)
+
+      # Only the part of the input that is near the work box is needed as constraint
+      workBounds = np.zeros(6)
+      seedLabelmap.GetBounds(workBounds)
+      box = vtk.vtkBox()
+      box.SetBounds(workBounds)
+      inputExtractor = vtk.vtkExtractPolyDataGeometry()
+      inputExtractor.SetInputData(self._inputPd)
+      inputExtractor.SetImplicitFunction(box)
+      inputExtractor.ExtractInsideOn()
+      inputExtractor.ExtractBoundaryCellsOn()
+      inputExtractor.Update()
+      workInputPd = inputExtractor.GetOutput()
+      if seedPd.GetNumberOfPoints() <= 1 or workInputPd.GetNumberOfPoints() <= 1:
+        return None, None
+
+      workShrunkenPd = self._shrinkWrap(seedPd, workInputPd)
+
+      # Replace the changed box of the previous result
+      changedLabelmap = WrapSolidifyLogic._polydataToLabelmap(workShrunkenPd,
+        referenceImage=WrapSolidifyLogic._getSubLabelmap(inputLabelmap, changedMin, changedMax),
+        numberOfThreads=self.numberOfThreads)
+      changedSlices = tuple(slice(changedMin[axis], changedMax[axis]) for axis in range(3))
+      shrunkenVoxels[changedSlices] = numpy_support.vtk_to_numpy(changedLabelmap.GetPointData().GetScalars()).reshape(
+        changedMax - changedMin)
+      shrunkenLabelmap.GetPointData().GetScalars().Modified()
+
+    shrunkenPd = vtk.vtkPolyData()
+    shrunkenPd.DeepCopy(WrapSolidifyLogic._labelmapToPolydata(shrunkenLabelmap, 1, self.isoSurfaceEngine, self.smoothingFactor))
+    return shrunkenPd, shrunkenLabelmap
 
-    # Find largest internal hole
-    largestHoleExtract = vtk.vtkImageConnectivityFilter()
-    largestHoleExtract.SetScalarRange(-0.5, 0.5)
-    largestHoleExtract.SetInputData(internalHolesLabelmap)
-    largestHoleExtract.SetExtractionModeToLargestRegion()
-    largestHoleExtract.Update()
-    largestHolesLabelmap = largestHoleExtract.GetOutput()
+  @staticmethod
+  def _getSubLabelmap(labelmap, minKji, maxKji):
+    """Get an image (without allocated scalars) that has the same geometry as labelmap, restricted to a box.
+    Box is specified by minimum and maximum (exclusive) voxel index along k, j, i axes, relative to the first voxel.
+    """
+    extent = labelmap.GetExtent()
+    subLabelmap = vtk.vtkImageData()
+    subLabelmap.SetOrigin(labelmap.GetOrigin())
+    subLabelmap.SetSpacing(labelmap.GetSpacing())
+    subLabelmap.SetExtent(
+      extent[0] + int(minKji[2]), extent[0] + int(maxKji[2]) - 1,
+      extent[2] + int(minKji[1]), extent[2] + int(maxKji[1]) - 1,
+      extent[4] + int(minKji[0]), extent[4] + int(maxKji[0]) - 1)
+    return subLabelmap
+
+  def _getInputComponentPds(self):
+    """Split the input into groups of connected components. Each group is returned as a separate polydata.
+    Components that have overlapping bounding boxes (for example, nested surfaces of a hollow object)
+    are kept in the same group. Groups that fit into a single grid voxel in all directions are ignored
+    (thin groups, such as plates, are kept).
+    """
+    connectivityFilter = vtk.vtkPolyDataConnectivityFilter()
+    connectivityFilter.SetInputData(self._inputPd)
+    connectivityFilter.SetExtractionModeToAllRegions()
+    connectivityFilter.ColorRegionsOn()
+    connectivityFilter.Update()
+    labeledPd = connectivityFilter.GetOutput()
+    numberOfComponents = connectivityFilter.GetNumberOfExtractedRegions()
+    if numberOfComponents < 2:
+      return [self._inputPd]
+
+    points = numpy_support.vtk_to_numpy(labeledPd.GetPoints().GetData())
+    offsets, connectivity = WrapSolidifyLogic._cellArrayToNumpy(labeledPd.GetPolys())
+    firstPolyCellId = labeledPd.GetNumberOfVerts() + labeledPd.GetNumberOfLines()
+    cellComponentIds = numpy_support.vtk_to_numpy(labeledPd.GetCellData().GetArray('RegionId'))
+    cellComponentIds = cellComponentIds[firstPolyCellId:firstPolyCellId + len(offsets) - 1].astype(np.int64)
+    entryComponentIds = np.repeat(cellComponentIds, np.diff(offsets))
+
+    # Merge groups of components until bounding boxes of the groups (extended by a grid voxel) do not overlap
+    margin = np.max(self._getGridSpacing(self._inputSpacing / self.remeshOversampling))
+    componentGroupIds = np.arange(numberOfComponents)
+    while True:
+      numberOfGroups = np.max(componentGroupIds) + 1
+      entryGroupIds = componentGroupIds[entryComponentIds]
+      boundsMin = np.full((numberOfGroups, 3), np.inf)
+      boundsMax = np.full((numberOfGroups, 3), -np.inf)
+      np.minimum.at(boundsMin, entryGroupIds, points[connectivity])
+      np.maximum.at(boundsMax, entryGroupIds, points[connectivity])
+      overlapping = np.all((boundsMin[:, np.newaxis, :] <= boundsMax[np.newaxis, :, :] + margin)
+        & (boundsMin[np.newaxis, :, :] <= boundsMax[:, np.newaxis, :] + margin), axis=2)
+      # Each group is merged into the first group that it overlaps with (at least it overlaps with itself)
+      mergedGroupIds = np.argmax(overlapping, axis=1)
+      if np.all(mergedGroupIds == np.arange(numberOfGroups)):
+        break
+      _, componentGroupIds = np.unique(mergedGroupIds[componentGroupIds], return_inverse=True)
+
+    # Create a polydata for each group, containing only the points that the group uses
+    cellGroupIds = componentGroupIds[cellComponentIds]
+    componentPds = []
+    for groupId in range(numberOfGroups):
+      if np.max(boundsMax[groupId] - boundsMin[groupId]) < margin:
+        logging.info("Wrap solidify: ignore component group {0}, it is smaller than the remesh grid spacing".format(groupId))
+        continue
+      groupCellIds = np.nonzero(cellGroupIds == groupId)[0]
+      # Entries of the connectivity array are in the same order as the cells
+      groupEntryIndices = np.nonzero(entryGroupIds == groupId)[0]
+      groupPointIds, groupConnectivity = np.unique(connectivity[groupEntryIndices], return_inverse=True)
+      groupOffsets = np.concatenate([[0], np.cumsum(np.diff(offsets)[groupCellIds])])
+      groupPoints = vtk.vtkPoints()
+      groupPoints.SetData(numpy_support.numpy_to_vtk(points[groupPointIds], deep=1))
+      componentPd = vtk.vtkPolyData()
+      componentPd.SetPoints(groupPoints)
+      componentPd.SetPolys(WrapSolidifyLogic._numpyToCellArray(groupOffsets, groupConnectivity))
+      componentPds.append(componentPd)
+
+    logging.info("Wrap solidify: {0} input components in {1} groups".format(numberOfComponents, len(componentPds)))
+    if not componentPds:
+      return [self._inputPd]
+    return componentPds
+
+  def _shrinkWrapComponents(self, componentPds):
+    """Shrinkwrap each input component separately, on a grid that only covers the component.
+    Components are processed concurrently, except when intermediate results are saved
+    (intermediate result nodes can only be created in the main thread). Returns the merged result.
+    """
+    def shrinkWrapComponent(componentPd):
+      # Use a copy of this logic that only sees this component as input
+      componentLogic = copy.copy(self)
+      componentLogic._parentLogic = self
+      componentLogic.progressCallback = None
+      componentLogic._numberOfProgressSteps = 0
+      componentLogic._inputPd = componentPd
+      componentLogic._inputDistanceMap = None
+      componentLogic._inputDistanceMapMargin = 0
+      componentLogic.splitComponents = False
+      # Warm start state belongs to the whole input, it must not be used or modified by components
+      componentLogic.warmStart = False
+      componentLogic._warmStartState = None
+      componentShrunkenPd = vtk.vtkPolyData()
+      componentLogic._computeStage('shrinkWrap', componentShrunkenPd)
+      return componentShrunkenPd
+
+    numberOfWorkers = self.numberOfThreads if self.numberOfThreads > 0 else (os.cpu_count() or 1)
+    numberOfWorkers = min(numberOfWorkers, len(componentPds))
+    if self.saveIntermediateResults or numberOfWorkers < 2:
+      shrunkenPds = [shrinkWrapComponent(componentPd) for componentPd in componentPds]
+    else:
+      import concurrent.futures
+      with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+        futures = [executor.submit(shrinkWrapComponent, componentPd) for componentPd in componentPds]
+        shrunkenPds = [future.result() for future in futures]
+
+    appendFilter = vtk.vtkAppendPolyData()
+    for shrunkenPd in shrunkenPds:
+      appendFilter.AddInputData(shrunkenPd)
+    appendFilter.Update()
+    return appendFilter.GetOutput()
+
+  def _getLargestCavityPd(self, shrunkenPd, splitCavitiesDiameter=None):
+    """Get the largest internal cavity of the input inside the outer surface (shrunkenPd).
+    If splitCavitiesDiameter is specified then cavities that are connected by openings smaller than this size are separated.
+    """
+    with self._instrumentStage('labelCavities', shrunkenPd) as record:
+      cavityLabelmap, cavityLabels, cavitySizes = self._labelCavities(shrunkenPd, splitCavitiesDiameter)
+      record['voxels'] = cavityLabelmap.GetNumberOfPoints()
+    if len(cavitySizes) == 0:
+      raise ValueError("No internal cavity is found")
+
+    # Reuse the cavity labelmap buffer for the mask: 1 in the largest cavity, 0 elsewhere.
+    # The surface of label 0 (everything except the cavity) is extracted, so that the surface is oriented
+    # the same way relative to the object wall as the outer surface (shell offset direction means the same side).
+    cavityVoxels = numpy_support.vtk_to_numpy(cavityLabelmap.GetPointData().GetScalars())
+    np.equal(cavityLabels, 1, out=cavityVoxels.view(np.bool_))
+    cavityLabelmap.GetPointData().GetScalars().Modified()
 
     # Convert back to polydata
     initialRegionPd = vtk.vtkPolyData()
-    initialRegionPd.DeepCopy(WrapSolidifyLogic._labelmapToPolydata(largestHolesLabelmap, 0))
+    initialRegionPd.DeepCopy(WrapSolidifyLogic._labelmapToPolydata(cavityLabelmap, 0, self.isoSurfaceEngine, self.smoothingFactor))
     self._saveIntermediateResult("SplitCavitiesLargest", initialRegionPd)
+    return initialRegionPd
 
-    if self.splitCavities:
-      return self._shrinkWrap(initialRegionPd)
+  def _labelCavities(self, shrunkenPd, splitCavitiesDiameter=None):
+    """Find all internal cavities of the input inside the outer surface (shrunkenPd).
+    Returns a uint8 labelmap (0 in cavities, 1 elsewhere) that the caller may overwrite,
+    cavity labels as a numpy array (label 1 is the largest cavity, 2 is the second largest, etc.),
+    and the number of voxels in each cavity (in the same order as the labels).
+    """
+
+    if splitCavitiesDiameter:
+      # It is less accurate but more robust to dilate labelmap than grow polydata.
+      # Since accuracy is not important here, we dilate labelmap.
+      # extendedInputLabelmap: 255 near original inputLabelmap voxels, 0 elsewhere
+      extendedInputLabelmap = self._getDilatedInputLabelmap(splitCavitiesDiameter / 2.0)
+      self._saveIntermediateResult("SplitCavitiesGrown",
+                                   WrapSolidifyLogic._labelmapToPolydata(extendedInputLabelmap, 255, self.isoSurfaceEngine))
+      outsideObjectLabelmap = WrapSolidifyLogic._polydataToLabelmap(shrunkenPd, referenceImage=extendedInputLabelmap,
+        numberOfThreads=self.numberOfThreads)  # 0=outside, 1=inside
     else:
-      return initialRegionPd
+      spacing = self._getGridSpacing(self._inputSpacing / self.remeshOversampling)
+      outsideObjectLabelmap = WrapSolidifyLogic._polydataToLabelmap(shrunkenPd, spacing,
+        numberOfThreads=self.numberOfThreads)  # 0=outside, 1=inside
+      extendedInputLabelmap = WrapSolidifyLogic._polydataToLabelmap(self._inputPd, referenceImage=outsideObjectLabelmap,
+        numberOfThreads=self.numberOfThreads)
+
+    # Combine the labelmaps in place, in the buffer of outsideObjectLabelmap (uint8, not shared with any other image):
+    # internal holes are 0, elsewhere >=1
+    outsideObjectVoxels = numpy_support.vtk_to_numpy(outsideObjectLabelmap.GetPointData().GetScalars())
+    extendedInputVoxels = numpy_support.vtk_to_numpy(extendedInputLabelmap.GetPointData().GetScalars())
+    np.bitwise_xor(outsideObjectVoxels, 1, out=outsideObjectVoxels)  # invert: 1 outside the object, 0 inside
+    np.maximum(outsideObjectVoxels, extendedInputVoxels, out=outsideObjectVoxels)
+    outsideObjectLabelmap.GetPointData().GetScalars().Modified()
+    internalHolesLabelmap = outsideObjectLabelmap
+    self._saveIntermediateResult("SplitCavitiesAll", WrapSolidifyLogic._labelmapToPolydata(internalHolesLabelmap, 0, self.isoSurfaceEngine))
+
+    # Label all internal holes in a single pass. Labels are assigned by decreasing size.
+    holeLabeler = vtk.vtkImageConnectivityFilter()
+    holeLabeler.SetScalarRange(-0.5, 0.5)
+    holeLabeler.SetInputData(internalHolesLabelmap)
+    holeLabeler.SetExtractionModeToAllRegions()
+    holeLabeler.SetLabelModeToSizeRank()
+    holeLabeler.SetLabelScalarTypeToUnsignedShort()
+    holeLabeler.Update()
+    cavityLabels = numpy_support.vtk_to_numpy(holeLabeler.GetOutput().GetPointData().GetScalars())
+    regionLabels = numpy_support.vtk_to_numpy(holeLabeler.GetExtractedRegionLabels())
+    cavitySizes = numpy_support.vtk_to_numpy(holeLabeler.GetExtractedRegionSizes()).astype(np.int64)
+    cavitySizes = cavitySizes[np.argsort(regionLabels, kind='stable')]
+
+    return internalHolesLabelmap, cavityLabels, cavitySizes
 
   @staticmethod
-  def _polydataToSegment(polydata, segmentationNode, segmentID):
+  def _polydataToSegment(polydata, segmentationNode, segmentID, updateRepresentations=True):
+    """Replace the segment content by the polydata. If updateRepresentations is False then
+    the segment only contains the closed surface representation until its representations are updated.
+    """
     # Get existing representations
     segmentation = segmentationNode.GetSegmentation()
     try:
@@ -649,33 +2251,54 @@ class WrapSolidifyLogic(object):
     segment = segmentation.GetSegment(segmentID)
     segment.RemoveAllRepresentations()
     segment.AddRepresentation(vtkSegmentationCorePython.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName(), polydata)
-    segmentation.CreateRepresentation(masterRepresentationName)
-    for representationName in representationNames:
-      if representationName:
-        # already converted
-        continue
-      segmentation.CreateRepresentation(representationName)
+    if updateRepresentations:
+      # Only convert the modified segment
+      for representationName in [masterRepresentationName] + representationNames:
+        if segment.GetRepresentation(representationName):
+          # already converted
+          continue
+        segmentation.ConvertSingleSegment(segmentID, representationName)
     segmentationNode.EndModify(wasModified)
 
   @staticmethod
-  def _polydataToNewSegment(polydata, segmentationNode, segmentID):
+  def _polydataToNewSegment(polydata, segmentationNode, segmentID, nameSuffix="_solid"):
     segmentation = segmentationNode.GetSegmentation()
     baseSegment = segmentation.GetSegment(segmentID)
     segment = slicer.vtkSegment()
-    segment.SetName(baseSegment.GetName() + "_solid")
+    segment.SetName(baseSegment.GetName() + nameSuffix)
     segment.AddRepresentation(vtkSegmentationCorePython.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName(), polydata)
     segmentation.AddSegment(segment)
+    return segmentation.GetSegmentIdBySegment(segment)
 
   def _saveIntermediateResult(self, name, polydata, color=None):
     if not self.saveIntermediateResults:
       return
 
+    polyDataCopy = vtk.vtkPolyData()
+    polyDataCopy.DeepCopy(polydata)
+
+    if self._backgroundThread is threading.current_thread():
+      # Nodes can only be created in the main thread
+      with self._pendingIntermediateResultsLock:
+        self._pendingIntermediateResults.append((name, polyDataCopy, color))
+      return
+
+    self._addIntermediateResultModel(name, polyDataCopy, color)
+
+  def processPendingIntermediateResults(self):
+    """Add intermediate results that were saved in the background thread to the scene"""
+    with self._pendingIntermediateResultsLock:
+      pendingIntermediateResults = self._pendingIntermediateResults
+      self._pendingIntermediateResults = []
+    for name, polydata, color in pendingIntermediateResults:
+      self._addIntermediateResultModel(name, polydata, color)
+
+  def _addIntermediateResultModel(self, name, polyDataCopy, color):
+
     # Show the last intermediate result only, hide previous
     if self.previousIntermediateResult:
       self.previousIntermediateResult.GetDisplayNode().SetVisibility(False)
 
-    polyDataCopy = vtk.vtkPolyData()
-    polyDataCopy.DeepCopy(polydata)
     outputModel = slicer.modules.models.logic().AddModel(polyDataCopy)
     outputModel.SetName("WrapSolidify-{0}-{1}".format(self.intermediateResultCounter, name))
     self.intermediateResultCounter += 1
@@ -689,62 +2312,145 @@ class WrapSolidifyLogic(object):
     self.previousIntermediateResult = outputModel
 
   @staticmethod
-  def _polydataToLabelmap(polydata, spacing = 1.0, extraMarginToBounds = 0, referenceImage = None):
+  def _getLabelmapGeometry(polydata, spacing = 1.0, extraMarginToBounds = 0):
+    """Get origin, spacing, and extent of a labelmap that fully contains the polydata"""
+    bounds = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    polydata.GetBounds(bounds)
+    bounds[0] -= extraMarginToBounds
+    bounds[2] -= extraMarginToBounds
+    bounds[4] -= extraMarginToBounds
+    bounds[1] += extraMarginToBounds
+    bounds[3] += extraMarginToBounds
+    bounds[5] += extraMarginToBounds
+
+    spacing3 = np.ones(3) * spacing
+    dim = [0, 0, 0]
+    for i in range(3):
+      # Add 3 to the dimensions to have at least 1 voxel thickness and 1 voxel margin on both sides
+      dim[i] = int(math.ceil((bounds[i * 2 + 1] - bounds[i * 2]) / spacing3[i])) + 3
+
+    # Subtract one spacing to ensure there is a margin
+    origin = [
+      bounds[0] - spacing3[0],
+      bounds[2] - spacing3[1],
+      bounds[4] - spacing3[2]]
+
+    extent = [0, dim[0] - 1, 0, dim[1] - 1, 0, dim[2] - 1]
+    return origin, spacing3, extent
 
-    binaryLabelmap = vtk.vtkImageData()
+  @staticmethod
+  def _polydataToLabelmap(polydata, spacing = 1.0, extraMarginToBounds = 0, referenceImage = None, numberOfThreads = 1):
 
     if referenceImage:
       origin = referenceImage.GetOrigin()
       spacing3 = referenceImage.GetSpacing()
       extent = referenceImage.GetExtent()
     else:
-      bounds = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-      polydata.GetBounds(bounds)
-      bounds[0] -= extraMarginToBounds
-      bounds[2] -= extraMarginToBounds
-      bounds[4] -= extraMarginToBounds
-      bounds[1] += extraMarginToBounds
-      bounds[3] += extraMarginToBounds
-      bounds[5] += extraMarginToBounds
-
-      spacing3 = np.ones(3) * spacing
-      dim = [0, 0, 0]
-      for i in range(3):
-        # Add 3 to the dimensions to have at least 1 voxel thickness and 1 voxel margin on both sides
-        dim[i] = int(math.ceil((bounds[i * 2 + 1] - bounds[i * 2]) / spacing3[i])) + 3
-
-      # Subtract one spacing to ensure there is a margin
-      origin = [
-        bounds[0] - spacing3[0],
-        bounds[2] - spacing3[1],
-        bounds[4] - spacing3[2]]
-
-      extent = [0, dim[0] - 1, 0, dim[1] - 1, 0, dim[2] - 1]
+      origin, spacing3, extent = WrapSolidifyLogic._getLabelmapGeometry(polydata, spacing, extraMarginToBounds)
 
-    binaryLabelmap.SetOrigin(origin)
-    binaryLabelmap.SetSpacing(spacing3)
-    binaryLabelmap.SetExtent(extent)
-
-    binaryLabelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
-    binaryLabelmap.GetPointData().GetScalars().Fill(0)
+    if numberOfThreads <= 0:
+      numberOfThreads = os.cpu_count() or 1
+    if numberOfThreads > 1 and extent[5] > extent[4]:
+      return WrapSolidifyLogic._polydataToLabelmapParallel(polydata, origin, spacing3, extent, numberOfThreads)
 
     pol2stenc = vtk.vtkPolyDataToImageStencil()
     pol2stenc.SetInputData(polydata)
     pol2stenc.SetOutputOrigin(origin)
     pol2stenc.SetOutputSpacing(spacing3)
-    pol2stenc.SetOutputWholeExtent(binaryLabelmap.GetExtent())
+    pol2stenc.SetOutputWholeExtent(extent)
 
-    imgstenc = vtk.vtkImageStencil()
-    imgstenc.SetInputData(binaryLabelmap)
-    imgstenc.SetStencilConnection(pol2stenc.GetOutputPort())
-    imgstenc.ReverseStencilOn()
-    imgstenc.SetBackgroundValue(1)
-    imgstenc.Update()
+    # Only the output labelmap is allocated (no input image is needed to be filled by the stencil)
+    stencilToImage = vtk.vtkImageStencilToImage()
+    stencilToImage.SetInputConnection(pol2stenc.GetOutputPort())
+    stencilToImage.SetInsideValue(1)
+    stencilToImage.SetOutsideValue(0)
+    stencilToImage.SetOutputScalarTypeToUnsignedChar()
+    stencilToImage.Update()
 
-    return imgstenc.GetOutput()
+    return stencilToImage.GetOutput()
 
   @staticmethod
-  def _labelmapToPolydata(labelmap, value=1):
+  def _polydataToLabelmapParallel(polydata, origin, spacing3, extent, numberOfThreads):
+    """Rasterize polydata by splitting the extent into z-slabs that are filled concurrently.
+    vtkPolyDataToImageStencil cuts the polydata independently at each slice,
+    therefore the result is the same as rasterizing the whole extent at once.
+    """
+    import concurrent.futures
+
+    binaryLabelmap = vtk.vtkImageData()
+    binaryLabelmap.SetOrigin(origin)
+    binaryLabelmap.SetSpacing(spacing3)
+    binaryLabelmap.SetExtent(extent)
+    binaryLabelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    dimensions = binaryLabelmap.GetDimensions()
+    voxels = numpy_support.vtk_to_numpy(binaryLabelmap.GetPointData().GetScalars()).reshape(
+      dimensions[2], dimensions[1], dimensions[0])
+
+    numberOfSlabs = min(numberOfThreads, dimensions[2])
+    slabBoundaries = np.linspace(0, dimensions[2], numberOfSlabs + 1).astype(int)
+
+    def rasterizeSlab(slabPolydata, slabStart, slabEnd):
+      slabExtent = [extent[0], extent[1], extent[2], extent[3], extent[4] + slabStart, extent[4] + slabEnd - 1]
+
+      pol2stenc = vtk.vtkPolyDataToImageStencil()
+      pol2stenc.SetInputData(slabPolydata)
+      pol2stenc.SetOutputOrigin(origin)
+      pol2stenc.SetOutputSpacing(spacing3)
+      pol2stenc.SetOutputWholeExtent(slabExtent)
+
+      stencilToImage = vtk.vtkImageStencilToImage()
+      stencilToImage.SetInputConnection(pol2stenc.GetOutputPort())
+      stencilToImage.SetInsideValue(1)
+      stencilToImage.SetOutsideValue(0)
+      stencilToImage.SetOutputScalarTypeToUnsignedChar()
+
+      # The output scalars are a zero-copy view of this slab of the shared labelmap. The filter reuses
+      # output scalars of the right type and size, therefore it writes directly into the shared labelmap.
+      slabVoxels = voxels[slabStart:slabEnd]
+      slabLabelmap = stencilToImage.GetOutput()
+      slabLabelmap.SetExtent(slabExtent)
+      slabLabelmap.GetPointData().SetScalars(numpy_support.numpy_to_vtk(slabVoxels.ravel(), deep=False))
+      stencilToImage.Update()
+
+      slabScalars = numpy_support.vtk_to_numpy(stencilToImage.GetOutput().GetPointData().GetScalars())
+      if slabScalars.ctypes.data != slabVoxels.ctypes.data:
+        # Output scalars have been reallocated by the filter, copy the result
+        slabVoxels[:] = slabScalars.reshape(slabVoxels.shape)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfSlabs) as executor:
+      futures = []
+      for slabIndex in range(numberOfSlabs):
+        # Each thread uses its own polydata object (sharing the same arrays), because the stencil filter
+        # builds cell links in its input
+        slabPolydata = vtk.vtkPolyData()
+        slabPolydata.ShallowCopy(polydata)
+        futures.append(executor.submit(rasterizeSlab, slabPolydata, slabBoundaries[slabIndex], slabBoundaries[slabIndex + 1]))
+      for future in futures:
+        future.result()
+
+    binaryLabelmap.GetPointData().GetScalars().Modified()
+    return binaryLabelmap
+
+  @staticmethod
+  def _labelmapToPolydata(labelmap, value=1, isoSurfaceEngine=None, smoothingFactor=None):
+    if isoSurfaceEngine == ISO_SURFACE_ENGINE_SURFACE_NETS:
+      return WrapSolidifyLogic._labelmapToPolydataSurfaceNets(labelmap, value, smoothingFactor)
+
+    if isoSurfaceEngine == ISO_SURFACE_ENGINE_DISCRETE_FLYING_EDGES:
+      # Multi-threaded (SMP) surface extraction
+      flyingEdges = vtk.vtkDiscreteFlyingEdges3D()
+      flyingEdges.SetInputData(labelmap)
+      flyingEdges.SetValue(0, value)
+      flyingEdges.ComputeNormalsOff()
+      flyingEdges.ComputeGradientsOff()
+      flyingEdges.ComputeScalarsOff()
+      flyingEdges.Update()
+      surfacePd = flyingEdges.GetOutput()
+      # Triangles follow the same orientation convention as marching cubes, therefore they are reversed
+      # the same way as the marching cubes output below.
+      WrapSolidifyLogic._reverseTriangles(surfacePd)
+      return surfacePd
+
     discreteCubes = vtk.vtkDiscreteMarchingCubes()
     discreteCubes.SetInputData(labelmap)
     discreteCubes.SetValue(0, value)
@@ -758,9 +2464,177 @@ class WrapSolidifyLogic(object):
     return reverse.GetOutput()
 
   @staticmethod
-  def _remeshPolydata(polydata, spacing):
-    labelmap = WrapSolidifyLogic._polydataToLabelmap(polydata, spacing)
-    return WrapSolidifyLogic._labelmapToPolydata(labelmap)
+  def _labelmapToPolydataSurfaceNets(labelmap, value=1, smoothingFactor=None):
+    """Extract a smooth surface using constrained surface nets.
+    Points are smoothed but kept within their voxel, therefore the surface remains close to the labelmap boundary.
+    smoothingFactor (0..1) sets the number of smoothing iterations: 0 disables smoothing,
+    the default smoothing factor (0.2) corresponds to the VTK default number of iterations.
+    If smoothingFactor is None then VTK defaults are used.
+    """
+    if not hasattr(vtk, 'vtkSurfaceNets3D'):
+      raise ValueError("Surface nets surface extraction requires VTK 9.3 or later")
+
+    if value != 1:
+      # Surface nets extract the boundary between the label and the background (0), therefore create a binary labelmap
+      threshold = vtk.vtkImageThreshold()
+      threshold.SetInputData(labelmap)
+      threshold.ThresholdBetween(value, value)
+      threshold.SetInValue(1)
+      threshold.SetOutValue(0)
+      threshold.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+      threshold.Update()
+      labelmap = threshold.GetOutput()
+
+    surfaceNets = vtk.vtkSurfaceNets3D()
+    surfaceNets.SetInputData(labelmap)
+    surfaceNets.SetValue(0, 1)
+    surfaceNets.SetBackgroundLabel(0)
+    surfaceNets.SetOutputMeshTypeToTriangles()
+    if smoothingFactor is not None and smoothingFactor <= 0:
+      surfaceNets.SmoothingOff()
+    else:
+      surfaceNets.SmoothingOn()
+      if smoothingFactor is not None:
+        surfaceNets.SetNumberOfIterations(max(1, int(round(smoothingFactor * SURFACE_NETS_ITERATIONS_PER_SMOOTHING_FACTOR))))
+    surfaceNets.Update()
+    surfacePd = surfaceNets.GetOutput()
+
+    # Triangles of all surfaces (including nested inner surfaces) are oriented consistently,
+    # in the opposite direction as the marching cubes output. Reverse them to match.
+    WrapSolidifyLogic._reverseTriangles(surfacePd)
+    return surfacePd
+
+  @staticmethod
+  def _reverseTriangles(polydata):
+    """Reverse orientation of all triangles in place by swapping two vertices of each triangle.
+    This is much faster than vtkReverseSense. Polydata must contain only triangles.
+    """
+    if polydata.GetNumberOfPolys() == 0:
+      return
+    connectivity = numpy_support.vtk_to_numpy(polydata.GetPolys().GetConnectivityArray())
+    triangles = connectivity.reshape(-1, 3)
+    triangles[:, [1, 2]] = triangles[:, [2, 1]]
+    polydata.GetPolys().Modified()
+
+  @staticmethod
+  def _remeshPolydata(polydata, spacing, narrowBand=False, isoSurfaceEngine=None, numberOfThreads=1, smoothingFactor=None):
+    # Surface nets smoothing is not local to a block, therefore narrow-band extraction is not used in that mode
+    if narrowBand and isoSurfaceEngine != ISO_SURFACE_ENGINE_SURFACE_NETS:
+      return WrapSolidifyLogic._remeshPolydataNarrowBand(polydata, spacing, isoSurfaceEngine=isoSurfaceEngine)
+    labelmap = WrapSolidifyLogic._polydataToLabelmap(polydata, spacing, numberOfThreads=numberOfThreads)
+    return WrapSolidifyLogic._labelmapToPolydata(labelmap, isoSurfaceEngine=isoSurfaceEngine, smoothingFactor=smoothingFactor)
+
+  @staticmethod
+  def _remeshPolydataNarrowBand(polydata, spacing, blockSize=64, isoSurfaceEngine=None):
+    """Remesh polydata by rasterizing and extracting the surface only in blocks that the surface passes through.
+    The stencil (run-length encoded, therefore small) is computed for the whole extent, but labelmap voxels
+    are only allocated for one block at a time. The result is the same surface as the one
+    extracted from the full-size labelmap.
+    """
+    origin, spacing3, extent = WrapSolidifyLogic._getLabelmapGeometry(polydata, spacing)
+
+    pol2stenc = vtk.vtkPolyDataToImageStencil()
+    pol2stenc.SetInputData(polydata)
+    pol2stenc.SetOutputOrigin(origin)
+    pol2stenc.SetOutputSpacing(spacing3)
+    pol2stenc.SetOutputWholeExtent(extent)
+    pol2stenc.Update()
+    stencil = pol2stenc.GetOutput()
+
+    # Get bounding box of each cell in voxel coordinates
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    offsets, connectivity = WrapSolidifyLogic._cellArrayToNumpy(polydata.GetPolys())
+    if len(connectivity) == 0:
+      return vtk.vtkPolyData()
+    pointsIjk = (points - np.array(origin)) / spacing3
+    cellMinIjk = np.minimum.reduceat(pointsIjk[connectivity], offsets[:-1])
+    cellMaxIjk = np.maximum.reduceat(pointsIjk[connectivity], offsets[:-1])
+
+    # Rasterized surface is within one voxel of the surface, a cell must not span more than two blocks
+    cellMinIjk -= 1.5
+    cellMaxIjk += 1.5
+    blockSize = max(blockSize, int(math.ceil(np.max(cellMaxIjk - cellMinIjk))) + 1)
+
+    # Find all blocks that are touched by a cell bounding box
+    dimensions = np.array([extent[1] + 1, extent[3] + 1, extent[5] + 1])
+    numberOfBlocks = (dimensions - 1 + blockSize - 1) // blockSize
+    cellMinBlocks = np.clip(np.floor(cellMinIjk / blockSize).astype(np.int64), 0, numberOfBlocks - 1)
+    cellMaxBlocks = np.clip(np.floor(cellMaxIjk / blockSize).astype(np.int64), 0, numberOfBlocks - 1)
+    activeBlocks = np.unique(np.vstack([
+      np.column_stack([
+        cellMaxBlocks[:, 0] if useMaxI else cellMinBlocks[:, 0],
+        cellMaxBlocks[:, 1] if useMaxJ else cellMinBlocks[:, 1],
+        cellMaxBlocks[:, 2] if useMaxK else cellMinBlocks[:, 2]])
+      for useMaxI in [False, True] for useMaxJ in [False, True] for useMaxK in [False, True]]), axis=0)
+
+    # Extract surface from each block. Neighbor blocks share one layer of voxels, therefore each
+    # marching cube is processed in exactly one block.
+    appendPolyData = vtk.vtkAppendPolyData()
+    for block in activeBlocks:
+      blockExtent = [0, 0, 0, 0, 0, 0]
+      for i in range(3):
+        blockExtent[i * 2] = int(block[i] * blockSize)
+        blockExtent[i * 2 + 1] = int(min((block[i] + 1) * blockSize, dimensions[i] - 1))
+      blockLabelmap = vtk.vtkImageData()
+      blockLabelmap.SetOrigin(origin)
+      blockLabelmap.SetSpacing(spacing3)
+      blockLabelmap.SetExtent(blockExtent)
+      blockLabelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+      blockLabelmap.GetPointData().GetScalars().Fill(0)
+
+      imgstenc = vtk.vtkImageStencil()
+      imgstenc.SetInputData(blockLabelmap)
+      imgstenc.SetStencilData(stencil)
+      imgstenc.ReverseStencilOn()
+      imgstenc.SetBackgroundValue(1)
+      imgstenc.Update()
+
+      blockPd = WrapSolidifyLogic._labelmapToPolydata(imgstenc.GetOutput(), isoSurfaceEngine=isoSurfaceEngine)
+      if blockPd.GetNumberOfCells() > 0:
+        appendPolyData.AddInputData(blockPd)
+
+    if appendPolyData.GetNumberOfInputConnections(0) == 0:
+      return vtk.vtkPolyData()
+
+    # Merge points that are duplicated along block boundaries
+    cleanPolyData = vtk.vtkCleanPolyData()
+    cleanPolyData.SetInputConnection(appendPolyData.GetOutputPort())
+    cleanPolyData.PointMergingOn()
+    cleanPolyData.SetTolerance(0.0)
+    cleanPolyData.Update()
+    return cleanPolyData.GetOutput()
+
+  @staticmethod
+  def _cellArrayToNumpy(cellArray):
+    """Get offsets and connectivity of a vtkCellArray as int64 numpy arrays"""
+    offsets = numpy_support.vtk_to_numpy(cellArray.GetOffsetsArray()).astype(np.int64)
+    connectivity = numpy_support.vtk_to_numpy(cellArray.GetConnectivityArray()).astype(np.int64)
+    return offsets, connectivity
+
+  @staticmethod
+  def _numpyToCellArray(offsets, connectivity):
+    """Create a vtkCellArray from offsets and connectivity numpy arrays"""
+    cellArray = vtk.vtkCellArray()
+    cellArray.SetData(
+      numpy_support.numpy_to_vtk(offsets, deep=1, array_type=vtk.VTK_ID_TYPE),
+      numpy_support.numpy_to_vtk(connectivity, deep=1, array_type=vtk.VTK_ID_TYPE))
+    return cellArray
+
+  @staticmethod
+  def _pointDistancesToSurface(points, surfacePd):
+    """Get signed distance of all points from the surface as a numpy array, computed in a single batch"""
+    implicitDistance = vtk.vtkImplicitPolyDataDistance()
+    implicitDistance.SetInput(surfacePd)
+    distances = vtk.vtkDoubleArray()
+    implicitDistance.FunctionValue(points.GetData(), distances)
+    return numpy_support.vtk_to_numpy(distances)
+
+  @staticmethod
+  def _surfaceDistance(polydata1, polydata2):
+    """Get symmetric mean absolute distance between two surfaces (larger of the two directed mean distances)"""
+    distance1 = np.mean(np.abs(WrapSolidifyLogic._pointDistancesToSurface(polydata1.GetPoints(), polydata2)))
+    distance2 = np.mean(np.abs(WrapSolidifyLogic._pointDistancesToSurface(polydata2.GetPoints(), polydata1)))
+    return max(distance1, distance2)
 
   @staticmethod
   def _smoothPolydata(polydata, smoothingFactor):
@@ -779,30 +2653,28 @@ class WrapSolidifyLogic(object):
   def _shellPreserveCracks(self, shrunkenPd):
     """Remove cells of the mesh that are far from the original surface"""
 
-    # Cells that are far from the input mesh will be removed from this
-    shrunkenPdWithCracks = vtk.vtkPolyData()
-    shrunkenPdWithCracks.DeepCopy(shrunkenPd)
-    shrunkenPdWithCracks.BuildLinks()
-
-    # Measure distance from input mesh
-    implicitDistance = vtk.vtkImplicitPolyDataDistance()
-    implicitDistance.SetInput(self._inputPd)
-
     # Determine cutoff distance
     spacing = self._inputSpacing / self.remeshOversampling
     maxDistance = 0.9 * spacing  # 0.9 because it is a bit more than half diameter of a cube (0.5*sqrt(3))
 
-    numberOfCells = shrunkenPdWithCracks.GetNumberOfCells()
-    for c in range(numberOfCells):
-      cell = shrunkenPdWithCracks.GetCell(c)
-      points = cell.GetPoints()
-      for p in range(points.GetNumberOfPoints()):
-        point = points.GetPoint(p)
-        distance = implicitDistance.EvaluateFunction(point)  # TODO: check if cell locator is faster
-        if abs(distance) > maxDistance:
-          shrunkenPdWithCracks.DeleteCell(c)
-          break
-    shrunkenPdWithCracks.RemoveDeletedCells()
+    # Measure distance of each point from input mesh (each point is evaluated once)
+    pointDistances = WrapSolidifyLogic._pointDistancesToSurface(shrunkenPd.GetPoints(), self._inputPd)
+    farPoints = (np.abs(pointDistances) > maxDistance)
+
+    # Cells that have any point far from the input mesh are removed
+    offsets, connectivity = WrapSolidifyLogic._cellArrayToNumpy(shrunkenPd.GetPolys())
+    cellSizes = np.diff(offsets)
+    entryCellIds = np.repeat(np.arange(len(cellSizes)), cellSizes)
+    keepCells = (np.bincount(entryCellIds, weights=farPoints[connectivity], minlength=len(cellSizes)) == 0)
+    keepEntries = keepCells[entryCellIds]
+    keptOffsets = np.concatenate([[0], np.cumsum(cellSizes[keepCells])])
+
+    shrunkenPdWithCracks = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.DeepCopy(shrunkenPd.GetPoints())
+    shrunkenPdWithCracks.SetPoints(points)
+    shrunkenPdWithCracks.GetPointData().DeepCopy(shrunkenPd.GetPointData())
+    shrunkenPdWithCracks.SetPolys(WrapSolidifyLogic._numpyToCellArray(keptOffsets, connectivity[keepEntries]))
 
     return shrunkenPdWithCracks
 
@@ -823,113 +2695,203 @@ class WrapSolidifyLogic(object):
       normals.FlipNormalsOn()
     normals.Update()
 
-    surfacePd = vtk.vtkPolyData()
-    surfacePd.DeepCopy(normals.GetOutput())
+    surfacePd = normals.GetOutput()
     numberOfPoints = surfacePd.GetNumberOfPoints()
 
-    # get boundary edges, used later
-    featureEdges = vtk.vtkFeatureEdges()
-    featureEdges.BoundaryEdgesOn()
-    featureEdges.ColoringOff()
-    featureEdges.FeatureEdgesOff()
-    featureEdges.NonManifoldEdgesOff()
-    featureEdges.ManifoldEdgesOff()
-    featureEdges.SetInputData(normals.GetOutput())
-    featureEdges.Update()
-
-    addingPoints = []
-    addingPolys = []
-
-    allNormalsArray = surfacePd.GetCellData().GetArray('Normals')
-
-    for pointID in range(numberOfPoints):
-      cellIDs = vtk.vtkIdList()
-      surfacePd.GetPointCells(pointID, cellIDs)
-      normalsArray = []
-
-      # ilterate through all cells/faces which contain point
-      for i in range(cellIDs.GetNumberOfIds()):
-        n = allNormalsArray.GetTuple3(cellIDs.GetId(i))
-        normalsArray.append(np.array(n))
+    points = numpy_support.vtk_to_numpy(surfacePd.GetPoints().GetData())
+    offsets, connectivity = WrapSolidifyLogic._cellArrayToNumpy(surfacePd.GetPolys())
+    numberOfPolys = len(offsets) - 1
+    firstPolyCellId = surfacePd.GetNumberOfVerts() + surfacePd.GetNumberOfLines()
+    polyNormals = numpy_support.vtk_to_numpy(surfacePd.GetCellData().GetArray('Normals'))
+    polyNormals = polyNormals[firstPolyCellId:firstPolyCellId + numberOfPolys].astype(np.float64)
+
+    cellStarts = offsets[:-1]
+    cellEnds = offsets[1:]
+    entryIndices = np.arange(len(connectivity))
+    entryCellIds = np.repeat(np.arange(numberOfPolys), cellEnds - cellStarts)
+
+    # calculate position of new verts: sum of the normals of all cells/faces which contain the point,
+    # scaled by its projection to the normal of the first cell that contains the point
+    directions = np.zeros((numberOfPoints, 3))
+    for axis in range(3):
+      directions[:, axis] = np.bincount(connectivity, weights=polyNormals[entryCellIds, axis], minlength=numberOfPoints)
+    directionLengths = np.linalg.norm(directions, axis=1)
+    directionLengths[directionLengths == 0] = 1.0  # point is not used by any cell, do not move it
+    directions /= directionLengths[:, np.newaxis]
+    # cell IDs are increasing along the connectivity array, therefore the first occurrence belongs to the first cell
+    firstCellIds = np.zeros(numberOfPoints, dtype=np.int64)
+    usedPointIds, firstEntryIndices = np.unique(connectivity, return_index=True)
+    firstCellIds[usedPointIds] = entryCellIds[firstEntryIndices]
+    projectionLengths = np.einsum('ij,ij->i', directions, polyNormals[firstCellIds])
+    offsetPoints = points + directions * (projectionLengths * shellThickness)[:, np.newaxis]
+
+    # cells of the offset layer contain the corresponding points in reversed order
+    reversedEntryIndices = cellStarts[entryCellIds] + cellEnds[entryCellIds] - 1 - entryIndices
+    reversedConnectivity = connectivity[reversedEntryIndices] + numberOfPoints
+
+    # add faces to boundary edges (edges that belong to exactly one cell)
+    nextEntryIndices = entryIndices + 1
+    nextEntryIndices[cellEnds - 1] = cellStarts
+    edgeStartPointIds = connectivity
+    edgeEndPointIds = connectivity[nextEntryIndices]
+    edgeKeys = (np.minimum(edgeStartPointIds, edgeEndPointIds) * numberOfPoints
+      + np.maximum(edgeStartPointIds, edgeEndPointIds))
+    _, edgeIndices, edgeCounts = np.unique(edgeKeys, return_inverse=True, return_counts=True)
+    boundaryEdges = (edgeCounts[edgeIndices] == 1)
+    boundaryStartPointIds = edgeStartPointIds[boundaryEdges]
+    boundaryEndPointIds = edgeEndPointIds[boundaryEdges]
+    sideConnectivity = np.column_stack([
+      boundaryEndPointIds,
+      boundaryStartPointIds,
+      boundaryStartPointIds + numberOfPoints,
+      boundaryEndPointIds + numberOfPoints]).ravel()
 
-      # calculate position of new vert
-      dir_vec = np.zeros(3)
-
-      for n in normalsArray:
-        dir_vec = dir_vec + np.array(n)
+    manifoldPoints = vtk.vtkPoints()
+    manifoldPoints.SetData(numpy_support.numpy_to_vtk(np.vstack([points, offsetPoints.astype(points.dtype)]), deep=1))
+    manifoldOffsets = np.concatenate([
+      offsets,
+      offsets[1:] + len(connectivity),
+      2 * len(connectivity) + 4 * np.arange(1, len(boundaryStartPointIds) + 1)])
+    manifoldConnectivity = np.concatenate([connectivity, reversedConnectivity, sideConnectivity])
 
-      dir_vec_norm = dir_vec / np.linalg.norm(dir_vec)
-      proj_length = np.dot(dir_vec_norm, np.array(normalsArray[0]))
-      dir_vec_finallenght = dir_vec_norm * proj_length
-      vertex_neu = np.array(surfacePd.GetPoint(pointID)) + (dir_vec_finallenght * shellThickness)
+    manifoldPD = vtk.vtkPolyData()
+    manifoldPD.SetPoints(manifoldPoints)
+    manifoldPD.SetPolys(WrapSolidifyLogic._numpyToCellArray(manifoldOffsets, manifoldConnectivity))
 
-      # append point
-      addingPoints.append(vertex_neu)
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(manifoldPD)
 
-    for cellID in range(surfacePd.GetNumberOfCells()):
-      pointIDs = vtk.vtkIdList()
-      surfacePd.GetCellPoints(cellID, pointIDs)
+    # Compute normals to make the result look smooth
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(triangleFilter.GetOutputPort())
+    normals.Update()
 
-      newPointIDs = vtk.vtkIdList()
-      for i in reversed(range(pointIDs.GetNumberOfIds())):
-        newPointIDs.InsertNextId(int(pointIDs.GetId(i) + numberOfPoints))
+    return normals.GetOutput()
 
-      addingPolys.append(newPointIDs)
 
-    doubleSurfacePoints = vtk.vtkPoints()
-    doubleSurfacePolys = vtk.vtkCellArray()
+class WrapSolidifyStageCache(object):
+  """Least recently used cache of processing stage results (polydata), with limited total memory size"""
+
+  def __init__(self, maxMemorySizeMB=1024):
+    self.maxMemorySizeMB = maxMemorySizeMB
+    self._items = collections.OrderedDict()  # key: (polydata, memory size in kB)
+    self._memorySizeKB = 0
+
+  def get(self, key, polydata):
+    """Copy the cached result into polydata. Returns False if the result is not found in the cache."""
+    if key not in self._items:
+      return False
+    self._items.move_to_end(key)
+    polydata.DeepCopy(self._items[key][0])
+    return True
+
+  def add(self, key, polydata):
+    if key in self._items:
+      self._remove(key)
+    polydataCopy = vtk.vtkPolyData()
+    polydataCopy.DeepCopy(polydata)
+    memorySizeKB = polydataCopy.GetActualMemorySize()
+    if memorySizeKB > self.maxMemorySizeMB * 1024:
+      # Does not fit into the cache
+      self._evict(0)
+      return
+    self._evict(self.maxMemorySizeMB * 1024 - memorySizeKB)
+    self._items[key] = (polydataCopy, memorySizeKB)
+    self._memorySizeKB += memorySizeKB
 
-    doubleSurfacePoints.DeepCopy(surfacePd.GetPoints())
-    doubleSurfacePolys.DeepCopy(surfacePd.GetPolys())
+  def clear(self):
+    self._items.clear()
+    self._memorySizeKB = 0
 
-    for p in addingPoints:
-      doubleSurfacePoints.InsertNextPoint(p)
-    for p in addingPolys:
-      doubleSurfacePolys.InsertNextCell(p)
+  def _remove(self, key):
+    self._memorySizeKB -= self._items.pop(key)[1]
 
-    doubleSurfacePD = vtk.vtkPolyData()
-    doubleSurfacePD.SetPoints(doubleSurfacePoints)
-    doubleSurfacePD.SetPolys(doubleSurfacePolys)
+  def _evict(self, maxMemorySizeKB):
+    """Remove least recently used items until total size is below the specified limit"""
+    while self._items and self._memorySizeKB > maxMemorySizeKB:
+      self._remove(next(iter(self._items)))
 
-    # add faces to boundary edges
-    mergePoints = vtk.vtkMergePoints()
-    mergePoints.InitPointInsertion(doubleSurfacePD.GetPoints(), doubleSurfacePD.GetBounds())
-    mergePoints.SetDataSet(doubleSurfacePD)
-    mergePoints.BuildLocator()
+class WrapSolidifyMemoryMonitor(object):
+  """Measure resident memory size of the process at the start and its peak during time intervals,
+  which may be nested or overlapping.
 
-    manifoldPolys = vtk.vtkCellArray()
-    manifoldPolys.DeepCopy(doubleSurfacePD.GetPolys())
-    manifoldPoints = vtk.vtkPoints()
-    manifoldPoints.DeepCopy(doubleSurfacePD.GetPoints())
-
-    for e in range(featureEdges.GetOutput().GetNumberOfCells()):
-      pointIDs = vtk.vtkIdList()
-      featureEdges.GetOutput().GetCellPoints(e, pointIDs)
-      if pointIDs.GetNumberOfIds() == 2: # -> Edge
-        matchingPointIDs = []
-        newPointIDs = vtk.vtkIdList()
-        for p in range(2):
-          matchingPointIDs.append(mergePoints.IsInsertedPoint(featureEdges.GetOutput().GetPoint(pointIDs.GetId(p))))
-        if not (-1) in matchingPointIDs: # edge vertex not found in original pd, should not happen
-          newPointIDs.InsertNextId(matchingPointIDs[1])
-          newPointIDs.InsertNextId(matchingPointIDs[0])
-          newPointIDs.InsertNextId(matchingPointIDs[0]+numberOfPoints)
-          newPointIDs.InsertNextId(matchingPointIDs[1]+numberOfPoints)
-          manifoldPolys.InsertNextCell(newPointIDs)
+  On Linux the peak is exact: the resident size high water mark of the process (VmHWM) is read and reset
+  whenever an interval starts or stops, and each open interval keeps the maximum of the values read while it is open.
+  On other platforms the current resident size is sampled when an interval starts or stops (using psutil, if it is
+  installed), therefore the peak is underestimated if memory is allocated and released within the interval.
+  Memory usage is measured for the whole process, therefore intervals that run at the same time
+  (for example, processing steps in parallel threads) all include the memory usage of each other.
+  """
 
-    manifoldPD = vtk.vtkPolyData()
-    manifoldPD.SetPoints(manifoldPoints)
-    manifoldPD.SetPolys(manifoldPolys)
+  # Memory measurement method, determined at first use: 'linux', 'psutil', or None (not available)
+  _method = False
 
-    triangleFilter = vtk.vtkTriangleFilter()
-    triangleFilter.SetInputData(manifoldPD)
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._openIntervals = {}  # interval ID: [resident size at start, peak resident size] in MB
+    self._nextIntervalId = 0
+
+  def start(self):
+    """Start an interval. Returns interval ID that must be passed to stop()."""
+    with self._lock:
+      startMemoryUsageMB = self._updatePeaks()
+      intervalId = self._nextIntervalId
+      self._nextIntervalId += 1
+      self._openIntervals[intervalId] = [startMemoryUsageMB, startMemoryUsageMB]
+      return intervalId
+
+  def stop(self, intervalId):
+    """Stop an interval. Returns resident size at the start of the interval and peak resident size during the interval
+    (in MB, None if it cannot be measured on this platform)."""
+    with self._lock:
+      self._updatePeaks()
+      return tuple(self._openIntervals.pop(intervalId))
+
+  def _updatePeaks(self):
+    """Update peak of all open intervals. Returns the current resident size."""
+    currentMemoryUsageMB, peakMemoryUsageMB = WrapSolidifyMemoryMonitor._readMemoryUsageMB()
+    if peakMemoryUsageMB is not None:
+      for interval in self._openIntervals.values():
+        interval[1] = max(interval[1], peakMemoryUsageMB)
+    return currentMemoryUsageMB
 
-    # Compute normals to make the result look smooth
-    normals = vtk.vtkPolyDataNormals()
-    normals.SetInputConnection(triangleFilter.GetOutputPort())
-    normals.Update()
+  @staticmethod
+  def _readMemoryUsageMB():
+    """Get current resident size and peak resident size since the previous call (in MB)"""
+    if WrapSolidifyMemoryMonitor._method is False:
+      WrapSolidifyMemoryMonitor._method = WrapSolidifyMemoryMonitor._getMethod()
+    method = WrapSolidifyMemoryMonitor._method
+    if method == 'linux':
+      memoryUsageKB = {}
+      with open('/proc/self/status') as statusFile:
+        for line in statusFile:
+          if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+            memoryUsageKB[line.split(':')[0]] = float(line.split()[1])
+      # Reset high water mark to the current resident size
+      with open('/proc/self/clear_refs', 'w') as clearRefsFile:
+        clearRefsFile.write('5')
+      return memoryUsageKB['VmRSS'] / 1024.0, memoryUsageKB['VmHWM'] / 1024.0
+    if method == 'psutil':
+      import psutil
+      currentMemoryUsageMB = psutil.Process().memory_info().rss / 1024.0 / 1024.0
+      return currentMemoryUsageMB, currentMemoryUsageMB
+    return None, None
 
-    return normals.GetOutput()
+  @staticmethod
+  def _getMethod():
+    try:
+      # Resetting the high water mark requires Linux kernel 4.0 or later
+      with open('/proc/self/clear_refs', 'w') as clearRefsFile:
+        clearRefsFile.write('5')
+      return 'linux'
+    except (IOError, OSError):
+      pass
+    try:
+      import psutil
+      return 'psutil'
+    except ImportError:
+      logging.info("Wrap solidify: memory usage is not measured, because psutil Python package is not installed")
+      return None
 
 
 ARG_DEFAULTS = {}
@@ -939,8 +2901,10 @@ ARG_REGION = 'region'
 REGION_OUTER_SURFACE = 'outerSurface'
 REGION_LARGEST_CAVITY = 'largestCavity'
 REGION_SEGMENT = 'segment'
-ARG_OPTIONS[ARG_REGION] = [REGION_OUTER_SURFACE, REGION_LARGEST_CAVITY, REGION_SEGMENT]
+REGION_CAVITIES = 'cavities'
+ARG_OPTIONS[ARG_REGION] = [REGION_OUTER_SURFACE, REGION_LARGEST_CAVITY, REGION_SEGMENT, REGION_CAVITIES]
 ARG_DEFAULTS[ARG_REGION] = REGION_OUTER_SURFACE
+CAVITY_REGIONS = [REGION_LARGEST_CAVITY, REGION_CAVITIES]
 
 ARG_REGION_SEGMENT_ID = 'regionSegmentID'
 ARG_DEFAULTS[ARG_REGION_SEGMENT_ID] = ''
@@ -957,6 +2921,12 @@ ARG_DEFAULTS[ARG_SPLIT_CAVITIES] = False
 ARG_SPLIT_CAVITIES_DIAMETER = 'splitCavitiesDiameter'
 ARG_DEFAULTS[ARG_SPLIT_CAVITIES_DIAMETER] = 5
 
+ARG_CAVITIES_MAX_COUNT = 'cavitiesMaxCount'
+ARG_DEFAULTS[ARG_CAVITIES_MAX_COUNT] = 5  # 0 = no limit
+
+ARG_CAVITIES_MINIMUM_VOLUME = 'cavitiesMinimumVolume'
+ARG_DEFAULTS[ARG_CAVITIES_MINIMUM_VOLUME] = 0.0  # mm3
+
 ARG_CREATE_SHELL = 'createShell'
 ARG_DEFAULTS[ARG_CREATE_SHELL] = False
 
@@ -984,11 +2954,75 @@ ARG_OUTPUT_MODEL_NODE = 'WrapSolidify.OutputModelNodeID'
 ARG_REMESH_OVERSAMPLING = 'remeshOversampling'
 ARG_DEFAULTS[ARG_REMESH_OVERSAMPLING] = 1.5  # 1.5x oversampling by default
 
+ARG_REMESH_NARROW_BAND = 'remeshNarrowBand'
+ARG_DEFAULTS[ARG_REMESH_NARROW_BAND] = False
+
+ARG_ISO_SURFACE_ENGINE = 'isoSurfaceEngine'
+ISO_SURFACE_ENGINE_DISCRETE_MARCHING_CUBES = 'discreteMarchingCubes'
+ISO_SURFACE_ENGINE_DISCRETE_FLYING_EDGES = 'discreteFlyingEdges'
+ISO_SURFACE_ENGINE_SURFACE_NETS = 'surfaceNets'
+# Number of surface nets smoothing iterations = smoothing factor * this value (default smoothing factor 0.2 -> 16 iterations)
+SURFACE_NETS_ITERATIONS_PER_SMOOTHING_FACTOR = 80
+ARG_OPTIONS[ARG_ISO_SURFACE_ENGINE] = [ISO_SURFACE_ENGINE_DISCRETE_MARCHING_CUBES, ISO_SURFACE_ENGINE_DISCRETE_FLYING_EDGES,
+  ISO_SURFACE_ENGINE_SURFACE_NETS]
+ARG_DEFAULTS[ARG_ISO_SURFACE_ENGINE] = ISO_SURFACE_ENGINE_DISCRETE_MARCHING_CUBES
+
+ARG_NUMBER_OF_THREADS = 'numberOfThreads'
+ARG_DEFAULTS[ARG_NUMBER_OF_THREADS] = 0  # 0 = use all CPU cores (for SMP filters and rasterization)
+
+ARG_MEMORY_BUDGET_MB = 'memoryBudgetMB'
+ARG_DEFAULTS[ARG_MEMORY_BUDGET_MB] = 0  # 0 = no limit
+
+ARG_REMESH_ANISOTROPIC = 'remeshAnisotropic'
+ARG_DEFAULTS[ARG_REMESH_ANISOTROPIC] = False
+
+ARG_SPLIT_COMPONENTS = 'splitComponents'
+ARG_DEFAULTS[ARG_SPLIT_COMPONENTS] = False
+
+ARG_WARM_START = 'warmStart'
+ARG_DEFAULTS[ARG_WARM_START] = False
+
+ARG_COMPACT_UNDO = 'compactUndo'
+ARG_DEFAULTS[ARG_COMPACT_UNDO] = False
+
+ARG_DEFER_REPRESENTATION_UPDATE = 'deferRepresentationUpdate'
+ARG_DEFAULTS[ARG_DEFER_REPRESENTATION_UPDATE] = False
+
+ARG_TIMING_REPORT = 'timingReport'
+ARG_DEFAULTS[ARG_TIMING_REPORT] = False
+
+ARG_TIMING_REPORT_TABLE_NODE = 'WrapSolidify.TimingReportTableNodeID'
+
+ARG_INITIAL_SHAPE = 'initialShape'
+INITIAL_SHAPE_SPHERE = 'sphere'
+INITIAL_SHAPE_CONVEX_HULL = 'convexHull'
+INITIAL_SHAPE_ORIENTED_BOUNDING_BOX = 'orientedBoundingBox'
+ARG_OPTIONS[ARG_INITIAL_SHAPE] = [INITIAL_SHAPE_SPHERE, INITIAL_SHAPE_CONVEX_HULL, INITIAL_SHAPE_ORIENTED_BOUNDING_BOX]
+ARG_DEFAULTS[ARG_INITIAL_SHAPE] = INITIAL_SHAPE_SPHERE
+
 ARG_SMOOTHING_FACTOR = 'smoothingFactor'
 ARG_DEFAULTS[ARG_SMOOTHING_FACTOR] = 0.2
 
 ARG_SHRINKWRAP_ITERATIONS = 'shrinkwrapIterations'
 ARG_DEFAULTS[ARG_SHRINKWRAP_ITERATIONS] = 6
 
+ARG_SHRINKWRAP_COARSE_TO_FINE = 'shrinkwrapCoarseToFine'
+ARG_DEFAULTS[ARG_SHRINKWRAP_COARSE_TO_FINE] = False
+
+ARG_SHRINKWRAP_COARSE_SPACING_FACTOR = 'shrinkwrapCoarseSpacingFactor'
+ARG_DEFAULTS[ARG_SHRINKWRAP_COARSE_SPACING_FACTOR] = 4.0  # first iteration is performed at 4x the remesh spacing
+
+ARG_SHRINKWRAP_STOP_AT_CONVERGENCE = 'shrinkwrapStopAtConvergence'
+ARG_DEFAULTS[ARG_SHRINKWRAP_STOP_AT_CONVERGENCE] = False
+
+ARG_SHRINKWRAP_CONVERGENCE_TOLERANCE = 'shrinkwrapConvergenceTolerance'
+ARG_DEFAULTS[ARG_SHRINKWRAP_CONVERGENCE_TOLERANCE] = 0.1  # relative to the remesh spacing
+
 ARG_SAVE_INTERMEDIATE_RESULTS = 'saveIntermediateResults'
 ARG_DEFAULTS[ARG_SAVE_INTERMEDIATE_RESULTS] = False
+
+ARG_RUN_IN_BACKGROUND = 'runInBackground'
+ARG_DEFAULTS[ARG_RUN_IN_BACKGROUND] = False
+
+ARG_STAGE_CACHE_SIZE_MB = 'stageCacheSizeMB'
+ARG_DEFAULTS[ARG_STAGE_CACHE_SIZE_MB] = 1024  # set to 0 to disable caching of processing stage results
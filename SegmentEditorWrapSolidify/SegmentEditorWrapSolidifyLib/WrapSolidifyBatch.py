@@ -0,0 +1,542 @@
+"""Process segmentations with Wrap Solidify without graphical user interface.
+
+Process all cases in a folder from the command line:
+
+    Slicer --no-main-window --python-script WrapSolidifyBatch.py --input-folder /path/to/cases --output-folder /path/to/results --parameters parameters.json
+
+Parameters file is a JSON dictionary of WrapSolidifyLogic input attributes, for example:
+
+    {"region": "outerSurface", "carveHolesInOuterSurface": true, "createShell": true, "shellThickness": 2.0, "outputType": "model"}
+
+Supported input files: segmentation (.seg.nrrd, .seg.nii.gz), surface mesh (.stl, .obj, .ply, .vtk, .vtp),
+and labelmap volume (.nrrd, .nii, .nii.gz, .mha, .mhd). Each segment of a case is processed.
+If output type is "model" then each result is written as an STL file, otherwise the modified
+segmentation is written as a .seg.nrrd (or .seg.vtm, if source representation is closed surface) file.
+Output file names are created from the case and segment names (characters that are not safe in file names
+are replaced by "_"). Processing time of each case (and time and memory usage of each processing step of each segment)
+and the list of written files are written to wrapSolidifyBatchSummary.json in the output folder. Files listed in this
+summary are not processed as input cases, therefore the output folder can be the same as the input folder.
+
+Cases can be processed concurrently in separate worker processes (each worker is a Slicer instance
+without main window). Memory usage of each worker can be limited to prevent large labelmaps of concurrently
+running workers from exhausting the system memory: resident memory size of each worker (including its
+child processes) is checked every second and a worker that exceeds the limit is stopped. This requires Linux
+or the psutil Python package:
+
+    Slicer --no-main-window --python-script WrapSolidifyBatch.py --input-folder /path/to/cases --output-folder /path/to/results --number-of-workers 8 --max-memory-per-worker 16000
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import tempfile
+import signal
+import subprocess
+import vtk, slicer
+
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from SegmentEditorEffect import *
+
+SEGMENTATION_FILE_EXTENSIONS = ['.seg.nrrd', '.seg.nhdr', '.seg.nii.gz', '.seg.nii', '.seg.vtm']
+SURFACE_FILE_EXTENSIONS = ['.stl', '.obj', '.ply', '.vtk', '.vtp']
+LABELMAP_FILE_EXTENSIONS = ['.nrrd', '.nhdr', '.nii.gz', '.nii', '.mha', '.mhd']
+SUMMARY_FILE_NAME = 'wrapSolidifyBatchSummary.json'
+
+
+def getCaseName(filePath):
+  """Get file name without any of the supported extensions"""
+  fileName = os.path.basename(filePath)
+  for extension in SEGMENTATION_FILE_EXTENSIONS + SURFACE_FILE_EXTENSIONS + LABELMAP_FILE_EXTENSIONS:
+    if fileName.lower().endswith(extension):
+      return fileName[:-len(extension)]
+  return os.path.splitext(fileName)[0]
+
+
+def getSafeFileName(name):
+  """Replace characters that may not be used in file names (or would create a path) by underscore"""
+  safeName = re.sub(r'[^\w\-. ]', '_', name).strip(' .')
+  return safeName if safeName else '_'
+
+
+def readPolyData(filePath):
+  """Read surface mesh file into polydata (without creating any nodes)"""
+  extension = os.path.splitext(filePath)[1].lower()
+  if extension == '.stl':
+    reader = vtk.vtkSTLReader()
+  elif extension == '.obj':
+    reader = vtk.vtkOBJReader()
+  elif extension == '.ply':
+    reader = vtk.vtkPLYReader()
+  elif extension == '.vtp':
+    reader = vtk.vtkXMLPolyDataReader()
+  elif extension == '.vtk':
+    reader = vtk.vtkPolyDataReader()
+  else:
+    raise ValueError("Unsupported surface file format: " + filePath)
+  reader.SetFileName(filePath)
+  reader.Update()
+  return reader.GetOutput()
+
+
+def writePolyData(polydata, filePath):
+  """Write polydata to STL (binary) or VTP file"""
+  if filePath.lower().endswith('.vtp'):
+    writer = vtk.vtkXMLPolyDataWriter()
+  else:
+    writer = vtk.vtkSTLWriter()
+    writer.SetFileTypeToBinary()
+  writer.SetInputData(polydata)
+  writer.SetFileName(filePath)
+  if not writer.Write():
+    raise ValueError("Failed to write " + filePath)
+
+
+def getSegmentationFileExtension(segmentationNode):
+  """Get file extension that can store the source representation of the segmentation"""
+  try:
+    sourceRepresentationName = segmentationNode.GetSegmentation().GetSourceRepresentationName()
+  except:
+    # Legacy (Slicer-5.3 and earlier)
+    sourceRepresentationName = segmentationNode.GetSegmentation().GetMasterRepresentationName()
+  if sourceRepresentationName == slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName():
+    return '.seg.nrrd'
+  return '.seg.vtm'
+
+
+def loadSegmentationNode(filePath):
+  """Load a segmentation, surface mesh, or labelmap file into a new segmentation node.
+  Display nodes are not created.
+  """
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', getCaseName(filePath))
+  lowerFilePath = filePath.lower()
+  if any(lowerFilePath.endswith(extension) for extension in SEGMENTATION_FILE_EXTENSIONS):
+    storageNode = slicer.vtkMRMLSegmentationStorageNode()
+    storageNode.SetFileName(filePath)
+    if not storageNode.ReadData(segmentationNode):
+      raise ValueError("Failed to read segmentation from " + filePath)
+  elif any(lowerFilePath.endswith(extension) for extension in SURFACE_FILE_EXTENSIONS):
+    segment = slicer.vtkSegment()
+    segment.SetName(getCaseName(filePath))
+    segment.AddRepresentation(slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName(), readPolyData(filePath))
+    segmentationNode.GetSegmentation().AddSegment(segment)
+  elif any(lowerFilePath.endswith(extension) for extension in LABELMAP_FILE_EXTENSIONS):
+    labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+    storageNode.SetFileName(filePath)
+    if not storageNode.ReadData(labelmapNode):
+      raise ValueError("Failed to read labelmap from " + filePath)
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+  else:
+    raise ValueError("Unsupported input file format: " + filePath)
+  return segmentationNode
+
+
+def wrapSolidifySegment(segmentationNode, segmentId, parameters=None, logCallback=None, instrumentationReports=None):
+  """Compute Wrap Solidify result of a segment and return it as polydata.
+  The segmentation node is not modified. If instrumentationReports list is specified then
+  the instrumentation report of the computation (time and memory usage of each processing step) is appended to it.
+  """
+  logic = WrapSolidifyLogic()
+  logic.logCallback = logCallback
+  if parameters:
+    logic.setParameters(parameters)
+  logic.segmentationNode = segmentationNode
+  logic.segmentId = segmentId
+  outputPd = logic.computeWrapSolidify()
+  if instrumentationReports is not None:
+    instrumentationReports.append(logic.getInstrumentationReport())
+  return outputPd
+
+
+def processCase(inputFilePath, outputFolder, parameters=None, segmentIds=None, modelFileExtension='.stl'):
+  """Process all (or the specified) segments of a case and write the results to the output folder.
+  Returns a dictionary that contains processing time and list of written files.
+  """
+  parameters = dict(parameters) if parameters else {}
+  outputType = parameters.get('outputType', ARG_DEFAULTS[ARG_OUTPUT_TYPE])
+  caseName = getCaseName(inputFilePath)
+  caseResult = {'input': inputFilePath, 'segments': [], 'outputs': []}
+  caseStartTime = time.time()
+
+  segmentationNode = loadSegmentationNode(inputFilePath)
+  try:
+    segmentation = segmentationNode.GetSegmentation()
+    if not segmentIds:
+      segmentIds = list(segmentation.GetSegmentIDs())
+    for segmentId in segmentIds:
+      segmentStartTime = time.time()
+      logging.info("Wrap solidify {0} / {1}".format(caseName, segmentId))
+      instrumentationReports = []
+      outputPd = wrapSolidifySegment(segmentationNode, segmentId, parameters, logging.info, instrumentationReports)
+      segmentName = segmentation.GetSegment(segmentId).GetName()
+      if isinstance(outputPd, list):
+        # Multiple cavities: one output per cavity
+        outputPds = outputPd
+        nameSuffixes = ["_cavity{0}".format(cavityIndex+1) for cavityIndex in range(len(outputPds))]
+      else:
+        outputPds = [outputPd]
+        nameSuffixes = [""]
+      for outputPd, nameSuffix in zip(outputPds, nameSuffixes):
+        if outputType == OUTPUT_MODEL:
+          outputFilePath = os.path.join(outputFolder, getSafeFileName("{0}_{1}{2}".format(caseName, segmentName, nameSuffix))
+            + modelFileExtension)
+          checkOutputFilePath(outputFilePath, inputFilePath)
+          writePolyData(outputPd, outputFilePath)
+          caseResult['outputs'].append(outputFilePath)
+        elif outputType == OUTPUT_SEGMENT and not nameSuffix:
+          WrapSolidifyLogic._polydataToSegment(outputPd, segmentationNode, segmentId)
+        elif outputType == OUTPUT_SEGMENT or outputType == OUTPUT_NEW_SEGMENT:
+          WrapSolidifyLogic._polydataToNewSegment(outputPd, segmentationNode, segmentId, nameSuffix or "_solid")
+        else:
+          raise ValueError('Unknown output type: ' + outputType)
+      caseResult['segments'].append({
+        'segmentId': segmentId,
+        'segmentName': segmentName,
+        'timeSec': time.time() - segmentStartTime,
+        'numberOfOutputs': len(outputPds),
+        'numberOfOutputPoints': sum(outputPd.GetNumberOfPoints() for outputPd in outputPds),
+        'numberOfOutputCells': sum(outputPd.GetNumberOfCells() for outputPd in outputPds),
+        'peakMemoryIncreaseMB': instrumentationReports[0]['peakMemoryIncreaseMB'],
+        'stages': instrumentationReports[0]['stages'],
+        })
+
+    if outputType != OUTPUT_MODEL:
+      outputFilePath = os.path.join(outputFolder, getSafeFileName(caseName) + getSegmentationFileExtension(segmentationNode))
+      checkOutputFilePath(outputFilePath, inputFilePath)
+      storageNode = slicer.vtkMRMLSegmentationStorageNode()
+      storageNode.SetFileName(outputFilePath)
+      if not storageNode.WriteData(segmentationNode):
+        raise ValueError("Failed to write segmentation to " + outputFilePath)
+      caseResult['outputs'].append(outputFilePath)
+
+  finally:
+    slicer.mrmlScene.RemoveNode(segmentationNode)
+
+  caseResult['timeSec'] = time.time() - caseStartTime
+  logging.info("Wrap solidify {0} completed in {1:.1f}s".format(caseName, caseResult['timeSec']))
+  return caseResult
+
+
+def checkOutputFilePath(outputFilePath, inputFilePath):
+  """Raise an exception if writing the output file would overwrite the input file"""
+  if os.path.exists(outputFilePath) and os.path.samefile(outputFilePath, inputFilePath):
+    raise ValueError("Output file would overwrite the input file: " + inputFilePath)
+
+
+def getPreviousOutputFilePaths(outputFolder):
+  """Get normalized paths of files that were written by a previous run into the output folder
+  (listed in the summary file of that run)"""
+  summaryFilePath = os.path.join(outputFolder, SUMMARY_FILE_NAME)
+  if not os.path.exists(summaryFilePath):
+    return set()
+  try:
+    with open(summaryFilePath) as summaryFile:
+      caseResults = json.load(summaryFile)
+  except (IOError, ValueError):
+    logging.warning("Failed to read previous summary file " + summaryFilePath)
+    return set()
+  return set(os.path.normcase(os.path.abspath(filePath))
+    for caseResult in caseResults for filePath in caseResult.get('outputs', []))
+
+
+def findCaseFiles(inputFolder, outputFolder=None):
+  """Get list of all supported input files in a folder. If output folder is specified then
+  files that were written by a previous run into that folder are not included.
+  """
+  excludedFilePaths = getPreviousOutputFilePaths(outputFolder) if outputFolder else set()
+  caseFilePaths = []
+  for fileName in sorted(os.listdir(inputFolder)):
+    filePath = os.path.join(inputFolder, fileName)
+    lowerFileName = fileName.lower()
+    if not os.path.isfile(filePath):
+      continue
+    if os.path.normcase(os.path.abspath(filePath)) in excludedFilePaths:
+      logging.info("Skip {0}, it is an output of a previous run".format(filePath))
+      continue
+    if any(lowerFileName.endswith(extension) for extension in
+      SEGMENTATION_FILE_EXTENSIONS + SURFACE_FILE_EXTENSIONS + LABELMAP_FILE_EXTENSIONS):
+      caseFilePaths.append(filePath)
+  return caseFilePaths
+
+
+def processFolder(inputFolder, outputFolder, parameters=None):
+  """Process all cases in the input folder. Processing errors are recorded in the summary
+  and processing continues with the next case.
+  Returns list of case results, which is also written to the summary file in the output folder.
+  """
+  if not os.path.exists(outputFolder):
+    os.makedirs(outputFolder)
+  caseResults = []
+  for inputFilePath in findCaseFiles(inputFolder, outputFolder):
+    try:
+      caseResult = processCase(inputFilePath, outputFolder, parameters)
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      caseResult = {'input': inputFilePath, 'error': str(e)}
+    caseResults.append(caseResult)
+    with open(os.path.join(outputFolder, SUMMARY_FILE_NAME), 'w') as summaryFile:
+      json.dump(caseResults, summaryFile, indent=2)
+  return caseResults
+
+
+def _getProcessTreePids(pid):
+  """Get ID of a process and all its descendants (the launcher starts the Slicer application as a child process).
+  Returns None if process information is not available on this platform (psutil is not installed and not Linux).
+  """
+  try:
+    import psutil
+    try:
+      return [pid] + [child.pid for child in psutil.Process(pid).children(recursive=True)]
+    except psutil.NoSuchProcess:
+      return []
+  except ImportError:
+    pass
+  if not os.path.exists('/proc/self/stat'):
+    return None
+  childPids = {}
+  for entry in os.listdir('/proc'):
+    if not entry.isdigit():
+      continue
+    try:
+      with open('/proc/{0}/stat'.format(entry)) as statFile:
+        # Process name may contain spaces, fields after the closing parenthesis are: state, ppid, ...
+        parentPid = int(statFile.read().rsplit(')', 1)[1].split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+      continue
+    childPids.setdefault(parentPid, []).append(int(entry))
+  pids = []
+  remainingPids = [pid]
+  while remainingPids:
+    currentPid = remainingPids.pop()
+    pids.append(currentPid)
+    remainingPids.extend(childPids.get(currentPid, []))
+  return pids
+
+
+def _getProcessMemoryUsageMB(pid):
+  """Get resident memory size of a process in MB (0 if the process does not exist anymore)"""
+  try:
+    import psutil
+    try:
+      return psutil.Process(pid).memory_info().rss / 1024.0 / 1024.0
+    except psutil.NoSuchProcess:
+      return 0.0
+  except ImportError:
+    pass
+  try:
+    with open('/proc/{0}/status'.format(pid)) as statusFile:
+      for line in statusFile:
+        if line.startswith('VmRSS:'):
+          return float(line.split()[1]) / 1024.0
+  except (IOError, OSError):
+    pass
+  return 0.0
+
+
+def _runWorkers(workerArguments, numberOfWorkers, maxMemoryPerWorkerMB=None):
+  """Run this script in separate Slicer processes, one for each item of workerArguments.
+  At most numberOfWorkers processes are running at the same time. If maxMemoryPerWorkerMB is specified
+  then resident memory size of each process (including its child processes) is checked every second
+  and the process is stopped if it exceeds the limit (only supported on Linux or if psutil is installed).
+  Returns list of process return codes.
+  """
+  import concurrent.futures
+
+  command = [slicer.app.launcherExecutableFilePath, '--no-splash', '--no-main-window', '--ignore-slicerrc',
+    '--python-script', os.path.abspath(__file__)]
+
+  if maxMemoryPerWorkerMB and _getProcessTreePids(os.getpid()) is None:
+    logging.warning("Memory limit of worker processes requires Linux or psutil Python package, the limit is ignored")
+    maxMemoryPerWorkerMB = None
+
+  def runWorker(arguments):
+    logging.info("Start worker: " + " ".join(arguments))
+    process = subprocess.Popen(command + arguments)
+    if not maxMemoryPerWorkerMB:
+      return process.wait()
+    while True:
+      try:
+        return process.wait(timeout=1.0)
+      except subprocess.TimeoutExpired:
+        pass
+      pids = _getProcessTreePids(process.pid)
+      memoryUsageMB = sum(_getProcessMemoryUsageMB(pid) for pid in pids)
+      if memoryUsageMB > maxMemoryPerWorkerMB:
+        logging.error("Worker uses {0:.0f}MB memory, more than the {1:.0f}MB limit, it is stopped: {2}".format(
+          memoryUsageMB, maxMemoryPerWorkerMB, " ".join(arguments)))
+        # Stop the descendants first, so that they are not left running
+        for pid in reversed(pids[1:]):
+          try:
+            os.kill(pid, signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM)
+          except OSError:
+            pass
+        process.kill()
+        return process.wait()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+    return list(executor.map(runWorker, workerArguments))
+
+
+def processFolderParallel(inputFolder, outputFolder, parameters=None, numberOfWorkers=None, maxMemoryPerWorkerMB=None):
+  """Process all cases in the input folder, each case in a separate worker process.
+  Returns list of case results, which is also written to the summary file in the output folder.
+  """
+  if not numberOfWorkers:
+    numberOfWorkers = os.cpu_count()
+  if not os.path.exists(outputFolder):
+    os.makedirs(outputFolder)
+  caseFilePaths = findCaseFiles(inputFolder, outputFolder)
+  with tempfile.TemporaryDirectory() as tempFolder:
+    parametersFilePath = os.path.join(tempFolder, 'parameters.json')
+    with open(parametersFilePath, 'w') as parametersFile:
+      json.dump(parameters if parameters else {}, parametersFile)
+    workerArguments = []
+    for caseIndex, inputFilePath in enumerate(caseFilePaths):
+      workerArguments.append(['--input-file', inputFilePath, '--output-folder', outputFolder,
+        '--parameters', parametersFilePath, '--result-file', os.path.join(tempFolder, 'result{0}.json'.format(caseIndex))])
+    returnCodes = _runWorkers(workerArguments, numberOfWorkers, maxMemoryPerWorkerMB)
+    caseResults = []
+    for caseIndex, inputFilePath in enumerate(caseFilePaths):
+      resultFilePath = os.path.join(tempFolder, 'result{0}.json'.format(caseIndex))
+      if os.path.exists(resultFilePath):
+        with open(resultFilePath) as resultFile:
+          caseResults.append(json.load(resultFile))
+      else:
+        caseResults.append({'input': inputFilePath, 'error': 'Worker process failed with code {0}'.format(returnCodes[caseIndex])})
+  with open(os.path.join(outputFolder, SUMMARY_FILE_NAME), 'w') as summaryFile:
+    json.dump(caseResults, summaryFile, indent=2)
+  return caseResults
+
+
+def writeSegmentFile(segmentationNode, segmentId, filePathWithoutExtension):
+  """Write a single segment into a file that can be processed as a case.
+  If the source representation is closed surface then the polydata of the segment is written (.vtp),
+  otherwise a segmentation file that only contains this segment (so that the input labelmap spacing is preserved).
+  Returns the path of the written file.
+  """
+  segmentation = segmentationNode.GetSegmentation()
+  if getSegmentationFileExtension(segmentationNode) == '.seg.vtm':
+    polydata = vtk.vtkPolyData()
+    segmentationNode.GetClosedSurfaceRepresentation(segmentId, polydata)
+    filePath = filePathWithoutExtension + '.vtp'
+    writePolyData(polydata, filePath)
+    return filePath
+
+  labelmap = slicer.vtkOrientedImageData()
+  segmentationNode.GetBinaryLabelmapRepresentation(segmentId, labelmap)
+  segmentSegmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+  try:
+    segmentSegmentationNode.GetSegmentation().CopyConversionParameters(segmentation)
+    segmentSegmentationNode.AddSegmentFromBinaryLabelmapRepresentation(labelmap,
+      segmentation.GetSegment(segmentId).GetName())
+    filePath = filePathWithoutExtension + '.seg.nrrd'
+    storageNode = slicer.vtkMRMLSegmentationStorageNode()
+    storageNode.SetFileName(filePath)
+    if not storageNode.WriteData(segmentSegmentationNode):
+      raise ValueError("Failed to write segment to " + filePath)
+  finally:
+    slicer.mrmlScene.RemoveNode(segmentSegmentationNode)
+  return filePath
+
+
+def wrapSolidifySegmentsParallel(segmentationNode, segmentIds, parameters=None, numberOfWorkers=None, maxMemoryPerWorkerMB=None):
+  """Compute Wrap Solidify result of multiple segments concurrently, each segment in a separate worker process.
+  The segmentation node is not modified.
+  Returns a dictionary that maps segment IDs to result polydata (list of polydata, one for each cavity,
+  if region is cavities).
+  """
+  if not numberOfWorkers:
+    numberOfWorkers = os.cpu_count()
+  workerParameters = dict(parameters) if parameters else {}
+  workerParameters['outputType'] = OUTPUT_MODEL
+
+  with tempfile.TemporaryDirectory() as tempFolder:
+    parametersFilePath = os.path.join(tempFolder, 'parameters.json')
+    with open(parametersFilePath, 'w') as parametersFile:
+      json.dump(workerParameters, parametersFile)
+
+    workerArguments = []
+    for segmentIndex, segmentId in enumerate(segmentIds):
+      workerOutputFolder = os.path.join(tempFolder, 'segment{0}'.format(segmentIndex))
+      os.makedirs(workerOutputFolder)
+      # Each worker only loads its own segment
+      segmentFilePath = writeSegmentFile(segmentationNode, segmentId,
+        os.path.join(tempFolder, 'segment{0}-input'.format(segmentIndex)))
+      workerArguments.append(['--input-file', segmentFilePath,
+        '--output-folder', workerOutputFolder, '--parameters', parametersFilePath, '--model-file-extension', '.vtp',
+        '--result-file', os.path.join(workerOutputFolder, 'result.json')])
+    _runWorkers(workerArguments, numberOfWorkers, maxMemoryPerWorkerMB)
+
+    outputPds = {}
+    for segmentIndex, segmentId in enumerate(segmentIds):
+      resultFilePath = os.path.join(tempFolder, 'segment{0}'.format(segmentIndex), 'result.json')
+      if not os.path.exists(resultFilePath):
+        raise ValueError("Processing of segment {0} failed".format(segmentId))
+      with open(resultFilePath) as resultFile:
+        caseResult = json.load(resultFile)
+      if 'error' in caseResult:
+        raise ValueError("Processing of segment {0} failed: {1}".format(segmentId, caseResult['error']))
+      segmentOutputPds = [readPolyData(outputFilePath) for outputFilePath in caseResult['outputs']]
+      if workerParameters.get('region', ARG_DEFAULTS[ARG_REGION]) == REGION_CAVITIES:
+        outputPds[segmentId] = segmentOutputPds
+      else:
+        outputPds[segmentId] = segmentOutputPds[0]
+  return outputPds
+
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(description="Process segmentations with Wrap Solidify.")
+  inputGroup = parser.add_mutually_exclusive_group(required=True)
+  inputGroup.add_argument("-i", "--input-folder", dest="inputFolder", help="Folder containing input files.")
+  inputGroup.add_argument("--input-file", dest="inputFilePath", help="Single input file to process.")
+  parser.add_argument("-o", "--output-folder", dest="outputFolder", required=True, help="Folder to write outputs and summary into.")
+  parser.add_argument("-p", "--parameters", dest="parametersFilePath", help="JSON file containing processing parameters.")
+  parser.add_argument("-n", "--number-of-workers", dest="numberOfWorkers", type=int, default=1,
+    help="Number of cases to process concurrently in separate processes. 0 means number of CPU cores.")
+  parser.add_argument("--max-memory-per-worker", dest="maxMemoryPerWorkerMB", type=float,
+    help="Maximum resident memory of each worker process in MB, workers that exceed it are stopped (requires Linux or psutil). "
+    "If specified then cases are always processed in worker processes.")
+  parser.add_argument("--segment-ids", dest="segmentIds", nargs='+', help="Process only these segments (with --input-file).")
+  parser.add_argument("--model-file-extension", dest="modelFileExtension", default='.stl', help="File format of output models (.stl or .vtp).")
+  parser.add_argument("--result-file", dest="resultFilePath", help="Write result of processing --input-file into this JSON file.")
+  args = parser.parse_args(argv)
+
+  parameters = {}
+  if args.parametersFilePath:
+    with open(args.parametersFilePath) as parametersFile:
+      parameters = json.load(parametersFile)
+
+  if args.inputFilePath:
+    # Process a single case (this is how worker processes are started)
+    try:
+      caseResult = processCase(args.inputFilePath, args.outputFolder, parameters, args.segmentIds, args.modelFileExtension)
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      caseResult = {'input': args.inputFilePath, 'error': str(e)}
+    if args.resultFilePath:
+      with open(args.resultFilePath, 'w') as resultFile:
+        json.dump(caseResult, resultFile, indent=2)
+    return 1 if 'error' in caseResult else 0
+
+  if args.numberOfWorkers == 1 and not args.maxMemoryPerWorkerMB:
+    caseResults = processFolder(args.inputFolder, args.outputFolder, parameters)
+  else:
+    caseResults = processFolderParallel(args.inputFolder, args.outputFolder, parameters,
+      args.numberOfWorkers, args.maxMemoryPerWorkerMB)
+  numberOfFailedCases = len([caseResult for caseResult in caseResults if 'error' in caseResult])
+  logging.info("Processed {0} cases, {1} failed".format(len(caseResults), numberOfFailedCases))
+  return 1 if numberOfFailedCases else 0
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  sys.exit(main(sys.argv[1:]))
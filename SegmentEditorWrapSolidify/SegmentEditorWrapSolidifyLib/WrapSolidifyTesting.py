@@ -0,0 +1,39 @@
+"""Helper functions that are shared by the module tests and the performance benchmarks of Wrap Solidify."""
+
+import os
+import sys
+import vtk
+import numpy as np
+from vtk.util import numpy_support
+
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from SegmentEditorEffect import WrapSolidifyLogic
+
+
+def createWrapSolidifyLogic(segmentationNode, segmentId, parameters=None, regionSegmentId=None):
+  """Create a logic that processes a segment with the specified parameters (dictionary of logic input attributes).
+  Stage cache is disabled, so that each run computes all processing stages.
+  """
+  logic = WrapSolidifyLogic()
+  logic.segmentationNode = segmentationNode
+  logic.segmentId = segmentId
+  if regionSegmentId:
+    logic.regionSegmentId = regionSegmentId
+  if parameters:
+    logic.setParameters(parameters)
+  logic.stageCacheSizeMB = 0
+  return logic
+
+
+def getSignedVolume(surfacePd):
+  """Get volume enclosed by a surface mesh. The volume is negative if surface normals point inward."""
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputData(surfacePd)
+  triangleFilter.Update()
+  surfacePd = triangleFilter.GetOutput()
+  points = numpy_support.vtk_to_numpy(surfacePd.GetPoints().GetData()).astype(np.float64)
+  triangles = numpy_support.vtk_to_numpy(surfacePd.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+  p0, p1, p2 = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+  return np.sum(np.einsum('ij,ij->i', p0, np.cross(p1, p2))) / 6.0
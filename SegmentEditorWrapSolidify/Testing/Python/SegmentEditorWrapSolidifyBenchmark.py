@@ -0,0 +1,805 @@
+"""Performance benchmarks of the Wrap Solidify effect logic.
+
+Run from the command line using Slicer's Python environment, for example:
+
+    Slicer --no-main-window --python-script SegmentEditorWrapSolidifyBenchmark.py [labelmap file]
+
+If a labelmap file (for example a segmented pelvis) is specified then it is used for the surface extraction
+benchmark, otherwise bone is thresholded in the CTChest sample data set.
+
+Synthetic phantoms (nested shells, porous lattice, multiple islands, cracked cortex) are generated offline
+at several resolutions, and each region, shell, and output mode is run on them. Time of each processing step
+and peak memory usage can be saved as a baseline and later runs can be compared with it (exit code is 1
+if any performance regression is found):
+
+    Slicer --no-main-window --python-script SegmentEditorWrapSolidifyBenchmark.py --phantoms-only --save-baseline baseline.json
+    Slicer --no-main-window --python-script SegmentEditorWrapSolidifyBenchmark.py --phantoms-only --baseline baseline.json
+
+The phantom benchmark is registered as a test (py_SegmentEditorWrapSolidifyBenchmark) that compares the smallest
+phantoms with Baseline/SegmentEditorWrapSolidifyBenchmarkBaseline.json. Timings depend on the machine, therefore
+the baseline has to be recorded on the machine that runs the tests (using --save-baseline with the same arguments).
+Until then only failed runs are reported.
+"""
+
+import os
+import sys
+import math
+import time
+import json
+import logging
+import collections
+import vtk, slicer
+import numpy as np
+
+
+def importWrapSolidifyLogic():
+  """Make the effect library importable and return the effect module"""
+  libPath = os.path.join(os.path.dirname(slicer.modules.segmenteditorwrapsolidify.path), 'SegmentEditorWrapSolidifyLib')
+  if libPath not in sys.path:
+    sys.path.insert(0, libPath)
+  import SegmentEditorEffect
+  return SegmentEditorEffect
+
+
+def importWrapSolidifyTesting():
+  """Return the module of helper functions shared with the module tests"""
+  importWrapSolidifyLogic()
+  import WrapSolidifyTesting
+  return WrapSolidifyTesting
+
+
+def createOpenSurface(resolution):
+  """Create a sphere surface with a hole cut into it (open surface, as after preserving cracks)"""
+  sphereSource = vtk.vtkSphereSource()
+  sphereSource.SetRadius(50)
+  sphereSource.SetPhiResolution(resolution)
+  sphereSource.SetThetaResolution(resolution)
+  plane = vtk.vtkPlane()
+  plane.SetOrigin(0, 0, 40)
+  plane.SetNormal(0, 0, -1)
+  clipper = vtk.vtkClipPolyData()
+  clipper.SetInputConnection(sphereSource.GetOutputPort())
+  clipper.SetClipFunction(plane)
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputConnection(clipper.GetOutputPort())
+  triangleFilter.Update()
+  return triangleFilter.GetOutput()
+
+
+def shellSolidifyReference(surfacePd, shellThickness, shellOffsetDirection, SHELL_OFFSET_OUTSIDE):
+  """Point-by-point shell solidification, used as reference for the vectorized implementation"""
+
+  cleanPolyData = vtk.vtkCleanPolyData()
+  cleanPolyData.SetInputData(surfacePd)
+
+  normals = vtk.vtkPolyDataNormals()
+  normals.SetComputeCellNormals(1)
+  normals.SetInputConnection(cleanPolyData.GetOutputPort())
+  normals.SplittingOff()
+  if shellOffsetDirection == SHELL_OFFSET_OUTSIDE:
+    normals.FlipNormalsOn()
+  normals.Update()
+
+  surfacePd = vtk.vtkPolyData()
+  surfacePd.DeepCopy(normals.GetOutput())
+  numberOfPoints = surfacePd.GetNumberOfPoints()
+
+  featureEdges = vtk.vtkFeatureEdges()
+  featureEdges.BoundaryEdgesOn()
+  featureEdges.ColoringOff()
+  featureEdges.FeatureEdgesOff()
+  featureEdges.NonManifoldEdgesOff()
+  featureEdges.ManifoldEdgesOff()
+  featureEdges.SetInputData(normals.GetOutput())
+  featureEdges.Update()
+
+  allNormalsArray = surfacePd.GetCellData().GetArray('Normals')
+
+  doubleSurfacePoints = vtk.vtkPoints()
+  doubleSurfacePoints.DeepCopy(surfacePd.GetPoints())
+  for pointID in range(numberOfPoints):
+    cellIDs = vtk.vtkIdList()
+    surfacePd.GetPointCells(pointID, cellIDs)
+    normalsArray = [np.array(allNormalsArray.GetTuple3(cellIDs.GetId(i))) for i in range(cellIDs.GetNumberOfIds())]
+    dir_vec = np.sum(normalsArray, axis=0)
+    dir_vec_norm = dir_vec / np.linalg.norm(dir_vec)
+    proj_length = np.dot(dir_vec_norm, normalsArray[0])
+    doubleSurfacePoints.InsertNextPoint(np.array(surfacePd.GetPoint(pointID)) + dir_vec_norm * proj_length * shellThickness)
+
+  doubleSurfacePolys = vtk.vtkCellArray()
+  doubleSurfacePolys.DeepCopy(surfacePd.GetPolys())
+  for cellID in range(surfacePd.GetNumberOfCells()):
+    pointIDs = vtk.vtkIdList()
+    surfacePd.GetCellPoints(cellID, pointIDs)
+    newPointIDs = vtk.vtkIdList()
+    for i in reversed(range(pointIDs.GetNumberOfIds())):
+      newPointIDs.InsertNextId(int(pointIDs.GetId(i) + numberOfPoints))
+    doubleSurfacePolys.InsertNextCell(newPointIDs)
+
+  doubleSurfacePD = vtk.vtkPolyData()
+  doubleSurfacePD.SetPoints(doubleSurfacePoints)
+  doubleSurfacePD.SetPolys(doubleSurfacePolys)
+
+  mergePoints = vtk.vtkMergePoints()
+  mergePoints.InitPointInsertion(doubleSurfacePD.GetPoints(), doubleSurfacePD.GetBounds())
+  mergePoints.SetDataSet(doubleSurfacePD)
+  mergePoints.BuildLocator()
+
+  for e in range(featureEdges.GetOutput().GetNumberOfCells()):
+    pointIDs = vtk.vtkIdList()
+    featureEdges.GetOutput().GetCellPoints(e, pointIDs)
+    if pointIDs.GetNumberOfIds() == 2:
+      matchingPointIDs = [mergePoints.IsInsertedPoint(featureEdges.GetOutput().GetPoint(pointIDs.GetId(p))) for p in range(2)]
+      if not (-1) in matchingPointIDs:
+        newPointIDs = vtk.vtkIdList()
+        newPointIDs.InsertNextId(matchingPointIDs[1])
+        newPointIDs.InsertNextId(matchingPointIDs[0])
+        newPointIDs.InsertNextId(matchingPointIDs[0]+numberOfPoints)
+        newPointIDs.InsertNextId(matchingPointIDs[1]+numberOfPoints)
+        doubleSurfacePolys.InsertNextCell(newPointIDs)
+
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputData(doubleSurfacePD)
+  normals = vtk.vtkPolyDataNormals()
+  normals.SetInputConnection(triangleFilter.GetOutputPort())
+  normals.Update()
+  return normals.GetOutput()
+
+
+def benchmarkShellSolidify(resolutions=(100, 300, 600)):
+  """Compare vectorized shell solidification with the point-by-point reference implementation"""
+  effect = importWrapSolidifyLogic()
+  from vtk.util import numpy_support
+  results = []
+  for resolution in resolutions:
+    surfacePd = createOpenSurface(resolution)
+
+    startTime = time.time()
+    referencePd = shellSolidifyReference(surfacePd, 1.5, effect.SHELL_OFFSET_INSIDE, effect.SHELL_OFFSET_OUTSIDE)
+    referenceTime = time.time() - startTime
+
+    startTime = time.time()
+    shellPd = effect.WrapSolidifyLogic._shellSolidify(surfacePd, 1.5, effect.SHELL_OFFSET_INSIDE)
+    vectorizedTime = time.time() - startTime
+
+    if (shellPd.GetNumberOfPoints() != referencePd.GetNumberOfPoints()
+      or shellPd.GetNumberOfCells() != referencePd.GetNumberOfCells()):
+      raise ValueError("Shell solidify output topology differs from reference")
+    maxPointDifference = np.max(np.abs(
+      numpy_support.vtk_to_numpy(shellPd.GetPoints().GetData())
+      - numpy_support.vtk_to_numpy(referencePd.GetPoints().GetData())))
+    if maxPointDifference > 1e-4:
+      raise ValueError("Shell solidify output geometry differs from reference by {0}".format(maxPointDifference))
+
+    result = {
+      'benchmark': 'shellSolidify',
+      'numberOfInputCells': surfacePd.GetNumberOfCells(),
+      'referenceTimeSec': referenceTime,
+      'timeSec': vectorizedTime,
+      'speedup': referenceTime / max(vectorizedTime, 1e-6),
+      }
+    logging.info("Shell solidify {numberOfInputCells} cells: reference {referenceTimeSec:.2f}s, "
+      "vectorized {timeSec:.2f}s ({speedup:.1f}x)".format(**result))
+    results.append(result)
+  return results
+
+
+def loadBenchmarkLabelmap(labelmapFilePath=None):
+  """Load a binary labelmap (vtkImageData with voxel value 1 inside the object).
+  If no file is specified then bone is thresholded in the CTChest sample data set.
+  """
+  if labelmapFilePath:
+    volumeNode = slicer.util.loadLabelVolume(labelmapFilePath)
+    thresholdValue = 1
+  else:
+    import SampleData
+    volumeNode = SampleData.downloadSample('CTChest')
+    thresholdValue = 200  # bone
+  threshold = vtk.vtkImageThreshold()
+  threshold.SetInputData(volumeNode.GetImageData())
+  threshold.ThresholdByUpper(thresholdValue)
+  threshold.SetInValue(1)
+  threshold.SetOutValue(0)
+  threshold.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+  threshold.Update()
+  labelmap = vtk.vtkImageData()
+  labelmap.DeepCopy(threshold.GetOutput())
+  labelmap.SetOrigin(volumeNode.GetOrigin())
+  labelmap.SetSpacing(volumeNode.GetSpacing())
+  slicer.mrmlScene.RemoveNode(volumeNode)
+  return labelmap
+
+
+def benchmarkIsoSurfaceEngines(labelmapFilePath=None, numbersOfThreads=(1, 4, 16)):
+  """Compare discrete marching cubes with multi-threaded discrete flying edges surface extraction"""
+  effect = importWrapSolidifyLogic()
+  testing = importWrapSolidifyTesting()
+  labelmap = loadBenchmarkLabelmap(labelmapFilePath)
+  dimensions = labelmap.GetDimensions()
+  numberOfVoxels = dimensions[0] * dimensions[1] * dimensions[2]
+
+  startTime = time.time()
+  referencePd = effect.WrapSolidifyLogic._labelmapToPolydata(labelmap, 1, effect.ISO_SURFACE_ENGINE_DISCRETE_MARCHING_CUBES)
+  referenceTime = time.time() - startTime
+
+  results = []
+  previousNumberOfThreads = vtk.vtkSMPTools.GetEstimatedNumberOfThreads()
+  try:
+    for numberOfThreads in numbersOfThreads:
+      vtk.vtkSMPTools.Initialize(numberOfThreads)
+      startTime = time.time()
+      surfacePd = effect.WrapSolidifyLogic._labelmapToPolydata(labelmap, 1, effect.ISO_SURFACE_ENGINE_DISCRETE_FLYING_EDGES)
+      flyingEdgesTime = time.time() - startTime
+
+      # Compare with reference: signed volume must be the same (also verifies that the orientation is correct)
+      referenceVolume = testing.getSignedVolume(referencePd)
+      volumeDifference = abs(testing.getSignedVolume(surfacePd) - referenceVolume) / abs(referenceVolume)
+      if volumeDifference > 1e-3:
+        raise ValueError("Flying edges output volume differs from reference by {0:.2f}%".format(volumeDifference * 100))
+
+      result = {
+        'benchmark': 'isoSurfaceEngine',
+        'numberOfVoxels': numberOfVoxels,
+        'numberOfThreads': numberOfThreads,
+        'smpBackend': vtk.vtkSMPTools.GetBackend() if hasattr(vtk.vtkSMPTools, 'GetBackend') else '',
+        'numberOfOutputCells': surfacePd.GetNumberOfCells(),
+        'referenceTimeSec': referenceTime,
+        'timeSec': flyingEdgesTime,
+        'speedup': referenceTime / max(flyingEdgesTime, 1e-6),
+        }
+      logging.info("Surface extraction {numberOfVoxels} voxels: marching cubes {referenceTimeSec:.2f}s, "
+        "flying edges with {numberOfThreads} threads {timeSec:.2f}s ({speedup:.1f}x)".format(**result))
+      results.append(result)
+  finally:
+    # Restore the number of threads that was used before the benchmark
+    vtk.vtkSMPTools.Initialize(previousNumberOfThreads)
+  return results
+
+
+def benchmarkRasterization(spacings=(1.0, 0.5, 0.25), numbersOfThreads=(4, 16)):
+  """Compare single-threaded and parallel slab rasterization of a closed surface"""
+  effect = importWrapSolidifyLogic()
+  from vtk.util import numpy_support
+  sphereSource = vtk.vtkSphereSource()
+  sphereSource.SetRadius(50)
+  sphereSource.SetPhiResolution(200)
+  sphereSource.SetThetaResolution(200)
+  sphereSource.Update()
+  surfacePd = sphereSource.GetOutput()
+
+  results = []
+  for spacing in spacings:
+    startTime = time.time()
+    referenceLabelmap = effect.WrapSolidifyLogic._polydataToLabelmap(surfacePd, spacing, numberOfThreads=1)
+    referenceTime = time.time() - startTime
+    referenceVoxels = numpy_support.vtk_to_numpy(referenceLabelmap.GetPointData().GetScalars())
+    for numberOfThreads in numbersOfThreads:
+      startTime = time.time()
+      labelmap = effect.WrapSolidifyLogic._polydataToLabelmap(surfacePd, spacing, numberOfThreads=numberOfThreads)
+      parallelTime = time.time() - startTime
+      if not np.array_equal(numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()), referenceVoxels):
+        raise ValueError("Parallel rasterization output differs from reference")
+      result = {
+        'benchmark': 'rasterization',
+        'numberOfVoxels': len(referenceVoxels),
+        'numberOfThreads': numberOfThreads,
+        'referenceTimeSec': referenceTime,
+        'timeSec': parallelTime,
+        'speedup': referenceTime / max(parallelTime, 1e-6),
+        }
+      logging.info("Rasterization {numberOfVoxels} voxels: single-threaded {referenceTimeSec:.2f}s, "
+        "{numberOfThreads} threads {timeSec:.2f}s ({speedup:.1f}x)".format(**result))
+      results.append(result)
+  return results
+
+
+def createThinSliceSegmentation(spacing=(0.3, 0.3, 1.0), radii=(30.0, 20.0, 15.0)):
+  """Create a segmentation node with an ellipsoid segment, stored as labelmap with anisotropic spacing"""
+  dimensions = [int(math.ceil(2 * radii[i] / spacing[i])) + 10 for i in range(3)]
+  k, j, i = np.meshgrid(*[np.arange(dimensions[axis]) for axis in [2, 1, 0]], indexing='ij')
+  center = [(dimensions[axis] - 1) / 2.0 for axis in range(3)]
+  inside = (((i - center[0]) * spacing[0] / radii[0]) ** 2
+    + ((j - center[1]) * spacing[1] / radii[1]) ** 2
+    + ((k - center[2]) * spacing[2] / radii[2]) ** 2) <= 1.0
+
+  labelmap = slicer.vtkOrientedImageData()
+  labelmap.SetDimensions(dimensions)
+  labelmap.SetSpacing(spacing)
+  labelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+  from vtk.util import numpy_support
+  numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars())[:] = inside.ravel().astype(np.uint8)
+
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+  segmentId = segmentationNode.AddSegmentFromBinaryLabelmapRepresentation(labelmap, 'Ellipsoid')
+  return segmentationNode, segmentId
+
+
+def benchmarkAnisotropicGrid():
+  """Compare isotropic and anisotropic remesh grids on a thin-slice labelmap"""
+  effect = importWrapSolidifyLogic()
+  testing = importWrapSolidifyTesting()
+  segmentationNode, segmentId = createThinSliceSegmentation()
+  segmentationNode.CreateClosedSurfaceRepresentation()
+  referencePd = vtk.vtkPolyData()
+  segmentationNode.GetClosedSurfaceRepresentation(segmentId, referencePd)
+  bounds = np.zeros(6)
+  referencePd.GetBounds(bounds)
+
+  defaultOversampling = effect.ARG_DEFAULTS[effect.ARG_REMESH_OVERSAMPLING]
+  # Ratio of the isotropic grid spacing and the in-plane spacing of the anisotropic grid
+  gridSpacings = {}
+  for remeshAnisotropic in [False, True]:
+    logic = testing.createWrapSolidifyLogic(segmentationNode, segmentId, {'remeshAnisotropic': remeshAnisotropic})
+    gridSpacings[remeshAnisotropic] = np.min(logic.estimateResources()['spacing'])
+  inputSpacingRatio = gridSpacings[False] / gridSpacings[True]
+  configurations = [
+    # current behavior: isotropic grid computed from the diagonal of the input voxel
+    ('isotropic', {'remeshAnisotropic': False, 'remeshOversampling': defaultOversampling}),
+    # isotropic grid with the same in-plane resolution as the anisotropic grid
+    ('isotropicFine', {'remeshAnisotropic': False, 'remeshOversampling': defaultOversampling * inputSpacingRatio}),
+    ('anisotropic', {'remeshAnisotropic': True, 'remeshOversampling': defaultOversampling}),
+    ]
+
+  results = []
+  for name, parameters in configurations:
+    logic = testing.createWrapSolidifyLogic(segmentationNode, segmentId, parameters)
+    gridSpacing = logic.estimateResources()['spacing']
+    startTime = time.time()
+    outputPd = logic.computeWrapSolidify()
+    result = {
+      'benchmark': 'anisotropicGrid',
+      'configuration': name,
+      'numberOfVoxels': effect.WrapSolidifyLogic._getNumberOfVoxels(bounds, gridSpacing),
+      'timeSec': time.time() - startTime,
+      'meanSurfaceDistanceMm': effect.WrapSolidifyLogic._surfaceDistance(outputPd, referencePd),
+      }
+    logging.info("Remesh grid {configuration}: {numberOfVoxels} voxels, {timeSec:.2f}s, "
+      "mean surface distance {meanSurfaceDistanceMm:.3f}mm".format(**result))
+    results.append(result)
+
+  slicer.mrmlScene.RemoveNode(segmentationNode)
+  return results
+
+
+def createIslandsSegmentation(distances=(50.0, 200.0), radius=20.0):
+  """Create a segmentation node with a segment for each distance, containing two spheres at that distance"""
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+  segmentIds = []
+  for distance in distances:
+    appender = vtk.vtkAppendPolyData()
+    for center in [(-distance / 2.0, 0, 0), (distance / 2.0, 0, 0)]:
+      sphereSource = vtk.vtkSphereSource()
+      sphereSource.SetRadius(radius)
+      sphereSource.SetCenter(center)
+      sphereSource.SetPhiResolution(60)
+      sphereSource.SetThetaResolution(60)
+      appender.AddInputConnection(sphereSource.GetOutputPort())
+    appender.Update()
+    segmentIds.append(segmentationNode.AddSegmentFromClosedSurfaceRepresentation(appender.GetOutput(), "Islands{0:.0f}".format(distance)))
+  return segmentationNode, segmentIds
+
+
+def benchmarkSplitComponents(distances=(50.0, 200.0)):
+  """Compare wrapping islands on a common grid and on separate tight grids"""
+  testing = importWrapSolidifyTesting()
+  segmentationNode, segmentIds = createIslandsSegmentation(distances)
+  results = []
+  for distance, segmentId in zip(distances, segmentIds):
+    for splitComponents in [False, True]:
+      logic = testing.createWrapSolidifyLogic(segmentationNode, segmentId, {'splitComponents': splitComponents})
+      startTime = time.time()
+      outputPd = logic.computeWrapSolidify()
+      result = {
+        'benchmark': 'splitComponents',
+        'distanceMm': distance,
+        'splitComponents': splitComponents,
+        'timeSec': time.time() - startTime,
+        'volumeMm3': testing.getSignedVolume(outputPd),
+        }
+      logging.info("Islands at {distanceMm:.0f}mm, split components {splitComponents}: {timeSec:.2f}s, "
+        "volume {volumeMm3:.0f}mm3".format(**result))
+      results.append(result)
+  slicer.mrmlScene.RemoveNode(segmentationNode)
+  return results
+
+
+def benchmarkInitialShapes(maxIterations=10):
+  """Compare the number of shrinkwrap iterations that are needed to reach the same surface error
+  when starting from different initial shapes"""
+  effect = importWrapSolidifyLogic()
+  testing = importWrapSolidifyTesting()
+  # Two overlapping spheres: the union has a concave region that the surface has to shrink into
+  appender = vtk.vtkAppendPolyData()
+  for center in [(5, 5, 5), (-5, -5, -5)]:
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(20)
+    sphereSource.SetCenter(center)
+    sphereSource.SetPhiResolution(60)
+    sphereSource.SetThetaResolution(60)
+    appender.AddInputConnection(sphereSource.GetOutputPort())
+  appender.Update()
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+  segmentId = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(appender.GetOutput(), "Spheres")
+  referencePd = appender.GetOutput()
+
+  initialShapes = effect.ARG_OPTIONS[effect.ARG_INITIAL_SHAPE]
+  errors = {}
+  results = []
+  for initialShape in initialShapes:
+    errors[initialShape] = []
+    for numberOfIterations in range(1, maxIterations + 1):
+      logic = testing.createWrapSolidifyLogic(segmentationNode, segmentId,
+        {'initialShape': initialShape, 'shrinkwrapIterations': numberOfIterations})
+      startTime = time.time()
+      outputPd = logic.computeWrapSolidify()
+      result = {
+        'benchmark': 'initialShape',
+        'initialShape': initialShape,
+        'numberOfIterations': numberOfIterations,
+        'timeSec': time.time() - startTime,
+        'meanSurfaceDistanceMm': effect.WrapSolidifyLogic._surfaceDistance(outputPd, referencePd),
+        }
+      errors[initialShape].append(result['meanSurfaceDistanceMm'])
+      results.append(result)
+
+  # Number of iterations needed to reach the error of the sphere start with the default number of iterations
+  targetError = errors[effect.INITIAL_SHAPE_SPHERE][effect.ARG_DEFAULTS[effect.ARG_SHRINKWRAP_ITERATIONS] - 1]
+  for initialShape in initialShapes:
+    reachedIterations = [iterationIndex + 1 for iterationIndex, error in enumerate(errors[initialShape]) if error <= targetError]
+    logging.info("Initial shape {0}: {1} iterations to reach mean surface distance {2:.3f}mm (errors: {3})".format(
+      initialShape, reachedIterations[0] if reachedIterations else "more than {0}".format(maxIterations), targetError,
+      ", ".join(["{0:.3f}".format(error) for error in errors[initialShape]])))
+
+  slicer.mrmlScene.RemoveNode(segmentationNode)
+  return results
+
+
+def benchmarkWarmStart(bumpRadius=3.0):
+  """Compare computation time of a full re-run and a warm start re-run after a small edit of the input labelmap"""
+  effect = importWrapSolidifyLogic()
+  testing = importWrapSolidifyTesting()
+  from vtk.util import numpy_support
+  segmentationNode, segmentId = createThinSliceSegmentation(spacing=(0.5, 0.5, 0.5))
+
+  warmStartLogic = testing.createWrapSolidifyLogic(segmentationNode, segmentId, {'warmStart': True})
+  startTime = time.time()
+  warmStartLogic.computeWrapSolidify()
+  firstRunTimeSec = time.time() - startTime
+
+  # Add a small bump on the surface (at the end of the longest axis)
+  labelmap = slicer.vtkOrientedImageData()
+  segmentationNode.GetBinaryLabelmapRepresentation(segmentId, labelmap)
+  dimensions = labelmap.GetDimensions()
+  spacing = labelmap.GetSpacing()
+  voxels = numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()).reshape(dimensions[2], dimensions[1], dimensions[0])
+  insideI = np.nonzero(voxels[dimensions[2] // 2, dimensions[1] // 2, :])[0]
+  k, j, i = np.meshgrid(*[np.arange(dimensions[axis]) for axis in [2, 1, 0]], indexing='ij')
+  bump = (((i - insideI[-1]) * spacing[0]) ** 2 + ((j - dimensions[1] // 2) * spacing[1]) ** 2
+    + ((k - dimensions[2] // 2) * spacing[2]) ** 2) <= bumpRadius ** 2
+  voxels[bump] = 1
+  labelmap.GetPointData().GetScalars().Modified()
+  slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(labelmap, segmentationNode, segmentId)
+
+  startTime = time.time()
+  warmStartPd = warmStartLogic.computeWrapSolidify()
+  warmStartTimeSec = time.time() - startTime
+
+  fullLogic = testing.createWrapSolidifyLogic(segmentationNode, segmentId)
+  startTime = time.time()
+  fullPd = fullLogic.computeWrapSolidify()
+  fullTimeSec = time.time() - startTime
+
+  result = {
+    'benchmark': 'warmStart',
+    'firstRunTimeSec': firstRunTimeSec,
+    'fullTimeSec': fullTimeSec,
+    'warmStartTimeSec': warmStartTimeSec,
+    'meanSurfaceDistanceMm': effect.WrapSolidifyLogic._surfaceDistance(warmStartPd, fullPd),
+    }
+  logging.info("Re-run after edit: full {fullTimeSec:.2f}s, warm start {warmStartTimeSec:.2f}s, "
+    "mean surface distance between results {meanSurfaceDistanceMm:.3f}mm".format(**result))
+
+  slicer.mrmlScene.RemoveNode(segmentationNode)
+  return [result]
+
+
+def createMultiSegmentSegmentation(numberOfSegments=40, dimensions=(256, 256, 200), spacing=(0.8, 0.8, 1.0), radius=15.0):
+  """Create a segmentation node with many sphere-shaped segments, stored as labelmaps"""
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+  from vtk.util import numpy_support
+  randomGenerator = np.random.RandomState(0)
+  k, j, i = np.meshgrid(*[np.arange(dimensions[axis]) for axis in [2, 1, 0]], indexing='ij')
+  segmentIds = []
+  for segmentIndex in range(numberOfSegments):
+    center = [randomGenerator.uniform(radius, dimensions[axis] * spacing[axis] - radius) for axis in range(3)]
+    inside = (((i * spacing[0] - center[0]) ** 2 + (j * spacing[1] - center[1]) ** 2 + (k * spacing[2] - center[2]) ** 2)
+      <= radius ** 2)
+    labelmap = slicer.vtkOrientedImageData()
+    labelmap.SetDimensions(dimensions)
+    labelmap.SetSpacing(spacing)
+    labelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars())[:] = inside.ravel().astype(np.uint8)
+    segmentIds.append(segmentationNode.AddSegmentFromBinaryLabelmapRepresentation(labelmap, "Segment{0}".format(segmentIndex)))
+  return segmentationNode, segmentIds
+
+
+def benchmarkUndoSnapshot(numberOfSegments=40):
+  """Compare time and memory of saving the whole segmentation (segment editor undo) and saving a single segment"""
+  effect = importWrapSolidifyLogic()
+  segmentationNode, segmentIds = createMultiSegmentSegmentation(numberOfSegments)
+
+  # Segment editor undo state is a copy of the whole segmentation
+  startTime = time.time()
+  segmentationCopy = slicer.vtkSegmentation()
+  segmentationCopy.DeepCopy(segmentationNode.GetSegmentation())
+  fullTimeSec = time.time() - startTime
+  fullMemoryKB = sum([segmentationCopy.GetLayerDataObject(layerIndex).GetActualMemorySize()
+    for layerIndex in range(segmentationCopy.GetNumberOfLayers())])
+
+  startTime = time.time()
+  segmentSnapshot = effect.WrapSolidifyLogic._getSegmentSnapshot(segmentationNode, segmentIds[0])
+  segmentTimeSec = time.time() - startTime
+  segmentMemoryKB = len(segmentSnapshot['labelmap']) / 1024.0
+
+  result = {
+    'benchmark': 'undoSnapshot',
+    'numberOfSegments': numberOfSegments,
+    'fullTimeSec': fullTimeSec,
+    'fullMemoryKB': fullMemoryKB,
+    'segmentTimeSec': segmentTimeSec,
+    'segmentMemoryKB': segmentMemoryKB,
+    }
+  logging.info("Undo snapshot of {numberOfSegments} segments: whole segmentation {fullTimeSec:.3f}s {fullMemoryKB:.0f}kB, "
+    "single segment {segmentTimeSec:.3f}s {segmentMemoryKB:.0f}kB".format(**result))
+
+  slicer.mrmlScene.RemoveNode(segmentationNode)
+  return [result]
+
+
+# Synthetic phantoms: (physical size is fixed, size is the number of voxels along each axis)
+PHANTOM_EXTENT_MM = 100.0
+
+
+def getPhantomCoordinates(size):
+  """Get x, y, z coordinates (in mm, centered) of the voxels of a phantom as broadcastable arrays (k, j, i order)"""
+  spacing = PHANTOM_EXTENT_MM / size
+  coordinates = (np.arange(size) - (size - 1) / 2.0) * spacing
+  return coordinates[np.newaxis, np.newaxis, :], coordinates[np.newaxis, :, np.newaxis], coordinates[:, np.newaxis, np.newaxis]
+
+
+def createNestedShellsPhantom(size):
+  """Three concentric spherical shells (like layers of a skull or organ walls), with closed cavities between them"""
+  x, y, z = getPhantomCoordinates(size)
+  r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+  return ((r >= 40) & (r <= 45)) | ((r >= 28) & (r <= 33)) | ((r >= 15) & (r <= 20))
+
+
+def createPorousLatticePhantom(size, pitch=10.0):
+  """Trabecular-like block: overlapping spherical pores on a regular lattice form a network of connected cavities
+  inside a solid cortex layer"""
+  x, y, z = getPhantomCoordinates(size)
+  block = (np.abs(x) <= 40) & (np.abs(y) <= 40) & (np.abs(z) <= 40)
+  cortex = block & ~((np.abs(x) <= 37) & (np.abs(y) <= 37) & (np.abs(z) <= 37))
+  # Pore radius varies slowly across the block, pores of neighbor lattice cells overlap (connected cavities)
+  poreRadius = pitch * (0.55 + 0.05 * np.sin(x / 13.0) * np.cos(y / 17.0) * np.sin(z / 11.0 + 1.0))
+  poreDistanceSquared = ((np.mod(x, pitch) - pitch / 2.0) ** 2 + (np.mod(y, pitch) - pitch / 2.0) ** 2
+    + (np.mod(z, pitch) - pitch / 2.0) ** 2)
+  return cortex | (block & (poreDistanceSquared > poreRadius ** 2))
+
+
+def createMultiIslandPhantom(size, numberOfIslands=8, radius=8.0):
+  """Disjoint spheres at random (but reproducible) positions"""
+  x, y, z = getPhantomCoordinates(size)
+  randomGenerator = np.random.RandomState(0)
+  inside = np.zeros((size, size, size), dtype=bool)
+  for islandIndex in range(numberOfIslands):
+    center = randomGenerator.uniform(-40 + radius, 40 - radius, 3)
+    inside |= ((x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2) <= radius ** 2
+  return inside
+
+
+def createCrackedCortexPhantom(size, thickness=2.5, crackWidth=1.5):
+  """Thin ellipsoid shell (like cortical bone) with cracks running through it"""
+  x, y, z = getPhantomCoordinates(size)
+  radii = np.array([45.0, 30.0, 25.0])
+  outer = ((x / radii[0]) ** 2 + (y / radii[1]) ** 2 + (z / radii[2]) ** 2) <= 1.0
+  innerRadii = radii - thickness
+  inner = ((x / innerRadii[0]) ** 2 + (y / innerRadii[1]) ** 2 + (z / innerRadii[2]) ** 2) <= 1.0
+  # A crack through the whole shell and an oblique partial crack
+  crack = (np.abs(x - 10.0) <= crackWidth / 2.0) | ((np.abs(y + z) / math.sqrt(2) <= crackWidth / 2.0) & (x < -10.0))
+  return outer & ~inner & ~crack
+
+
+PHANTOMS = collections.OrderedDict([
+  ('nestedShells', createNestedShellsPhantom),
+  ('porousLattice', createPorousLatticePhantom),
+  ('multiIsland', createMultiIslandPhantom),
+  ('crackedCortex', createCrackedCortexPhantom),
+  ])
+
+
+def createPhantomLabelmap(inside):
+  """Create a labelmap from a boolean voxel array of a phantom (k, j, i order)"""
+  from vtk.util import numpy_support
+  size = inside.shape[0]
+  spacing = PHANTOM_EXTENT_MM / size
+  labelmap = slicer.vtkOrientedImageData()
+  labelmap.SetDimensions(size, size, size)
+  labelmap.SetSpacing(spacing, spacing, spacing)
+  labelmap.SetOrigin([-(size - 1) / 2.0 * spacing] * 3)
+  labelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+  numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars())[:] = np.broadcast_to(inside, (size, size, size)).ravel()
+  return labelmap
+
+
+def createPhantomSegmentation(phantomName, size):
+  """Create a segmentation node with the phantom as a labelmap segment and a small seed segment
+  in the center (for the segment region). Returns the segmentation node, phantom segment ID, and seed segment ID."""
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+  segmentId = segmentationNode.AddSegmentFromBinaryLabelmapRepresentation(
+    createPhantomLabelmap(PHANTOMS[phantomName](size)), phantomName)
+  x, y, z = getPhantomCoordinates(size)
+  seedSegmentId = segmentationNode.AddSegmentFromBinaryLabelmapRepresentation(
+    createPhantomLabelmap((x ** 2 + y ** 2 + z ** 2) <= 5.0 ** 2), "Seed")
+  return segmentationNode, segmentId, seedSegmentId
+
+
+def getPhantomConfigurations(effect, phantomName):
+  """Get processing configurations (name and parameters) that are benchmarked on a phantom:
+  each region, shell, and output mode (other parameters have default values)"""
+  configurations = [
+    ('outerSurface', {'region': effect.REGION_OUTER_SURFACE}),
+    ('segment', {'region': effect.REGION_SEGMENT}),
+    ('shell', {'createShell': True, 'shellThickness': 1.5, 'shellPreserveCracks': False}),
+    ('shellPreserveCracks', {'createShell': True, 'shellThickness': 1.5, 'shellPreserveCracks': True}),
+    ('newSegment', {'outputType': effect.OUTPUT_NEW_SEGMENT}),
+    ('model', {'outputType': effect.OUTPUT_MODEL}),
+    ]
+  if phantomName in ['nestedShells', 'porousLattice']:
+    configurations += [
+      ('largestCavity', {'region': effect.REGION_LARGEST_CAVITY}),
+      ('cavities', {'region': effect.REGION_CAVITIES}),
+      ('largestCavitySplit', {'region': effect.REGION_LARGEST_CAVITY, 'splitCavities': True, 'splitCavitiesDiameter': 5.0}),
+      ]
+  if phantomName == 'multiIsland':
+    configurations.append(('splitComponents', {'splitComponents': True}))
+  return configurations
+
+
+def benchmarkPhantoms(sizes=(64, 128, 192), phantomNames=None):
+  """Run each region, shell, and output mode on each synthetic phantom at several resolutions
+  and record time and memory usage of each processing step"""
+  effect = importWrapSolidifyLogic()
+  testing = importWrapSolidifyTesting()
+  results = []
+  # Memory usage is measured during each run (see WrapSolidifyMemoryMonitor), therefore the order of runs does not matter;
+  # on platforms where only the current memory usage can be sampled, the reported peak memory increase is a lower bound
+  for size in sizes:
+    for phantomName in (phantomNames or PHANTOMS.keys()):
+      for configurationName, parameters in getPhantomConfigurations(effect, phantomName):
+        # The segmentation is recreated for each run, because it is modified by the output
+        segmentationNode, segmentId, seedSegmentId = createPhantomSegmentation(phantomName, size)
+        logic = testing.createWrapSolidifyLogic(segmentationNode, segmentId, parameters, seedSegmentId)
+        result = {
+          'benchmark': 'phantom',
+          'case': '{0}/{1}/{2}'.format(phantomName, configurationName, size),
+          'phantom': phantomName,
+          'configuration': configurationName,
+          'size': size,
+          'estimatedPeakMemoryMB': logic.estimateResources()['peakMemoryMB'],
+          }
+        try:
+          logic.applyWrapSolidify()
+          report = logic.getInstrumentationReport()
+          result['totalTimeSec'] = report['totalTimeSec']
+          result['peakMemoryIncreaseMB'] = report['peakMemoryIncreaseMB']
+          # Iterations are summed up (for example 'shrink 1', 'shrink 2', ... are reported as 'shrink')
+          stageTimes = collections.OrderedDict()
+          for record in report['stages']:
+            stageName = record['stage'].split(' ')[0]
+            stageTimes[stageName] = stageTimes.get(stageName, 0.0) + record['timeSec']
+          result['stageTimesSec'] = stageTimes
+          logging.info("Phantom {case}: {totalTimeSec:.2f}s ({stages})".format(
+            stages=", ".join(["{0} {1:.2f}s".format(name, stageTime) for name, stageTime in stageTimes.items()]), **result))
+        except Exception as e:
+          result['error'] = str(e)
+          logging.error("Phantom {0} failed: {1}".format(result['case'], e))
+        finally:
+          if logic.outputModelNode:
+            slicer.mrmlScene.RemoveNode(logic.outputModelNode)
+          slicer.mrmlScene.RemoveNode(segmentationNode)
+        results.append(result)
+  return results
+
+
+def saveBaseline(results, baselineFilePath):
+  """Save phantom benchmark results as a machine-readable baseline (JSON) for detecting performance regressions"""
+  cases = collections.OrderedDict()
+  for result in results:
+    if result.get('benchmark') != 'phantom' or 'error' in result:
+      continue
+    cases[result['case']] = {key: result[key] for key in ['totalTimeSec', 'peakMemoryIncreaseMB', 'estimatedPeakMemoryMB', 'stageTimesSec']}
+  baseline = {
+    'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'slicerVersion': slicer.app.applicationVersion,
+    'platform': sys.platform,
+    'cases': cases,
+    }
+  with open(baselineFilePath, 'w') as file:
+    json.dump(baseline, file, indent=2)
+
+
+def compareWithBaseline(results, baselineFilePath, relativeTolerance=0.25, minimumTimeDifferenceSec=0.2,
+    minimumMemoryDifferenceMB=50.0):
+  """Compare phantom benchmark results with a baseline saved by saveBaseline.
+  A run is considered a regression if its total time, time of any processing step, or peak memory usage increase
+  exceeds the baseline by more than the relative tolerance (small absolute differences are ignored, as they are
+  within measurement noise). Failed runs are reported as regressions, other cases that are not in the baseline are ignored.
+  Returns list of regression descriptions.
+  """
+  with open(baselineFilePath) as file:
+    baselineCases = json.load(file)['cases']
+  regressions = []
+  for result in results:
+    if result.get('benchmark') != 'phantom':
+      continue
+    if 'error' in result:
+      regressions.append("{0}: failed ({1})".format(result['case'], result['error']))
+      continue
+    if result['case'] not in baselineCases:
+      continue
+    baseline = baselineCases[result['case']]
+    timeValues = [('total time', result['totalTimeSec'], baseline['totalTimeSec'])]
+    for stageName, stageTime in result['stageTimesSec'].items():
+      if stageName in baseline['stageTimesSec']:
+        timeValues.append(("{0} time".format(stageName), stageTime, baseline['stageTimesSec'][stageName]))
+    for name, value, baselineValue in timeValues:
+      if value > baselineValue * (1.0 + relativeTolerance) and value - baselineValue > minimumTimeDifferenceSec:
+        regressions.append("{0}: {1} {2:.2f}s (baseline {3:.2f}s)".format(result['case'], name, value, baselineValue))
+    memory = result['peakMemoryIncreaseMB']
+    baselineMemory = baseline['peakMemoryIncreaseMB']
+    if (memory is not None and baselineMemory is not None
+        and memory > baselineMemory * (1.0 + relativeTolerance) and memory - baselineMemory > minimumMemoryDifferenceMB):
+      regressions.append("{0}: peak memory increase {1:.0f}MB (baseline {2:.0f}MB)".format(result['case'], memory, baselineMemory))
+  for regression in regressions:
+    logging.warning("Performance regression: " + regression)
+  logging.info("Compared {0} phantom benchmark results with baseline {1}: {2} regressions".format(
+    len([result for result in results if result.get('benchmark') == 'phantom']), baselineFilePath, len(regressions)))
+  return regressions
+
+
+def runBenchmarks(labelmapFilePath=None, phantomSizes=(64, 128, 192), phantomsOnly=False):
+  results = []
+  if phantomsOnly:
+    return benchmarkPhantoms(phantomSizes)
+  results.extend(benchmarkShellSolidify())
+  results.extend(benchmarkRasterization())
+  results.extend(benchmarkAnisotropicGrid())
+  results.extend(benchmarkSplitComponents())
+  results.extend(benchmarkInitialShapes())
+  results.extend(benchmarkWarmStart())
+  results.extend(benchmarkUndoSnapshot())
+  results.extend(benchmarkIsoSurfaceEngines(labelmapFilePath))
+  results.extend(benchmarkPhantoms(phantomSizes))
+  return results
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description="Performance benchmarks of the Wrap Solidify effect logic")
+  parser.add_argument('labelmapFile', nargs='?', default=None, help="labelmap file for the surface extraction benchmark")
+  parser.add_argument('--phantoms-only', action='store_true', help="only run the synthetic phantom benchmarks")
+  parser.add_argument('--phantom-sizes', type=int, nargs='+', default=[64, 128, 192],
+    help="number of voxels along each axis of the phantoms")
+  parser.add_argument('--save-baseline', default=None, help="save phantom benchmark results into this JSON file")
+  parser.add_argument('--baseline', default=None, help="compare phantom benchmark results with this baseline JSON file")
+  args = parser.parse_args()
+
+  logging.getLogger().setLevel(logging.INFO)
+  results = runBenchmarks(args.labelmapFile, args.phantom_sizes, args.phantoms_only)
+  regressions = []
+  if args.baseline:
+    regressions = compareWithBaseline(results, args.baseline)
+  if args.save_baseline:
+    saveBaseline(results, args.save_baseline)
+  sys.exit(1 if regressions else 0)